@@ -1,11 +1,12 @@
-import google.generativai as genai
-import pandas as pd
-import os
-import json
-import math
-import time
 import streamlit as st # Thêm Streamlit
-import re # Thêm thư viện Regex để phân tích Markdown 
+import json
+import os
+import script_pipeline # Toàn bộ logic tạo kịch bản / JSON (không phụ thuộc UI, import nhanh)
+import job_queue # Hàng đợi job chạy nền (worker thread + bảng job trên đĩa)
+
+JOB_POLL_SECONDS = 2 # Chu kỳ làm mới bảng job khi còn job đang chạy
+MAX_JOBS_SHOWN = 20
+JOB_MESSAGES_SHOWN = 8 # Số thông báo gần nhất hiển thị cho mỗi job
 
 # --- API KEY CONFIGURATION ---
 try:
@@ -19,493 +20,226 @@ except (FileNotFoundError, KeyError):
         # Nếu không, dùng key hardcode (cho local dev)
         GOOGLE_API_KEY = "YOUR_NEW_API_KEY" # ⚠️ Dán key của bạn vào đây nếu không dùng secrets
 
+# Nhiều key (ClientPool): GOOGLE_API_KEYS = "key1,key2,..." trong Secrets hoặc biến môi trường
 try:
-    genai.configure(api_key=GOOGLE_API_KEY)
-except Exception as e:
-    st.error(f"Error configuring API Key: {e}. Please check your API key.")
-    st.stop() # Dừng ứng dụng nếu key lỗi
+    GOOGLE_API_KEYS = st.secrets["GOOGLE_API_KEYS"]
+except (FileNotFoundError, KeyError):
+    GOOGLE_API_KEYS = os.environ.get("GOOGLE_API_KEYS", "")
+GOOGLE_API_KEYS = script_pipeline.split_config_list(GOOGLE_API_KEYS)
 
-# Select the model
-model = genai.GenerativeModel('gemini-1.5-flash-latest')
-# -------------------------
+@st.cache_resource(show_spinner=False)
+def load_model(api_keys, model_names):
+    # Streamlit chạy lại toàn bộ file sau mỗi thao tác: model / client chỉ được tạo một lần cho mỗi tiến trình server
+    return script_pipeline.create_model(list(api_keys), model_names)
 
-def call_gemini_api(prompt, is_json=False):
+def configure_model():
     """
-    Helper function to call the API and handle errors
+    Cấu hình key và chọn model (GEMINI_MODELS: một hoặc nhiều model, cách nhau bởi dấu phẩy).
+    Chỉ gọi khi bắt đầu tạo kịch bản: google.generativeai không bị import khi mở trang hay chạy lại.
+    Model riêng của từng bước (ô "Model per step") dùng cùng các key.
     """
-    st.info(f"   ... 🤖 Sending request to AI (Model: {model.model_name})...")
-    
+    api_keys = tuple(GOOGLE_API_KEYS) or (GOOGLE_API_KEY,)
     try:
-        if is_json:
-            prompt_full = f"{prompt}\n\nPlease respond with only a valid JSON string (or a JSON list). Do not add any other text, explanations, or markdown."
-        else:
-            prompt_full = prompt
-            
-        response = model.generate_content(prompt_full)
-        
-        # Giữ thời gian chờ để tránh lỗi quota
-        time.sleep(2) 
-        
-        text_response = response.text.strip()
-        if is_json and text_response.startswith("```json"):
-            text_response = text_response[7:-3].strip() # Remove ```json and ```
-        
-        return text_response
+        script_pipeline.configure(list(api_keys), backend=load_model(
+            api_keys, os.environ.get("GEMINI_MODELS", script_pipeline.DEFAULT_MODEL_NAME)))
     except Exception as e:
-        st.warning(f"   --- 😥 Error calling API: {e} ---")
-        st.warning("   --- Will retry after 5 seconds ---")
-        time.sleep(5)
-        # Retry once
-        try:
-            response = model.generate_content(prompt_full)
-            time.sleep(2)
-            text_response = response.text.strip()
-            if is_json and text_response.startswith("```json"):
-                text_response = text_response[7:-3].strip() # Remove ```json and ```
-            return text_response
-        except Exception as e2:
-            st.error(f"   --- 😥 Error on second try: {e2}. Skipping this step. ---")
-            return None # Return None on failure
+        st.error(f"Error configuring API Key: {e}. Please check your API key.")
+        st.stop() # Dừng ứng dụng nếu key lỗi
+# -------------------------
 
-# --- [NEW] HÀM PHÂN TÍCH BẢNG MARKDOWN ---
-def parse_markdown_table(markdown_text):
+def render_artifact(name, value):
     """
-    Trích xuất dữ liệu từ bảng Markdown trong kịch bản.
+    Hiển thị một kết quả trung gian của pipeline (cũng dùng để hiển thị lại sau khi Streamlit chạy lại script).
     """
-    parsed_scenes = []
-    # Biểu thức chính quy (Regex) để tìm các hàng trong bảng
-    # | Timecode | Scene Description | Camera Angle | Sound/Ambience | Emotion |
-    table_regex = re.compile(
-        r"\|\s*(.*?)\s*\|\s*(.*?)\s*\|\s*(.*?)\s*\|\s*(.*?)\s*\|\s*(.*?)\s*\|"
-    )
-    
-    table_found = False
-    for line in markdown_text.split('\n'):
-        line = line.strip()
-        
-        # Bỏ qua header
-        if "Timecode" in line and "Scene Description" in line:
-            table_found = True
-            continue
-        # Bỏ qua dòng phân cách "---"
-        if "---" in line and table_found:
-            continue
-        # Bắt đầu phân tích các hàng
-        if table_found and line.startswith('|'):
-            match = table_regex.match(line)
-            if match:
-                groups = match.groups()
-                if len(groups) == 5:
-                    parsed_scenes.append({
-                        "timecode": groups[0],
-                        "description": groups[1],
-                        "camera": groups[2],
-                        "sound": groups[3],
-                        "emotion": groups[4]
-                    })
-                    
-    return parsed_scenes
-
-# --- [NEW] HÀM PHÂN TÍCH CÁC PHẦN KHÁC ---
-def parse_script_sections(markdown_text):
+    if name == "keys":
+        with st.expander("Show Generated Consistency Keys"):
+            st.markdown(value)
+    elif name == "script":
+        # Hiển thị toàn bộ kịch bản Markdown lên giao diện
+        with st.expander("Show Generated Master Script (Markdown)", expanded=True):
+            st.markdown(value)
+    elif name == "sections":
+        st.text_input("Generated Title", value=value.get('title', ''))
+        st.text_area("Generated Description", value=value.get('description', ''))
+        st.text_area("Generated Thumbnail Prompts", value=value.get('thumbnail_prompts', ''))
+    elif name == "scene_table":
+        # Hiển thị bảng dữ liệu (list các dict; Streamlit tự chuyển thành bảng)
+        st.dataframe(value)
+    elif name == "metadata":
+        # --- TẢI VỀ TỆP METADATA .TXT ---
+        st.download_button(
+            label="Download Video Metadata (.txt)",
+            data=value,
+            file_name="video_metadata.txt",
+            mime="text/plain"
+        )
+    elif name == "usage" and value:
+        # Báo cáo token đã dùng theo từng bước (lấy từ usage_metadata của API)
+        with st.expander("Token usage by stage"):
+            st.dataframe(value, use_container_width=True)
+        total_prompt_tokens = sum(entry["prompt_tokens"] for entry in value)
+        total_saved = sum(entry["prefix_tokens_saved"] for entry in value)
+        st.caption(f"Prompt tokens sent: {total_prompt_tokens:,} · est. tokens saved by prefix compaction/caching: {total_saved:,}")
+    elif name == "trace":
+        # Bảng tổng hợp của lần chạy: thời gian, latency, retry, thông lượng
+        with st.expander("Run summary (latency & throughput)", expanded=True):
+            col_time, col_rate, col_latency, col_retries = st.columns(4)
+            col_time.metric("Total time", f"{value['total_seconds']:.1f}s")
+            col_rate.metric("Scenes / minute", value["scenes_per_minute"] if value["scenes_per_minute"] is not None else "n/a")
+            col_latency.metric("p50 / p95 call latency",
+                               f"{value['p50_call_seconds']:.1f}s / {value['p95_call_seconds']:.1f}s"
+                               if value["p50_call_seconds"] is not None else "n/a")
+            col_retries.metric("Retries", value["retries"])
+            cache_stats = script_pipeline.response_cache.stats()
+            st.caption(f"Response cache: {value['cache_hits']} hits / {value.get('cache_misses', 0)} misses this run · "
+                       f"{cache_stats['hits']} hits / {cache_stats['misses']} misses on this server since it started")
+            st.caption(f"API calls: {value['api_calls']} · "
+                       f"waiting for rate limiter: {value['queue_seconds']:.1f}s · "
+                       f"sleeping before retries: {value['retry_sleep_seconds']:.1f}s")
+            if value.get("hedging"):
+                hedging = value["hedging"]
+                st.caption(f"Hedged batches: {hedging['hedged_batches']} ({hedging['extra_requests']} extra requests) · "
+                           f"hedges finished first: {hedging['hedges_won']} · "
+                           f"batch time saved: ≥ {hedging['seconds_saved']:.1f}s")
+            if value.get("stage_models"):
+                st.caption("Models: " + " · ".join(f"{route}: {name}" for route, name in value["stage_models"].items()))
+            st.dataframe([{"step": step, "seconds": seconds} for step, seconds in value["stage_seconds"].items()],
+                         use_container_width=True)
+            st.dataframe(value["stages"], use_container_width=True)
+
+@st.cache_resource(show_spinner=False)
+def get_job_queue():
     """
-    Trích xuất Tiêu đề, Mô tả, Thumbnail Prompts, etc.
+    Một hàng đợi job (và các worker thread) cho mỗi tiến trình server, dùng chung cho mọi phiên / tab.
+    Số job chạy cùng lúc: MAX_CONCURRENT_JOBS trong Secrets hoặc biến môi trường.
     """
-    data = {}
-    try:
-        # Dùng Regex để tìm các phần (rất linh hoạt)
-        data['title'] = re.search(r"#\s*Title\s*\n(.*?)\n", markdown_text, re.DOTALL | re.IGNORECASE).group(1).strip()
-    except: data['title'] = "Title Not Found"
-    
     try:
-        data['description'] = re.search(r"#\s*Description\s*\n(.*?)\n#", markdown_text, re.DOTALL | re.IGNORECASE).group(1).strip()
-    except: data['description'] = "Description Not Found"
+        max_concurrent_jobs = st.secrets["MAX_CONCURRENT_JOBS"]
+    except (FileNotFoundError, KeyError):
+        max_concurrent_jobs = job_queue.MAX_CONCURRENT_JOBS
+    return job_queue.JobQueue(max_concurrent_jobs=int(max_concurrent_jobs))
 
-    # Đã thêm regex cho Hashtags
-    try:
-        data['hashtags'] = re.search(r"#\s*Hashtags\s*\n(.*?)\n#", markdown_text, re.DOTALL | re.IGNORECASE).group(1).strip()
-    except: data['hashtags'] = "#hashtags #not #found"
-    
-    try:
-        data['thumbnail_prompts'] = re.search(r"#\s*Thumbnail Prompts\s*\n(.*?)\n#", markdown_text, re.DOTALL | re.IGNORECASE).group(1).strip()
-    except: data['thumbnail_prompts'] = "Thumbnails Not Found"
-
-    try:
-        data['keywords'] = re.search(r"#\s*Keywords\s*\n(.*?)\n#", markdown_text, re.DOTALL | re.IGNORECASE).group(1).strip()
-    except: data['keywords'] = "Keywords Not Found"
-    
-    return data
+@st.cache_data(show_spinner=False, max_entries=8)
+def load_job_artifacts(job_dir):
+    """
+    Đọc lại kết quả của một job đã xong từ bundle trên đĩa (theo thứ tự hiển thị của render_artifact).
+    Bundle không đổi sau khi job xong nên chỉ đọc một lần cho mỗi job.
+    """
+    def read_text(filename):
+        with open(os.path.join(job_dir, filename), "r", encoding="utf-8") as f:
+            return f.read()
+    markdown_script = read_text("script.md")
+    script_index = script_pipeline.index_script(markdown_script)
+    return {
+        "keys": read_text("consistency_keys.md"),
+        "script": markdown_script,
+        "sections": script_pipeline.parse_script_sections(markdown_script, script_index),
+        "scene_table": script_index.rows,
+        "metadata": read_text("video_metadata.txt"),
+        "usage": json.loads(read_text("token_usage.json")),
+        "trace": json.loads(read_text("run_trace.json"))["summary"],
+    }
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def load_job_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def show_export_downloads(job):
+    """
+    Một nút tải về cho mỗi định dạng đã xuất và cho run trace (đọc từ thư mục của job).
+    """
+    job_dir = get_job_queue().job_dir(job["id"])
+    downloads = [(f"Download {export_format.upper()} File (Veo 3 JSONs)", filename, mime)
+                 for export_format, filename, mime in job["outputs"]]
+    downloads.append(("Download Run Trace (JSON)", "run_trace.json", "application/json"))
+    for label, filename, mime in downloads:
+        st.download_button(
+            label=label,
+            data=load_job_file(os.path.join(job_dir, filename)),
+            file_name=f"{job['run_id']}_trace.json" if filename == "run_trace.json" else filename,
+            mime=mime,
+            key=f"download_{job['id']}_{filename}"
+        )
 
 # --- LOGIC CHÍNH (Đã được cập nhật) ---
-def main_automation(video_topic, video_duration_minutes):
-    
-    # Placeholder cho các thanh status
-    status_area = st.container()
-    progress_bar = status_area.progress(0, text="Starting...")
-    SCENE_DURATION_SECONDS = 8 # Mặc định
-    JSON_BATCH_SIZE = 10 
-    
-    # Tính toán tổng số cảnh
-    total_scenes = math.ceil((video_duration_minutes * 60) / SCENE_DURATION_SECONDS)
-    st.info(f"Calculating for {video_duration_minutes} minutes... ({total_scenes} scenes @ {SCENE_DURATION_SECONDS}s each)")
-
-    try:
-        # --- [STEP 1] (Đã Nâng cấp): GENERATE "PREHUMANFILE" SCRIPT ---
-        progress_bar.progress(10, text="[1/5] Generating 'PrehumanFile' master script...")
-        
-        prompt_task_1_prehumanfile = f"""
-        You are a cinematic scriptwriter for the YouTube channel “PrehumanFile,” which produces visually immersive, emotional, AI-generated documentaries about prehistoric survival.  
-        
-        Your task: Write a full cinematic script (VEO 3–ready format) for one episode based on the user’s provided video topic and duration.
-
-        === INPUT ===
-        Video Topic: "{video_topic}"
-        Video Duration: "{video_duration_minutes} minutes"
-
-        === OUTPUT STYLE & STRUCTURE ===
-
-        🎯 1. VIDEO OVERVIEW
-        - Title suggestion (fit YouTube style: “Life X Million Years Ago | [Conflict/Emotion/Outcome]”)
-        - One-line tagline
-        - Short description (SEO-optimized, cinematic tone)
-        - Recommended hashtags (#prehistoric #prehumanfile #survival #stoneage #ancienthumans)
-
-        🎬 2. CINEMATIC SCRIPT STRUCTURE ({video_duration_minutes} minutes total)
-        Divide into 3 ACTS and a CLOSING TAG.
-        Your script table must contain exactly {total_scenes} scenes.
-        
-        | Timecode | Scene Description (1 line, cinematic) | Camera Angle | Sound/Ambience | Emotion |
-        |-----------|----------------------------------------|----------------|----------------|----------|
-
-        Follow this model:
-        - **Act I – Awakening (10% duration):** Introduce environment + first instinct (fear or awe).
-        - **Act II – Confrontation (60% duration):** Main survival conflict: danger, strategy, or loss.
-        - **Act III – Resolution (25% duration):** Survival outcome, emotional reflection.
-        - **Tag Scene (5% duration):** A haunting or hopeful visual to tease the next episode.
-
-        Each scene = one {SCENE_DURATION_SECONDS}s micro-shot (for VEO 3 input).  
-        Use compact English (one line per scene, no line breaks inside).  
-
-        🎥 3. CINEMATIC VISUAL GUIDELINES
-        - **Scientific Consistency:** You MUST define the specific prehistoric era (e.g., Late Pleistocene) and hominid species (e.g., Neanderthal, Homo erectus) based on the topic.
-        - **Mandatory Consistency:** All animals, plants, and tools mentioned MUST be scientifically accurate for that specific era and species.
-        - Aspect ratio 16:9, golden-hour or storm lighting, Panavision anamorphic lens.
-        - Focus on prehistoric realism: stone tools, mammoths, volcano smoke, tribal faces.
-        - Lighting tone: fire-orange, fog-blue, or earthy neutrals.
-        - Human motion should feel natural, grounded, emotional (close-ups on eyes, hands, fire).
-
-        🔊 4. AUDIO & ATMOSPHERE
-        - Ambient base: wind, crackling fire, breathing, animal calls.
-        - Emotional layer: deep tribal drums, low strings, heartbeat pulse.
-        - Use silence strategically (before climax or aftermath).
-        - Sound motif: final 2 seconds = “flame burst + deep drum” (brand signature).
-
-        💥 5. HOOK & CTA
-        - First 8 seconds: visual shock or emotional hook (“Fear → Curiosity → Survival”).
-        - Add one text overlay hook at 0:05 like: “When fire dies, how do you survive the night?”
-        - CTA end-screen line: “Continue the PrehumanFile — next chapter below 🔥”.
-
-        📜 6. ADDITIONAL OUTPUTS
-        - 3 alternative YouTube titles (SEO-friendly + emotionally charged)
-        - 3 highly detailed, 50-word cinematic thumbnail prompts (for AI image generation)
-        - 5 SEO keywords related to the episode
-        - Short caption (for YouTube Shorts version, <100 characters)
-
-        === OUTPUT FORMAT ===
-        Return everything as clear Markdown sections:
-        # Title
-        (Suggested Title)
-
-        # Description
-        (Tagline and Description)
-        
-        # Hashtags
-        (Hashtags)
-        
-        # Era Definition
-        (e.g., "Era: Late Pleistocene. Species: Homo neanderthalensis")
-
-        # Script (table format)
-        (The full Markdown table with exactly {total_scenes} scenes)
-        
-        # Thumbnail Prompts
-        (3 prompt lines)
-
-        # Keywords
-        (5 keywords)
-
-        # CTA
-        (CTA Line and Hook Text)
-
-        Tone: cinematic, emotional, survival-driven, with a mythic prehistoric atmosphere.
-        """
-        markdown_script = call_gemini_api(prompt_task_1_prehumanfile)
-        if not markdown_script:
-            st.error("Error: Could not generate master script. Exiting.")
-            return
-
-        # Hiển thị toàn bộ kịch bản Markdown lên giao diện
-        with st.expander("Show Generated Master Script (Markdown)", expanded=True):
-            st.markdown(markdown_script)
-        
-        # --- [STEP 2] (Đã Nâng cấp): PARSE MARKDOWN SCRIPT ---
-        progress_bar.progress(25, text="[2/5] Parsing generated script...")
-        
-        # Phân tích bảng
-        scene_list_data = parse_markdown_table(markdown_script)
-        
-        if not scene_list_data:
-             st.error("   ! Critical Error: AI did not return a valid Markdown Table for the script. Stopping.")
-             return
-        
-        num_scenes_generated = len(scene_list_data)
-        if num_scenes_generated != total_scenes:
-             st.warning(f"   ! Warning: AI generated {num_scenes_generated} scenes instead of {total_scenes} as requested. Continuing.")
+def main_automation(video_topic, video_duration_minutes, max_workers=script_pipeline.DEFAULT_JSON_WORKERS,
+                    rpm_limit=script_pipeline.DEFAULT_RPM_LIMIT, tpm_limit=script_pipeline.DEFAULT_TPM_LIMIT,
+                    refresh_cache=False, streaming_mode=False, resume_job=False, export_formats=("xlsx",),
+                    script_mode="auto", use_library=True, hedge_mode="off", stage_models=None):
+    """
+    Đưa một tập vào hàng đợi job và trả về job_id ngay; pipeline (script_pipeline.run_episode) chạy
+    trên worker thread của JobQueue, trang chỉ theo dõi tiến độ (show_jobs).
+    `stage_models`: {route: model} cho các bước dùng model khác model chính (xem script_pipeline.STAGE_ROUTES).
+    """
+    return get_job_queue().submit(video_topic, video_duration_minutes, {
+        "workers": int(max_workers),
+        "rpm_limit": int(rpm_limit),
+        "tpm_limit": int(tpm_limit),
+        "refresh_cache": refresh_cache,
+        "streaming": streaming_mode,
+        "resume": resume_job,
+        "formats": list(export_formats or ("xlsx",)),
+        "script_mode": script_mode,
+        "use_library": use_library,
+        "hedge_mode": hedge_mode,
+        "stage_models": {route: spec.strip() for route, spec in (stage_models or {}).items() if spec and spec.strip()},
+    })
+
+def format_job(job):
+    return f"{job['topic']} ({job['duration_minutes']} min) · {job['status']} · {job['id']}"
+
+def show_job(job):
+    """
+    Chi tiết một job: tiến độ + nút hủy khi đang chạy, kết quả + tải về khi xong, chạy tiếp khi lỗi.
+    """
+    queue = get_job_queue()
+    if job["status"] in job_queue.ACTIVE_STATUSES:
+        st.progress(job["progress"], text=job["progress_text"])
+        for level, message in job["messages"][-JOB_MESSAGES_SHOWN:]:
+            getattr(st, level)(message)
+        if not job["cancel_requested"] and st.button("Cancel job", key=f"cancel_{job['id']}"):
+            queue.cancel(job["id"])
+            st.rerun(scope="fragment")
+    elif job["status"] == "done":
+        st.success(f"Successfully generated {job['scenes'] - job['failed_scenes']}/{job['scenes']} scenes "
+                   f"in {job['total_seconds']:.0f}s (run {job['run_id']}).")
+        for artifact_name, artifact_value in load_job_artifacts(queue.job_dir(job["id"])).items():
+            render_artifact(artifact_name, artifact_value)
+        show_export_downloads(job)
+    else:
+        if job["status"] == "cancelled":
+            st.warning("This job was cancelled.")
         else:
-             status_area.info(f"   -> Parsed a total of {num_scenes_generated} scenes from Markdown table.")
-        
-        # Phân tích các phần khác (Tiêu đề, Mô tả...)
-        other_script_data = parse_script_sections(markdown_text)
-        st.text_input("Generated Title", value=other_script_data.get('title', ''))
-        st.text_area("Generated Description", value=other_script_data.get('description', ''))
-        st.text_area("Generated Thumbnail Prompts", value=other_script_data.get('thumbnail_prompts', ''))
-        
-        # Hiển thị bảng dữ liệu
-        st.dataframe(pd.DataFrame(scene_list_data))
-
-        # --- [MỚI] TẠO VÀ TẢI VỀ TỆP METADATA .TXT ---
-        try:
-            metadata_content = f"""
-# ===============================
-# PREHUMANFILE VIDEO METADATA
-# ===============================
-
-# TITLE
-{other_script_data.get('title', 'N/A')}
-
-# DESCRIPTION
-{other_script_data.get('description', 'N/A')}
-
-# HASHTAGS
-{other_script_data.get('hashtags', 'N/A')}
-
-# KEYWORDS
-{other_script_data.get('keywords', 'N/A')}
-
-# THUMBNAIL PROMPTS
-{other_script_data.get('thumbnail_prompts', 'N/A')}
-            """
-            
-            st.download_button(
-                label="Download Video Metadata (.txt)",
-                data=metadata_content.strip(),
-                file_name="video_metadata.txt",
-                mime="text/plain"
-            )
-        except Exception as e:
-            st.warning(f"Could not generate metadata download button: {e}")
-        # --- KẾT THÚC BƯỚC MỚI ---
-        
-        # --- [STEP 3] (Đã Nâng cấp): GENERATE CONSISTENCY KEYS ---
-        progress_bar.progress(40, text="[3/5] Generating Consistency Keys...")
-        prompt_task_2_5 = f"""
-        Based on the following full master script: 
-        "{markdown_script}"
-        
-        Identify the MAIN CHARACTERS, KEY LOCATIONS, or special OBJECTS that will appear repeatedly.
-        For each item, provide a detailed visual description to ensure consistency in all scenes.
-        Pay close attention to the "Era Definition" (Species, Era) from the script.
-
-        Example:
-        - CHARACTER (Kael): 'A young Neanderthal hunter, lean, wearing rough furs, has a scar over
-        his left eye, carries a flint-tipped spear. (Based on Homo neanderthalensis)'
-        - LOCATION (The Valley): 'A misty, volcanic valley, black rock, sparse giant ferns (Pleistocene era), a river of slow-moving lava in the distance.'
-
-        Please respond concisely, focusing on visual descriptions.
-        Please respond in English.
-        """
-        consistency_keys = call_gemini_api(prompt_task_2_5)
-        if not consistency_keys:
-            st.warning("   ! Warning: Could not generate consistency keys. Continuing without them.")
-            consistency_keys = "None"
-            
-        with st.expander("Show Generated Consistency Keys"):
-            st.markdown(consistency_keys)
-
-        # --- [STEP 4] (Đã Nâng cấp): GENERATE VEO 3 JSON PROMPT (IN BATCHES) ---
-        progress_bar.progress(60, text="[4/5] Processing JSON details in batches...")
-        
-        all_scenes_data = [] # Đây là danh sách cuối cùng cho Excel
-        
-        # Template JSON Veo 3 (từ file Prompt AI Veo 3.txt của bạn)
-        json_template_string = f"""
-        {{
-            "1. CORE_IDEA": {{
-                "scene_purpose": "Briefly describe the purpose of this scene (based on the scene description)",
-                "desired_duration_seconds": {SCENE_DURATION_SECONDS}
-            }},
-            "2. CHARACTERS_AND_ACTIONS": [
-                {{
-                    "character": "Character Name 1 (if any, use name from consistency keys)",
-                    "description": "Appearance description (TAKE FROM CONSISTENCY KEYS IF AVAILABLE)",
-                    "action_and_expression": "Describe the specific action and expression IN THIS SCENE"
-                }}
-            ],
-            "3. SETTING": {{
-                "location": "Location (TAKE FROM CONSISTENCY KEYS IF AVAILABLE, or describe new)",
-                "time_and_weather": "Time of day and weather in this scene",
-                "key_elements": ["Key Element 1", "Key Element 2", "Key Element 3"],
-                "negative_prompt": "cartoon, animated, stylized, illustration, low-resolution, blurry, morphing artifacts, distorted features, unrealistic movement, fast motion, shaky cam, text, watermark, humans, man-made objects, modern technology, grass, flowering plants, mammals, incorrect anatomy, unrealistic physics, gore, blood."
-            }},
-            "4. VISUAL_STYLE_AND_MOOD": {{
-                "film_genre": "Science Fiction",
-                "primary_mood": "The primary mood or atmosphere (e.g., 'Mystical', 'Joyful', 'Mysterious and tense')",
-                "lighting_and_color": "Description of lighting and dominant colors (e.g., 'Soft lighting, pastel tones', 'High contrast, neon colors')",
-                "camera_work": "Description of camera techniques (e.g., 'Low angle shot', 'Handheld camera')"
-            }},
-            "5. AUDIO": {{
-                "background_music": "Type of background music (e.g., 'Epic orchestral score', 'Gentle lo-fi music')",
-                "ambient_sound": "A rich, layered description of the soundscape (e.g., 'the buzz of prehistoric insects, distant calls of unknown creatures')",
-                "sound_effects": ["Sound Effect 1 (e.g., 'deep footfalls')", "Sound Effect 2 (e.g., 'a low growl')"]
-            }}
-        }}
-        """
-        
-        # Lặp qua danh sách cảnh (đã được phân tích) theo từng lô (batch)
-        num_batches = math.ceil(len(scene_list_data) / JSON_BATCH_SIZE)
-        for i in range(0, len(scene_list_data), JSON_BATCH_SIZE):
-            
-            batch_num = (i // JSON_BATCH_SIZE) + 1
-            progress_bar.progress(60 + int(batch_num * (35/num_batches)), text=f"[4/5] Processing JSON batch {batch_num}/{num_batches}...")
-
-            batch_of_scenes_data = scene_list_data[i:i + JSON_BATCH_SIZE]
-            
-            # Xây dựng chuỗi thông tin đầu vào cho batch này
-            batch_input_string = ""
-            for j, scene_data in enumerate(batch_of_scenes_data):
-                scene_num = i + 1 + j
-                batch_input_string += f"--- SCENE {scene_num} INPUT ---\n"
-                batch_input_string += f"Timecode: {scene_data['timecode']}\n"
-                batch_input_string += f"Description: {scene_data['description']}\n"
-                batch_input_string += f"Camera: {scene_data['camera']}\n"
-                batch_input_string += f"Sound: {scene_data['sound']}\n"
-                batch_input_string += f"Emotion: {scene_data['emotion']}\n\n"
-
-            # --- Tạo prompt NÂNG CẤP cho batch 4 ---
-            prompt_task_4_batch = f"""
-            You are a JSON generation bot.
-            You will be given a list of structured scene inputs (from a Markdown table) and consistency keys.
-            You MUST return a valid JSON LIST, containing one JSON object for each scene,
-            filled according to the JSON TEMPLATE.
-            
-            CONSISTENCY KEYS (MUST ADHERE IF RELEVANT):
-            "{consistency_keys}"
-
-            JSON TEMPLATE (Use this for each object in the list):
-            {json_template_string}
-            
-            STRUCTURED SCENE INPUTS (Generate one JSON object for each):
-            {batch_input_string}
-            ---
-
-            INSTRUCTIONS:
-            Fill in the JSON TEMPLATE for EACH of the {len(batch_of_scenes_data)} scenes provided above.
-            
-            - **action_and_expression**: THIS IS CRITICAL. EXPAND the 1-line input "Description" (e.g., "Kael watches the herd") into a detailed, 300-400 word cinematic description of the action, character expression, and environment for this specific scene. Be vivid and immersive.
-            - "scene_purpose": Base this on the input "Description".
-            - "camera_work": Use the input "Camera" (e.g., "Close-up")
-            - "primary_mood": Use the input "Emotion" (e.g., "Terror")
-            - "ambient_sound": Use the input "Sound" (e.g., "Roar, rain")
-            - "character" / "description" / "location": Use the CONSISTENCY KEYS.
-            - "negative_prompt": MUST be kept exactly as it is.
-
-            Respond with only a valid JSON LIST (e.g., [ {{...}}, {{...}}, ... ]).
-            """
-            
-            json_response_string = call_gemini_api(prompt_task_4_batch, is_json=True)
-            
-            if not json_response_string:
-                st.warning(f"   ! Error: No response received for batch {batch_num}. Skipping batch.")
-                continue 
-
-            # --- Xử lý danh sách JSON ---
-            try:
-                json_list_data = json.loads(json_response_string)
-                
-                if not isinstance(json_list_data, list):
-                     raise json.JSONDecodeError("AI did not return a list.", json_response_string, 0)
-
-                for j, json_data in enumerate(json_list_data):
-                    if j >= len(batch_of_scenes_data): break 
-                    
-                    scene_data_from_table = batch_of_scenes_data[j]
-                    scene_number = i + 1 + j
-                    
-                    # Dữ liệu cơ bản từ bảng Markdown
-                    row_data = {
-                        "Scene ID": scene_number,
-                        "Table: Timecode": scene_data_from_table['timecode'],
-                        "Table: Description": scene_data_from_table['description'],
-                        "Table: Camera": scene_data_from_table['camera'],
-                        "Table: Sound": scene_data_from_table['sound'],
-                        "Table: Emotion": scene_data_from_table['emotion'],
-                    }
-                    
-                    # Thêm toàn bộ JSON
-                    row_data["JSON Prompt (Full)"] = json.dumps(json_data, indent=2)
-                    
-                    # Thêm các cột đã "làm phẳng" từ JSON (để tham khảo)
-                    core_idea = json_data.get("1. CORE_IDEA", {})
-                    row_data["JSON: Scene Purpose"] = core_idea.get("scene_purpose", "N/A")
-                    chars = json_data.get("2. CHARACTERS_AND_ACTIONS", [{}])
-                    if chars: 
-                        row_data["JSON: Character 1"] = chars[0].get("character", "N/A")
-                        # Lấy mô tả chi tiết 300-400 từ
-                        row_data["JSON: Detailed Description (300-400 words)"] = chars[0].get("action_and_expression", "N/A")
-                    
-                    all_scenes_data.append(row_data)
-
-            except json.JSONDecodeError as e:
-                st.warning(f"   ! Error: AI did not return a valid JSON LIST for batch {batch_num}. Error: {e}")
-            except Exception as e:
-                st.warning(f"   ! Unknown error processing JSON list for batch {batch_num}. Error: {e}")
-                
-        # --- STEP 5: EXPORT TO EXCEL FILE ---
-        progress_bar.progress(98, text="[5/5] Exporting data to Excel file...")
-        try:
-            df = pd.DataFrame(all_scenes_data)
-            
-            base_filename = "prehumanfile_veo3_prompts"
-            file_extension = ".xlsx"
-            output_filename = base_filename + file_extension
-            
-            # Trên Replit, chúng ta không cần vòng lặp 'while' phức tạp
-            # vì không có ai đang "mở" tệp.
-            try:
-                df.to_excel(output_filename, index=False, engine='openpyxl')
-                
-                progress_bar.progress(100, text="Complete!")
-                st.success(f"Successfully saved the detailed script to: {output_filename}")
-                
-                # Thêm nút tải về (Cách của Replit)
-                with open(output_filename, "rb") as f:
-                    st.download_button(
-                        label="Download Excel File (Veo 3 JSONs)",
-                        data=f,
-                        file_name=output_filename,
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                    )
-                return # Thoát khỏi hàm main_automation thành công
-                
-            except Exception as e:
-                st.error(f"😥 Error exporting to Excel: {e}") 
-
-        except Exception as e:
-            st.error(f"😥 An unexpected error occurred during data preparation for Excel: {e}")
-
-    except Exception as e:
-        st.error(f"😥 An unexpected error occurred during the automation process: {e}")
-        st.exception(e) # In ra toàn bộ lỗi để debug
+            st.error(f"😥 Job {job['status']}: {job.get('error') or 'unknown error'}")
+        with st.expander("Last messages"):
+            for level, message in job["messages"][-JOB_MESSAGES_SHOWN:]:
+                getattr(st, level)(message)
+        if st.button("Resume job (reuse the saved script, keys and finished scenes)", key=f"retry_{job['id']}"):
+            configure_model()
+            st.session_state["selected_job"] = queue.retry(job["id"])
+            st.rerun() # Chạy lại cả trang để bật polling
+
+def show_jobs(polling):
+    """
+    Bảng các job và chi tiết job được chọn. Chạy trong fragment: khi có job đang chạy, chỉ phần này
+    được làm mới mỗi JOB_POLL_SECONDS giây (form không bị chạy lại).
+    """
+    jobs = get_job_queue().list_jobs(limit=MAX_JOBS_SHOWN)
+    if not jobs:
+        return
+    if polling and not any(job["status"] in job_queue.ACTIVE_STATUSES for job in jobs):
+        st.rerun() # Job cuối cùng vừa xong: chạy lại cả trang để tắt polling
+    st.subheader("Jobs")
+    st.dataframe([{"job": job["id"], "topic": job["topic"], "minutes": job["duration_minutes"],
+                   "status": job["status"], "progress": job["progress"]} for job in jobs],
+                 use_container_width=True, hide_index=True)
+    jobs_by_id = {job["id"]: job for job in jobs}
+    if st.session_state.get("selected_job") not in jobs_by_id:
+        st.session_state["selected_job"] = jobs[0]["id"]
+    selected_job = st.selectbox("Show job:", list(jobs_by_id), key="selected_job",
+                                format_func=lambda job_id: format_job(jobs_by_id[job_id]))
+    show_job(jobs_by_id[selected_job])
 
 # --- GIAO DIỆN STREAMLIT (Đã Nâng cấp) ---
 
@@ -519,15 +253,75 @@ with st.form(key="script_form"):
                               placeholder="e.g., 'The First Fire' or 'Tribe vs Giant Eagle'")
     duration_input = st.number_input("Enter Video Duration (in minutes):", 
                                       min_value=1, max_value=60, value=10, step=1)
-    
+
+    # Cấu hình chạy song song cho Step 4
+    col_workers, col_rpm, col_tpm = st.columns(3)
+    workers_input = col_workers.number_input("Parallel JSON workers:",
+                                             min_value=1, max_value=16, value=script_pipeline.DEFAULT_JSON_WORKERS, step=1)
+    rpm_input = col_rpm.number_input("Requests per minute (RPM) per API key:",
+                                     min_value=1, max_value=2000, value=script_pipeline.DEFAULT_RPM_LIMIT, step=1)
+    tpm_input = col_tpm.number_input("Tokens per minute (TPM) per API key:",
+                                     min_value=1000, max_value=10_000_000, value=script_pipeline.DEFAULT_TPM_LIMIT, step=1000)
+    refresh_cache_input = st.checkbox("Bypass response cache (force fresh AI responses)", value=False)
+    streaming_input = st.checkbox("Streaming pipeline (keys-first: start JSON batches while the script is still arriving)",
+                                  value=False,
+                                  help="Overlaps Step 4 with the script stream; it does not make the script itself "
+                                       "faster. Consistency keys are generated from the topic before the script.")
+    # Video dài: outline rồi viết các act song song thay vì một lần gọi cho cả bảng
+    script_mode_input = st.selectbox(
+        "Script generation mode:", script_pipeline.SCRIPT_MODES,
+        format_func={"auto": f"Auto (hierarchical from {script_pipeline.HIERARCHICAL_AUTO_MIN_SCENES} scenes)",
+                     "single": "Single call", "hierarchical": "Hierarchical (outline, then acts in parallel)"}.get
+    )
+    library_input = st.checkbox("Reuse characters and locations from the series library (Step 3 only describes new ones)",
+                                value=True)
+    # Lô JSON chậm bất thường: gửi thêm một request, dùng kết quả về trước
+    hedge_mode_input = st.selectbox(
+        "Hedge slow JSON batches:", script_pipeline.HEDGE_MODES,
+        format_func={"off": "Off",
+                     "duplicate": "Duplicate the slow batch",
+                     "split": "Split the slow batch into two halves"}.get,
+        help=f"A batch running longer than the p{script_pipeline.DEFAULT_HEDGE_PERCENTILE * 100:.0f} of finished batches "
+             f"gets an extra request; at most {script_pipeline.DEFAULT_HEDGE_BUDGET:.0%} extra requests per episode."
+    )
+    # Model riêng cho từng bước: model mạnh cho kịch bản, model nhanh / rẻ cho các lô JSON
+    with st.expander("Model per step"):
+        st.caption("Leave empty to use the main model. 'primary > fallback' switches to the fallback "
+                   "while the primary is overloaded (429 / 5xx / timeouts).")
+        stage_model_inputs = {
+            route: st.text_input(label, key=f"stage_model_{route}", placeholder=placeholder)
+            for route, label, placeholder in (
+                ("script", "Script (Step 1):", "e.g. gemini-1.5-pro > gemini-1.5-flash"),
+                ("keys", "Consistency keys (Step 3):", "e.g. gemini-1.5-flash"),
+                ("json", "JSON batches (Step 4):", "e.g. gemini-1.5-flash-8b > gemini-1.5-flash"),
+            )
+        }
+    export_formats_input = st.multiselect("Export formats:", script_pipeline.available_export_formats(),
+                                          default=["xlsx"])
+    resume_input = st.checkbox("Resume previous job (reuse the saved script, keys and finished scenes for this topic and duration)",
+                               value=False)
+
     submit_button = st.form_submit_button(label="Generate Full Script & JSONs")
 
 # Xử lý khi nhấn nút
 if submit_button:
     if not topic_input:
         st.error("Please enter a Video Topic.")
-    elif not GOOGLE_API_KEY or "YOUR_NEW_API_KEY" in GOOGLE_API_KEY:
+    elif (script_pipeline.LLM_BACKEND == "gemini" and not GOOGLE_API_KEYS
+          and (not GOOGLE_API_KEY or "YOUR_NEW_API_KEY" in GOOGLE_API_KEY)):
         st.error("Please configure your GOOGLE_API_KEY in the 'Secrets' tab (lock icon).")
     else:
-        with st.spinner(f"Generating full episode for '{topic_input}'... This will take several minutes. Please wait."):
-            main_automation(topic_input, duration_input)
+        configure_model()
+        # Trả về ngay: job chạy nền, có thể đóng trang và quay lại tải kết quả sau
+        st.session_state["selected_job"] = main_automation(
+            topic_input, duration_input, max_workers=workers_input, rpm_limit=rpm_input, tpm_limit=tpm_input,
+            refresh_cache=refresh_cache_input, streaming_mode=streaming_input, resume_job=resume_input,
+            export_formats=export_formats_input, script_mode=script_mode_input, use_library=library_input,
+            hedge_mode=hedge_mode_input, stage_models=stage_model_inputs
+        )
+        st.success(f"Job {st.session_state['selected_job']} queued for '{topic_input}'. "
+                   f"Progress is shown below; results stay available after the job finishes.")
+
+# Chỉ làm mới bảng job khi còn job đang chờ / đang chạy
+has_active_jobs = any(job["status"] in job_queue.ACTIVE_STATUSES for job in get_job_queue().list_jobs())
+st.fragment(show_jobs, run_every=JOB_POLL_SECONDS if has_active_jobs else None)(has_active_jobs)
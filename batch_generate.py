@@ -0,0 +1,232 @@
+"""
+CLI chạy hàng loạt (không cần Streamlit): đọc danh sách chủ đề từ CSV / JSONL và tạo
+nhiều tập song song trên nhiều tiến trình, dùng chung một ngân sách RPM/TPM.
+Mỗi tập được ghi ra một thư mục riêng (kịch bản, keys, metadata, Excel JSON Veo 3).
+
+    python batch_generate.py topics.csv --output-dir episodes --processes 3 --rpm 60
+    python batch_generate.py topics.csv --script-model gemini-1.5-pro --json-model "gemini-1.5-flash-8b > gemini-1.5-flash"
+
+CSV cần các cột "topic" và "duration" (phút); JSONL: mỗi dòng {"topic": ..., "duration": ...}.
+Mỗi bundle có thêm run_trace.json (thời gian từng bước / lô, từng lần gọi API) để so sánh giữa các lần chạy.
+Nhân vật / địa điểm của các tập được ghi vào thư viện chung (CONSISTENCY_LIBRARY_PATH) và dùng lại ở các tập sau.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import script_pipeline
+
+DEFAULT_PROCESSES = 2
+DEFAULT_DURATION_MINUTES = 10
+
+def read_topics(path):
+    """
+    Đọc danh sách (topic, duration) từ tệp .csv hoặc .jsonl. Dòng không có topic bị bỏ qua.
+    """
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith((".jsonl", ".json")):
+            entries = [json.loads(line) for line in f if line.strip()]
+        else:
+            entries = list(csv.DictReader(f))
+
+    topics = []
+    for line_number, entry in enumerate(entries, start=1):
+        topic = (entry.get("topic") or "").strip()
+        if not topic:
+            continue
+        duration = entry.get("duration") or entry.get("duration_minutes") or DEFAULT_DURATION_MINUTES
+        try:
+            duration = int(duration)
+        except (TypeError, ValueError):
+            raise ValueError(f"{path}: entry {line_number} has an invalid duration: {duration!r}")
+        topics.append((topic, duration))
+    return topics
+
+def episode_dir_name(index, video_topic, video_duration_minutes):
+    return f"{index:03d}-{script_pipeline.slugify(video_topic)}-{video_duration_minutes}m"
+
+def write_episode_bundle(result, outputs, bundle_dir):
+    """
+    Ghi toàn bộ kết quả của một tập vào `bundle_dir`; `outputs` là kết quả của SceneExporter.finish().
+    """
+    os.makedirs(bundle_dir, exist_ok=True)
+    text_files = {
+        "script.md": result["script"],
+        "consistency_keys.md": result["keys"],
+        "video_metadata.txt": result["metadata"],
+    }
+    for filename, content in text_files.items():
+        with open(os.path.join(bundle_dir, filename), "w", encoding="utf-8") as f:
+            f.write(content)
+    with open(os.path.join(bundle_dir, "token_usage.json"), "w", encoding="utf-8") as f:
+        json.dump(result["usage"], f, indent=2)
+    with open(os.path.join(bundle_dir, "run_trace.json"), "w", encoding="utf-8") as f:
+        f.write(result["trace"].to_json(len(result["rows"]) - result["failed_scenes"]))
+    for filename, data, _ in outputs.values():
+        with open(os.path.join(bundle_dir, filename), "wb") as f:
+            f.write(data)
+
+class ConsoleReporter(script_pipeline.PipelineReporter):
+    """
+    In thông báo và tiến độ của một tập ra console, có tiền tố để phân biệt các tập chạy song song.
+    """
+    def __init__(self, prefix, verbose=False):
+        self.prefix = prefix
+        self.verbose = verbose
+
+    def log(self, level, message):
+        # Thông báo "info" (mỗi lần gọi API...) chỉ in khi --verbose
+        if level != "info" or self.verbose:
+            print(f"{self.prefix} [{level.upper()}] {message.strip()}", flush=True)
+
+    def progress(self, percent, text):
+        print(f"{self.prefix} {percent:3d}% {text}", flush=True)
+
+# --- TIẾN TRÌNH CON ---
+_worker_limiter = None
+
+def _init_worker(limiter, api_keys, model_names, backend, client_limiters):
+    # Chạy một lần trong mỗi tiến trình con: limiter dùng chung được truyền vào lúc tạo tiến trình
+    global _worker_limiter
+    _worker_limiter = limiter
+    script_pipeline.configure(api_keys, model_names, backend=backend, client_limiters=client_limiters)
+
+def run_one_episode(index, video_topic, video_duration_minutes, bundle_dir, options):
+    """
+    Tạo một tập trong tiến trình con và ghi bundle; trả về dict tóm tắt (không ném lỗi).
+    """
+    reporter = ConsoleReporter(f"[{index:03d}]", verbose=options["verbose"])
+    summary = {"index": index, "topic": video_topic, "duration_minutes": video_duration_minutes,
+               "bundle_dir": bundle_dir}
+    start_time = time.time()
+    try:
+        exporter = script_pipeline.SceneExporter(options["formats"])
+        result = script_pipeline.run_episode(
+            video_topic, video_duration_minutes, reporter=reporter, limiter=_worker_limiter,
+            max_workers=options["workers"], refresh_cache=options["refresh_cache"],
+            streaming_mode=options["streaming"], resume_job=options["resume"], exporter=exporter,
+            script_mode=options["script_mode"], use_library=options["use_library"],
+            hedge_mode=options["hedge_mode"], hedge_percentile=options["hedge_percentile"],
+            hedge_budget=options["hedge_budget"], stage_models=options["stage_models"]
+        )
+        if result is None:
+            summary["status"] = "FAILED: no usable master script"
+        else:
+            write_episode_bundle(result, exporter.finish(), bundle_dir)
+            run_summary = result["trace"].run_summary(len(result["rows"]) - result["failed_scenes"])
+            summary.update(status="OK", run_id=result["run_id"], scenes=len(result["rows"]),
+                           failed_scenes=result["failed_scenes"], scenes_per_minute=run_summary["scenes_per_minute"],
+                           p95_call_seconds=run_summary["p95_call_seconds"], retries=run_summary["retries"])
+    except Exception as e:
+        summary["status"] = f"FAILED: {e}"
+    summary["seconds"] = round(time.time() - start_time, 1)
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate PrehumanFile scripts and Veo 3 JSON prompts for a list of topics.")
+    parser.add_argument("topics_file", help="CSV (columns: topic, duration) or JSONL file of episodes")
+    parser.add_argument("--output-dir", default="episodes", help="directory for the per-episode bundles")
+    parser.add_argument("--processes", type=int, default=DEFAULT_PROCESSES, help="episodes generated in parallel")
+    parser.add_argument("--workers", type=int, default=script_pipeline.DEFAULT_JSON_WORKERS,
+                        help="parallel JSON batch workers per episode")
+    parser.add_argument("--rpm", type=int, default=script_pipeline.DEFAULT_RPM_LIMIT,
+                        help="requests per minute per API key and model, shared by all processes")
+    parser.add_argument("--tpm", type=int, default=script_pipeline.DEFAULT_TPM_LIMIT,
+                        help="tokens per minute per API key and model, shared by all processes")
+    parser.add_argument("--model", default=script_pipeline.DEFAULT_MODEL_NAME,
+                        help="model name, several comma-separated models to pool, "
+                             "or a fallback chain 'primary > fallback' used when the primary is overloaded")
+    parser.add_argument("--api-key", default=os.environ.get("GOOGLE_API_KEYS") or os.environ.get("GOOGLE_API_KEY"),
+                        help="API key, or several comma-separated keys to pool "
+                             "(defaults to GOOGLE_API_KEYS, then GOOGLE_API_KEY)")
+    parser.add_argument("--backend", choices=("gemini", "fake"), default=script_pipeline.LLM_BACKEND,
+                        help="'fake' uses the offline fake_llm backend (no API key, no quota)")
+    for route, help_text in (("script", "Step 1 script / outline / acts"), ("keys", "Step 3 consistency keys"),
+                             ("json", "Step 4 JSON batches")):
+        parser.add_argument(f"--{route}-model", default=None,
+                            help=f"model (or 'primary > fallback' chain) for {help_text}; defaults to --model")
+    parser.add_argument("--formats", default="xlsx",
+                        help=f"comma-separated export formats ({', '.join(script_pipeline.EXPORT_FORMATS)})")
+    parser.add_argument("--streaming", action="store_true", help="keys-first streaming pipeline")
+    parser.add_argument("--script-mode", choices=script_pipeline.SCRIPT_MODES, default="auto",
+                        help="'hierarchical' writes an outline, then the acts in parallel; "
+                             f"'auto' does so from {script_pipeline.HIERARCHICAL_AUTO_MIN_SCENES} scenes")
+    parser.add_argument("--no-library", action="store_true",
+                        help="do not reuse or extend the character/location library (CONSISTENCY_LIBRARY_PATH)")
+    parser.add_argument("--hedge", choices=script_pipeline.HEDGE_MODES, default="off",
+                        help="send an extra request ('duplicate' batch or 'split' into two halves) for slow JSON batches")
+    parser.add_argument("--hedge-percentile", type=float, default=script_pipeline.DEFAULT_HEDGE_PERCENTILE,
+                        help="hedge a batch once it runs longer than this percentile of finished batches")
+    parser.add_argument("--hedge-budget", type=float, default=script_pipeline.DEFAULT_HEDGE_BUDGET,
+                        help="max extra requests per episode, as a fraction of its JSON batches")
+    parser.add_argument("--refresh-cache", action="store_true", help="bypass the response cache")
+    parser.add_argument("--resume", action="store_true", help="resume each episode from its job journal")
+    parser.add_argument("--verbose", action="store_true", help="print every API call")
+    args = parser.parse_args(argv)
+
+    if args.backend == "gemini" and not args.api_key:
+        parser.error("no API key: pass --api-key or set GOOGLE_API_KEY")
+    try:
+        topics = read_topics(args.topics_file)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if not topics:
+        parser.error(f"no topics found in {args.topics_file}")
+    formats = [export_format.strip().lower() for export_format in args.formats.split(",") if export_format.strip()]
+    unavailable = [export_format for export_format in formats
+                   if export_format not in script_pipeline.available_export_formats()]
+    if not formats or unavailable:
+        parser.error(f"unsupported or unavailable export format(s): {', '.join(unavailable) or args.formats}")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    options = {"workers": args.workers, "refresh_cache": args.refresh_cache, "streaming": args.streaming,
+               "resume": args.resume, "verbose": args.verbose, "formats": formats, "script_mode": args.script_mode,
+               "use_library": not args.no_library, "hedge_mode": args.hedge, "hedge_percentile": args.hedge_percentile,
+               "hedge_budget": args.hedge_budget,
+               "stage_models": {route: getattr(args, f"{route}_model") for route in script_pipeline.STAGE_ROUTES
+                                if getattr(args, f"{route}_model")}}
+    api_keys = script_pipeline.split_config_list(args.api_key)
+    model_names = script_pipeline.split_config_list(args.model)
+    # Mỗi phần tử của chuỗi fallback ("a,b > c") là một pool riêng: mỗi cặp (key, model) của nó
+    # một bucket dùng chung cho mọi tiến trình
+    link_sizes = [len(api_keys) * len(script_pipeline.split_config_list(link)) if args.backend == "gemini" else 1
+                  for link in args.model.split(">")]
+    client_limiters = [[script_pipeline.SharedTokenBucketLimiter(args.rpm, args.tpm) for _ in range(size)]
+                       if size > 1 else None for size in link_sizes]
+    if len(client_limiters) == 1:
+        client_limiters = client_limiters[0]
+    # Bucket tổng tính theo các model ưu tiên (phần trước dấu ">")
+    pool_size = link_sizes[0]
+    limiter = script_pipeline.SharedTokenBucketLimiter(args.rpm * pool_size, args.tpm * pool_size)
+    print(f"Generating {len(topics)} episodes with {args.processes} processes "
+          f"(shared budget: {args.rpm * pool_size} RPM / {args.tpm * pool_size} TPM"
+          f"{f' over {pool_size} key/model clients' if pool_size > 1 else ''})...", flush=True)
+
+    summaries = []
+    with ProcessPoolExecutor(max_workers=max(1, args.processes), initializer=_init_worker,
+                             initargs=(limiter, api_keys, model_names, args.backend, client_limiters)) as pool:
+        futures = [
+            pool.submit(run_one_episode, index, video_topic, video_duration_minutes,
+                        os.path.join(args.output_dir, episode_dir_name(index, video_topic, video_duration_minutes)),
+                        options)
+            for index, (video_topic, video_duration_minutes) in enumerate(topics, start=1)
+        ]
+        for future in as_completed(futures):
+            summary = future.result()
+            summaries.append(summary)
+            print(f"[{summary['index']:03d}] {summary['status']} - {summary['topic']} "
+                  f"({summary['seconds']}s) -> {summary['bundle_dir']}", flush=True)
+
+    summaries.sort(key=lambda summary: summary["index"])
+    with open(os.path.join(args.output_dir, "batch_summary.json"), "w", encoding="utf-8") as f:
+        json.dump(summaries, f, ensure_ascii=False, indent=2)
+
+    failed = [summary for summary in summaries if summary["status"] != "OK"]
+    print(f"Done: {len(summaries) - len(failed)}/{len(summaries)} episodes generated.", flush=True)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""
+Benchmark ClientPool trên backend giả lập có quota riêng cho từng "key" (fake_llm quota_requests):
+một key so với pool nhiều key, và pool có một key bị dùng chung ở nơi khác (hết quota sớm, trả 429).
+In wall time, số lần gọi, số lỗi 429, số cảnh lỗi và số request mỗi client đã phục vụ.
+
+    python benchmarks/bench_client_pool.py [--minutes 30] [--keys 3] [--rpm 15]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# Cache, journal và thư viện consistency của benchmark nằm trong thư mục tạm (phải đặt trước khi import pipeline)
+_work_dir = tempfile.mkdtemp(prefix="bench_client_pool_")
+os.environ["GEMINI_CACHE_DIR"] = os.path.join(_work_dir, "cache")
+os.environ["JOB_JOURNAL_DIR"] = os.path.join(_work_dir, "journal")
+os.environ["CONSISTENCY_LIBRARY_PATH"] = os.path.join(_work_dir, "consistency_library.jsonl")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fake_llm
+import script_pipeline
+
+class QuietReporter(script_pipeline.PipelineReporter):
+    # Chỉ in lỗi
+    def log(self, level, message):
+        if level == "error":
+            print(f"    [{level.upper()}] {message.strip()}", flush=True)
+
+def fake_key(args, quota_requests):
+    # Quota phía server: cửa sổ trượt 60s; bucket phía client (RPM, bắt đầu đầy) có thể gửi tới 2x RPM trong 60s đầu
+    return fake_llm.FakeGenerativeModel(seed=args.seed, latency=("lognormal", args.latency, 0.35),
+                                        quota_requests=quota_requests)
+
+def run_scenario(name, backend, args):
+    script_pipeline.configure(backend=backend)
+    start_time = time.perf_counter()
+    result = script_pipeline.run_episode(f"Client pool {name}", args.minutes, reporter=QuietReporter(),
+                                         max_workers=args.workers, rpm_limit=args.rpm, refresh_cache=True,
+                                         use_library=False)
+    wall_seconds = time.perf_counter() - start_time
+    fake_models = [client.model for client in backend.clients] if isinstance(backend, script_pipeline.ClientPool) else [backend]
+    print(f"{name:<28} {wall_seconds:>8.1f} {sum(m.calls for m in fake_models):>6} "
+          f"{sum(m.stats['quota_exceeded'] for m in fake_models):>5} "
+          f"{result['failed_scenes'] if result else 'n/a':>7}", flush=True)
+    if isinstance(backend, script_pipeline.ClientPool):
+        for client_stats in backend.stats():
+            print(f"    {client_stats['client']:<24} calls={client_stats['calls']} "
+                  f"quota_errors={client_stats['quota_errors']}", flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--minutes", type=int, default=30, help="video duration of the benchmark episode")
+    parser.add_argument("--keys", type=int, default=3, help="API keys in the pool")
+    parser.add_argument("--rpm", type=int, default=15, help="declared requests per minute of each key")
+    parser.add_argument("--workers", type=int, default=script_pipeline.DEFAULT_JSON_WORKERS)
+    parser.add_argument("--latency", type=float, default=0.3, help="median fake call latency (seconds)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'scenario':<28} {'wall s':>8} {'calls':>6} {'429s':>5} {'failed':>7}")
+    run_scenario("1 key", fake_key(args, 2 * args.rpm), args)
+    run_scenario(f"{args.keys} keys", script_pipeline.ClientPool.from_models(
+        [fake_key(args, 2 * args.rpm) for _ in range(args.keys)], rpm_limit=args.rpm), args)
+    # Key thứ hai đã bị dùng gần hết quota ở nơi khác: chỉ còn 3 request trong cửa sổ 60s
+    run_scenario(f"{args.keys} keys, 1 exhausted", script_pipeline.ClientPool.from_models(
+        [fake_key(args, 3 if index == 1 else 2 * args.rpm) for index in range(args.keys)], rpm_limit=args.rpm), args)
+
+if __name__ == "__main__":
+    main()
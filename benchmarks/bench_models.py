@@ -0,0 +1,214 @@
+"""
+So sánh model cho từng bước của pipeline: chạy lại một bộ chủ đề cố định, mỗi lần chỉ đổi model của
+một route (script / keys / json, xem script_pipeline.STAGE_ROUTES), các route khác giữ model baseline.
+In latency (thời gian bước, p50/p95 từng lần gọi), token, độ chính xác số cảnh, độ phủ consistency keys và
+tỷ lệ object JSON hợp lệ ngay lần gọi đầu; với mỗi route chọn model nhanh nhất vượt qua mọi ngưỡng.
+
+    python benchmarks/bench_models.py                                   # backend giả lập (fake_llm.FAKE_MODEL_PROFILES)
+    python benchmarks/bench_models.py --json-models gemini-1.5-flash,gemini-1.5-flash-8b --routes json
+    python benchmarks/bench_models.py --backend gemini --topics topics.csv --baseline-model gemini-1.5-pro
+    python benchmarks/bench_models.py --json results.json
+
+Backend "gemini" gọi API thật (tốn quota; key từ --api-key / GOOGLE_API_KEYS / GOOGLE_API_KEY).
+Exit 1 nếu có route không model nào vượt qua ngưỡng.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+# Cache, journal và thư viện consistency của benchmark nằm trong thư mục tạm (phải đặt trước khi import pipeline)
+_work_dir = tempfile.mkdtemp(prefix="bench_models_")
+os.environ["GEMINI_CACHE_DIR"] = os.path.join(_work_dir, "cache")
+os.environ["JOB_JOURNAL_DIR"] = os.path.join(_work_dir, "journal")
+os.environ["CONSISTENCY_LIBRARY_PATH"] = os.path.join(_work_dir, "consistency_library.jsonl")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import script_pipeline
+from batch_generate import read_topics
+
+# Bộ chủ đề cố định: cùng prompt giữa các lần chạy, đủ nhiều cảnh để có vài lô Step 4
+DEFAULT_TOPICS = (
+    ("The First Fire", 3),
+    ("Tribe vs Giant Eagle", 2),
+    ("Crossing the Frozen River", 4),
+    ("The Last Mammoth Hunt", 3),
+)
+DEFAULT_CANDIDATES = "gemini-1.5-pro,gemini-1.5-flash,gemini-1.5-flash-8b"
+# Span của run_episode cho thời gian từng route
+ROUTE_SPANS = {"script": "step1_script", "keys": "step3_keys", "json": "step4_json"}
+
+class QuietReporter(script_pipeline.PipelineReporter):
+    # Chỉ in lỗi
+    def log(self, level, message):
+        if level == "error":
+            print(f"    [{level.upper()}] {message.strip()}", flush=True)
+
+def episode_metrics(route, result, video_duration_minutes):
+    """
+    Số liệu của một tập cho `route`: thời gian bước, latency / token các lần gọi của route, và các chỉ số chất lượng.
+    """
+    summary = result["trace"].run_summary(len(result["rows"]) - result["failed_scenes"])
+    stages = script_pipeline.STAGE_ROUTES[route]
+    calls = [entry for entry in result["trace"].calls if entry["stage"] in stages and not entry.get("cache_hit")]
+
+    expected_scenes = -(-video_duration_minutes * 60 // script_pipeline.SCENE_DURATION_SECONDS)
+    parsed_scenes = len(result["rows"])
+    entries = script_pipeline.parse_consistency_entries(result["keys"] if result["keys"] != "None" else "")
+    descriptions = [scene.get("description", "") for scene in script_pipeline.index_script(result["script"]).rows]
+    covered = sum(1 for description in descriptions if script_pipeline.scene_is_covered(description, entries))
+    json_calls = [entry for entry in result["trace"].calls if entry["stage"] == "step4_json" and "scenes_requested" in entry]
+    return {
+        "stage_seconds": summary["stage_seconds"].get(ROUTE_SPANS[route], 0.0),
+        "call_seconds": [entry.get("wall_seconds", 0.0) for entry in calls],
+        "tokens": sum(entry["prompt_tokens"] + entry["response_tokens"] for entry in calls),
+        "scene_count_ok": parsed_scenes == expected_scenes,
+        "keys_entries": len(entries),
+        "keys_coverage": covered / len(descriptions) if descriptions else 0.0,
+        # Object hợp lệ ngay lần gọi đầu / số cảnh gửi đi (không tính retry / bisect cứu lại)
+        "json_requested": sum(entry["scenes_requested"] for entry in json_calls),
+        "json_valid": sum(entry.get("objects_parsed", 0) - entry.get("objects_invalid", 0) for entry in json_calls),
+        "failed_scenes": result["failed_scenes"],
+    }
+
+def run_candidate(route, candidate, topics, args):
+    """
+    Chạy mọi chủ đề với `candidate` cho `route` (route khác dùng model baseline); trả về dict tổng hợp.
+    """
+    episodes = []
+    for video_topic, video_duration_minutes in topics:
+        result = script_pipeline.run_episode(
+            video_topic, video_duration_minutes, reporter=QuietReporter(), max_workers=args.workers,
+            rpm_limit=args.rpm, tpm_limit=args.tpm, refresh_cache=True, script_mode=args.script_mode,
+            use_library=False, stage_models={route: candidate}
+        )
+        if result is None:
+            episodes.append(None)
+            continue
+        episodes.append(episode_metrics(route, result, video_duration_minutes))
+
+    finished = [episode for episode in episodes if episode is not None]
+    call_seconds = [seconds for episode in finished for seconds in episode["call_seconds"]]
+    json_requested = sum(episode["json_requested"] for episode in finished)
+    entry = {
+        "route": route,
+        "model": candidate,
+        "episodes": len(episodes),
+        "episodes_failed": len(episodes) - len(finished),
+        "median_stage_seconds": round(statistics.median(episode["stage_seconds"] for episode in finished), 3) if finished else None,
+        "p50_call_seconds": script_pipeline.percentile(call_seconds, 0.5),
+        "p95_call_seconds": script_pipeline.percentile(call_seconds, 0.95),
+        "tokens_per_episode": round(sum(episode["tokens"] for episode in finished) / len(finished)) if finished else 0,
+        # Tỷ lệ tập có đúng số cảnh được yêu cầu
+        "scene_accuracy": round(sum(episode["scene_count_ok"] for episode in finished) / len(finished), 3) if finished else 0.0,
+        "keys_coverage": round(statistics.mean(episode["keys_coverage"] for episode in finished), 3) if finished else 0.0,
+        "keys_missing": sum(1 for episode in finished if not episode["keys_entries"]),
+        "json_validity": round(sum(episode["json_valid"] for episode in finished) / json_requested, 3) if json_requested else 0.0,
+        "failed_scenes": sum(episode["failed_scenes"] for episode in finished),
+    }
+    entry["problems"] = check_candidate(entry, args)
+    return entry
+
+def check_candidate(entry, args):
+    """
+    Các ngưỡng chất lượng không đạt (rỗng = đạt).
+    """
+    problems = []
+    if entry["episodes_failed"]:
+        problems.append(f"{entry['episodes_failed']} episodes without a script")
+    if entry["scene_accuracy"] < args.min_scene_accuracy:
+        problems.append(f"scene accuracy {entry['scene_accuracy']:.1%} < {args.min_scene_accuracy:.0%}")
+    if entry["keys_missing"] or entry["keys_coverage"] < args.min_keys_coverage:
+        problems.append(f"keys coverage {entry['keys_coverage']:.1%} < {args.min_keys_coverage:.0%}"
+                        + (f" ({entry['keys_missing']} episodes without keys)" if entry["keys_missing"] else ""))
+    if entry["json_validity"] < args.min_json_validity:
+        problems.append(f"JSON validity {entry['json_validity']:.1%} < {args.min_json_validity:.0%}")
+    if entry["failed_scenes"] > args.max_failed_scenes:
+        problems.append(f"{entry['failed_scenes']} failed scenes")
+    return problems
+
+def pick_fastest(results):
+    """
+    Route -> model nhanh nhất (thời gian bước trung vị, rồi p95 từng lần gọi) trong các model đạt mọi ngưỡng.
+    """
+    picks = {}
+    for entry in results:
+        if entry["problems"]:
+            continue
+        best = picks.get(entry["route"])
+        rank = (entry["median_stage_seconds"], entry["p95_call_seconds"] or 0.0)
+        if best is None or rank < (best["median_stage_seconds"], best["p95_call_seconds"] or 0.0):
+            picks[entry["route"]] = entry
+    return picks
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--backend", choices=("fake", "gemini"), default="fake",
+                        help="'fake' simulates the models in fake_llm.FAKE_MODEL_PROFILES (no API key, no quota)")
+    parser.add_argument("--api-key", default=os.environ.get("GOOGLE_API_KEYS") or os.environ.get("GOOGLE_API_KEY"))
+    parser.add_argument("--topics", help="CSV / JSONL file of episodes (as batch_generate); defaults to a built-in set")
+    parser.add_argument("--routes", default=",".join(script_pipeline.STAGE_ROUTES),
+                        help=f"comma-separated routes to compare: {', '.join(script_pipeline.STAGE_ROUTES)}")
+    parser.add_argument("--baseline-model", default="gemini-1.5-pro", help="model for the routes not being compared")
+    for route in script_pipeline.STAGE_ROUTES:
+        parser.add_argument(f"--{route}-models", default=DEFAULT_CANDIDATES,
+                            help=f"comma-separated candidates for the '{route}' route ('a > b' chains allowed)")
+    parser.add_argument("--script-mode", choices=script_pipeline.SCRIPT_MODES, default="single",
+                        help="Step 1 mode ('single' measures the model's own scene count; hierarchical pads missing rows)")
+    parser.add_argument("--min-scene-accuracy", type=float, default=1.0,
+                        help="fraction of episodes whose scene table has exactly the requested scene count")
+    parser.add_argument("--min-keys-coverage", type=float, default=0.8, help="fraction of scenes naming a defined key")
+    parser.add_argument("--min-json-validity", type=float, default=0.98,
+                        help="fraction of JSON objects valid on the first call (before retries)")
+    parser.add_argument("--max-failed-scenes", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=script_pipeline.DEFAULT_JSON_WORKERS)
+    parser.add_argument("--rpm", type=int, default=1000, help="rate limit (high by default: measure the models, not the quota)")
+    parser.add_argument("--tpm", type=int, default=10_000_000)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    routes = [route.strip() for route in args.routes.split(",") if route.strip()]
+    unknown = [route for route in routes if route not in script_pipeline.STAGE_ROUTES]
+    if unknown:
+        parser.error(f"unknown route(s): {', '.join(unknown)}")
+    if args.backend == "gemini" and not args.api_key:
+        parser.error("no API key: pass --api-key or set GOOGLE_API_KEY")
+    try:
+        topics = read_topics(args.topics) if args.topics else list(DEFAULT_TOPICS)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    script_pipeline.configure(args.api_key, args.baseline_model, backend=args.backend)
+
+    results = []
+    start_time = time.perf_counter()
+    print(f"{len(topics)} topics, baseline model {args.baseline_model}, backend {args.backend}")
+    print(f"{'route':<7} {'model':<40} {'step s':>7} {'p50 s':>6} {'p95 s':>6} {'tokens':>8} "
+          f"{'scenes':>7} {'keys':>6} {'json':>6} {'failed':>6}  result")
+    for route in routes:
+        for candidate in script_pipeline.split_config_list(getattr(args, f"{route}_models")):
+            entry = run_candidate(route, candidate, topics, args)
+            results.append(entry)
+            print(f"{route:<7} {candidate:<40} {entry['median_stage_seconds'] or 0:>7.2f} "
+                  f"{entry['p50_call_seconds'] or 0:>6.2f} {entry['p95_call_seconds'] or 0:>6.2f} "
+                  f"{entry['tokens_per_episode']:>8} {entry['scene_accuracy']:>7.1%} {entry['keys_coverage']:>6.1%} "
+                  f"{entry['json_validity']:>6.1%} {entry['failed_scenes']:>6}  "
+                  f"{'; '.join(entry['problems']) or 'pass'}", flush=True)
+
+    picks = pick_fastest(results)
+    print(f"\nCompared in {time.perf_counter() - start_time:.0f}s. Fastest model passing all checks:")
+    for route in routes:
+        print(f"  {route:<7} {picks[route]['model'] if route in picks else 'none (no candidate passed)'}")
+    if picks:
+        print("  flags: " + " ".join(f'--{route}-model "{entry["model"]}"' for route, entry in picks.items()))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"results": results, "recommended": {route: entry["model"] for route, entry in picks.items()}},
+                      f, indent=2)
+    return 0 if all(route in picks for route in routes) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
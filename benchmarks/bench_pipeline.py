@@ -0,0 +1,202 @@
+"""
+Benchmark end-to-end: chạy toàn bộ pipeline (Step 1-5) trên backend giả lập fake_llm cho các
+thời lượng 1 / 10 / 30 / 60 phút. In wall time, số lần gọi API, số cảnh lấy được và bộ nhớ đỉnh,
+để thấy regression trước khi deploy. Không cần API key, không tốn quota.
+
+    python benchmarks/bench_pipeline.py [--durations 1,10,30,60] [--profile clean,faulty] [--streaming]
+    python benchmarks/bench_pipeline.py --durations 60 --script-mode single,hierarchical --seconds-per-token 0.002
+    python benchmarks/bench_pipeline.py --profile faulty [--plain-json]   # có / không có structured output
+    python benchmarks/bench_pipeline.py --profile stragglers --durations 30 --hedge off,duplicate,split
+    python benchmarks/bench_pipeline.py --json results.json
+    python benchmarks/bench_pipeline.py --library   # Step 3 qua consistency library (mỗi case một thư viện mới)
+    python benchmarks/bench_pipeline.py --baseline results.json --tolerance 0.25   # exit 1 nếu chậm hơn / tốn hơn
+
+Profile "faulty" có lỗi 429 / 503, phản hồi bị cắt và JSON hỏng để đo cả đường retry / bisect;
+kích thước lô thích ứng phụ thuộc thứ tự các lô xong nên kết quả profile này dao động nhẹ giữa các lần chạy.
+Profile "stragglers" có một số lần gọi chậm gấp nhiều lần (đuôi latency) để đo hedged requests.
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Cache, journal và thư viện consistency của benchmark nằm trong thư mục tạm (phải đặt trước khi import pipeline)
+_work_dir = tempfile.mkdtemp(prefix="bench_pipeline_")
+os.environ["GEMINI_CACHE_DIR"] = os.path.join(_work_dir, "cache")
+os.environ["JOB_JOURNAL_DIR"] = os.path.join(_work_dir, "journal")
+os.environ["CONSISTENCY_LIBRARY_PATH"] = os.path.join(_work_dir, "consistency_library.jsonl")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fake_llm
+import script_pipeline
+
+PROFILES = {
+    "clean": {},
+    "faulty": {"rate_limit_rate": 0.05, "server_error_rate": 0.03, "truncation_rate": 0.1, "malformed_rate": 0.1},
+    # API sập sau vài lần gọi: circuit breaker phải làm các lô lỗi ngay thay vì chờ từng lô
+    "outage": {"outage_after_calls": 4},
+    # Vài lô chậm gấp 6 lần trung vị: thời gian của tập do lô chậm nhất quyết định
+    "stragglers": {"straggler_rate": 0.08},
+}
+_library_ids = itertools.count(1)
+# Các chỉ số được so với baseline (càng nhỏ càng tốt)
+REGRESSION_METRICS = ("wall_seconds", "api_calls", "peak_memory_mb")
+
+class QuietReporter(script_pipeline.PipelineReporter):
+    # Chỉ in cảnh báo / lỗi
+    def log(self, level, message):
+        if level in ("warning", "error"):
+            print(f"    [{level.upper()}] {message.strip()}", flush=True)
+
+def run_case(duration, profile, args, script_mode="auto", hedge_mode="off"):
+    """
+    Một lần chạy pipeline đầy đủ (kể cả xuất xlsx) trên FakeGenerativeModel mới; trả về dict kết quả.
+    """
+    fake_model = fake_llm.FakeGenerativeModel(seed=args.seed, latency=("lognormal", args.latency, 0.35),
+                                              seconds_per_output_token=args.seconds_per_token,
+                                              structured_output=not args.plain_json, **PROFILES[profile])
+    script_pipeline.configure(backend=fake_model)
+    if args.library:
+        # Thư viện mới cho mỗi case: case sau không dùng lại nhân vật của case trước (kết quả không phụ thuộc thứ tự)
+        library_path = os.path.join(_work_dir, f"consistency_library_{next(_library_ids)}.jsonl")
+        script_pipeline.consistency_library = script_pipeline.ConsistencyLibrary(library_path)
+    # Chủ đề cố định -> cùng prompt, cùng độ trễ / lỗi giả lập giữa các lần chạy (journal được ghi mới)
+    topic = f"Benchmark {profile} {duration}m"
+
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    exporter = script_pipeline.SceneExporter(("xlsx",))
+    result = script_pipeline.run_episode(
+        topic, duration, reporter=QuietReporter(), max_workers=args.workers, rpm_limit=args.rpm,
+        tpm_limit=args.tpm, refresh_cache=True, streaming_mode=args.streaming, exporter=exporter,
+        script_mode=script_mode, hedge_mode=hedge_mode, hedge_percentile=args.hedge_percentile,
+        hedge_budget=args.hedge_budget, use_library=args.library
+    )
+    if result is not None:
+        exporter.finish()
+    wall_seconds = time.perf_counter() - start_time
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    total_scenes = -(-duration * 60 // script_pipeline.SCENE_DURATION_SECONDS)
+    scenes_ok = len(result["rows"]) - result["failed_scenes"] if result else 0
+    summary = result["trace"].run_summary(scenes_ok) if result else {}
+    return {
+        "profile": profile,
+        "duration_minutes": duration,
+        "streaming": args.streaming,
+        "script_mode": script_mode,
+        "structured_output": not args.plain_json,
+        "hedge_mode": hedge_mode,
+        "wall_seconds": round(wall_seconds, 2),
+        "api_calls": fake_model.calls,
+        "scenes_recovered": scenes_ok,
+        "scenes_expected": total_scenes,
+        "peak_memory_mb": round(peak_bytes / 2 ** 20, 1),
+        "retries": summary.get("retries", 0),
+        "p95_call_seconds": summary.get("p95_call_seconds"),
+        "step1_seconds": summary.get("stage_seconds", {}).get("step1_script"),
+        "step4_seconds": summary.get("stage_seconds", {}).get("step4_json"),
+        "hedging": summary.get("hedging"),
+        "injected": {key: value for key, value in fake_model.stats.items() if key != "calls"},
+    }
+
+def find_regressions(results, baseline, tolerance):
+    """
+    So với kết quả baseline cùng (profile, duration, streaming, script mode): chậm / tốn hơn quá `tolerance`,
+    hoặc lấy được ít cảnh hơn.
+    """
+    case_key = lambda entry: (entry["profile"], entry["duration_minutes"], entry["streaming"],
+                              entry.get("script_mode", "auto"), entry.get("structured_output", True),
+                              entry.get("hedge_mode", "off"))
+    baseline_by_case = {case_key(entry): entry for entry in baseline}
+    regressions = []
+    for entry in results:
+        reference = baseline_by_case.get(case_key(entry))
+        if reference is None:
+            continue
+        case = f"{entry['profile']} {entry['duration_minutes']}m {entry['script_mode']} hedge={entry['hedge_mode']}"
+        for metric in REGRESSION_METRICS:
+            if entry[metric] > reference[metric] * (1 + tolerance):
+                regressions.append(f"{case}: {metric} {reference[metric]} -> {entry[metric]}")
+        if entry["scenes_recovered"] < reference["scenes_recovered"]:
+            regressions.append(f"{case}: scenes_recovered {reference['scenes_recovered']} -> {entry['scenes_recovered']}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--durations", default="1,10,30,60", help="comma-separated video durations (minutes)")
+    parser.add_argument("--profile", default="clean,faulty,outage", help=f"comma-separated: {', '.join(PROFILES)}")
+    parser.add_argument("--streaming", action="store_true", help="keys-first streaming pipeline")
+    parser.add_argument("--script-mode", default="auto",
+                        help=f"comma-separated Step 1 modes to compare: {', '.join(script_pipeline.SCRIPT_MODES)}")
+    parser.add_argument("--plain-json", action="store_true",
+                        help="no structured output (response schema): JSON requested by prompt text only")
+    parser.add_argument("--hedge", default="off",
+                        help=f"comma-separated Step 4 hedge modes to compare: {', '.join(script_pipeline.HEDGE_MODES)}")
+    parser.add_argument("--hedge-percentile", type=float, default=script_pipeline.DEFAULT_HEDGE_PERCENTILE)
+    parser.add_argument("--hedge-budget", type=float, default=script_pipeline.DEFAULT_HEDGE_BUDGET,
+                        help="max extra requests as a fraction of the batches")
+    parser.add_argument("--library", action="store_true",
+                        help="resolve Step 3 through a fresh consistency library per case (default: plain Step 3 call)")
+    parser.add_argument("--workers", type=int, default=script_pipeline.DEFAULT_JSON_WORKERS)
+    parser.add_argument("--rpm", type=int, default=1000, help="rate limit (high by default: measure the pipeline, not the quota)")
+    parser.add_argument("--tpm", type=int, default=10_000_000)
+    parser.add_argument("--latency", type=float, default=0.3, help="median fake call latency (seconds)")
+    parser.add_argument("--seconds-per-token", type=float, default=0.0, help="extra fake latency per output token")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results file of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression (0.25 = +25%%)")
+    args = parser.parse_args()
+
+    durations = [int(duration) for duration in args.durations.split(",")]
+    profiles = [profile.strip() for profile in args.profile.split(",")]
+    unknown = [profile for profile in profiles if profile not in PROFILES]
+    if unknown:
+        parser.error(f"unknown profile(s): {', '.join(unknown)}")
+    script_modes = [script_mode.strip() for script_mode in args.script_mode.split(",")]
+    if any(script_mode not in script_pipeline.SCRIPT_MODES for script_mode in script_modes):
+        parser.error(f"unknown script mode(s): {args.script_mode}")
+    hedge_modes = [hedge_mode.strip() for hedge_mode in args.hedge.split(",")]
+    if any(hedge_mode not in script_pipeline.HEDGE_MODES for hedge_mode in hedge_modes):
+        parser.error(f"unknown hedge mode(s): {args.hedge}")
+
+    # Chạy khởi động (không tính): import lười (openpyxl...) không bị tính vào bộ nhớ đỉnh của case đầu
+    run_case(1, "clean", args)
+
+    results = []
+    print(f"{'profile':<10} {'min':>4} {'mode':<12} {'hedge':<9} {'wall s':>8} {'step1 s':>8} {'step4 s':>8} "
+          f"{'calls':>6} {'scenes':>9} {'peak MB':>8} {'retries':>7} {'hedges':>7} {'won':>4} {'saved≥s':>8}")
+    for profile in profiles:
+        for duration in durations:
+            for script_mode in script_modes:
+                for hedge_mode in hedge_modes:
+                    entry = run_case(duration, profile, args, script_mode, hedge_mode)
+                    results.append(entry)
+                    hedging = entry["hedging"] or {}
+                    print(f"{profile:<10} {duration:>4} {script_mode:<12} {hedge_mode:<9} {entry['wall_seconds']:>8.2f} "
+                          f"{entry['step1_seconds'] or 0:>8.2f} {entry['step4_seconds'] or 0:>8.2f} {entry['api_calls']:>6} "
+                          f"{entry['scenes_recovered']:>4}/{entry['scenes_expected']:<4} {entry['peak_memory_mb']:>8.1f} "
+                          f"{entry['retries']:>7} {hedging.get('hedged_batches', 0):>7} {hedging.get('hedges_won', 0):>4} "
+                          f"{hedging.get('seconds_saved', 0):>8.1f}", flush=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print(f"No regressions vs {args.baseline} (tolerance {args.tolerance:.0%}).")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
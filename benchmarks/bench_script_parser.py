@@ -0,0 +1,136 @@
+"""
+Micro-benchmark: phân tích kịch bản tổng hợp 450 cảnh (60 phút) bằng ScriptIndexer một lượt
+so với cách cũ (5 lần re.search + regex trên từng dòng của bảng).
+
+    python benchmarks/bench_script_parser.py [--scenes 450] [--repeat 50]
+"""
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import script_pipeline
+
+def build_synthetic_script(num_scenes):
+    """
+    Kịch bản giả có đủ các section như prompt Step 1 yêu cầu.
+    """
+    rows = "\n".join(
+        f"| {i * 8 // 60:02d}:{i * 8 % 60:02d} | Scene {i + 1}: the hunters cross the frozen river while the elder "
+        f"watches the storm gather over the ridge | Wide tracking shot | Wind, cracking ice | Tension |"
+        for i in range(num_scenes)
+    )
+    return f"""# Title
+The First Fire
+
+# Description
+{"A tribe of early humans learns to tame fire. " * 20}
+
+# Hashtags
+#prehistoric #prehumanfile #survival #stoneage #ancienthumans
+
+# Era Definition
+Era: Late Pleistocene, ~40,000 years ago. Species: Homo neanderthalensis.
+
+# Script (table format)
+| Timecode | Scene Description | Camera Angle | Sound/Ambience | Emotion |
+|---|---|---|---|---|
+{rows}
+
+# Thumbnail Prompts
+1. A lone hunter holding a torch against a blizzard.
+2. Close-up of sparks falling on dry moss.
+
+# Keywords
+prehistoric, fire, survival, neanderthal
+
+# CTA
+Subscribe for more PrehumanFile stories.
+"""
+
+# --- CÁCH CŨ (trước khi có ScriptIndexer), giữ lại để so sánh ---
+def legacy_parse_markdown_table(markdown_text):
+    scenes = []
+    table_regex = re.compile(r"\|\s*(.*?)\s*\|\s*(.*?)\s*\|\s*(.*?)\s*\|\s*(.*?)\s*\|\s*(.*?)\s*\|")
+    table_found = False
+    for line in markdown_text.split('\n'):
+        line = line.strip()
+        if "Timecode" in line and "Scene Description" in line:
+            table_found = True
+            continue
+        if "---" in line and table_found:
+            continue
+        if table_found and line.startswith('|'):
+            match = table_regex.match(line)
+            if match:
+                groups = match.groups()
+                scenes.append(dict(zip(script_pipeline.TABLE_FIELDS, groups)))
+    return scenes
+
+def legacy_parse_script_sections(markdown_text):
+    data = {}
+    patterns = {
+        'title': r"#\s*Title\s*\n(.*?)\n",
+        'description': r"#\s*Description\s*\n(.*?)\n#",
+        'hashtags': r"#\s*Hashtags\s*\n(.*?)\n#",
+        'thumbnail_prompts': r"#\s*Thumbnail Prompts\s*\n(.*?)\n#",
+        'keywords': r"#\s*Keywords\s*\n(.*?)\n#",
+    }
+    for key, pattern in patterns.items():
+        match = re.search(pattern, markdown_text, re.DOTALL | re.IGNORECASE)
+        data[key] = match.group(1).strip() if match else None
+    return data
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenes", type=int, default=450)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    script = build_synthetic_script(args.scenes)
+    # Hai cách phải cho cùng kết quả trên kịch bản chuẩn
+    new_rows = script_pipeline.parse_markdown_table(script)
+    assert new_rows == legacy_parse_markdown_table(script), "table rows differ"
+    assert len(new_rows) == args.scenes
+    new_sections = script_pipeline.parse_script_sections(script)
+    for key, value in legacy_parse_script_sections(script).items():
+        assert new_sections[key] == value, f"section {key!r} differs"
+
+    def legacy():
+        legacy_parse_markdown_table(script)
+        legacy_parse_script_sections(script)
+
+    def single_pass():
+        indexer = script_pipeline.index_script(script)
+        script_pipeline.parse_script_sections(script, indexer)
+
+    def streamed(chunk_size):
+        # Như chế độ streaming: các đoạn `chunk_size` ký tự (fake_llm: 200, API thật: thường vài trăm)
+        # Các đoạn được tạo trước: chi phí cắt đoạn thuộc về stream, không thuộc về parser
+        chunks = [script[i:i + chunk_size] for i in range(0, len(script), chunk_size)]
+        def run():
+            indexer = script_pipeline.ScriptIndexer()
+            for _ in script_pipeline.iter_markdown_table_rows(chunks, indexer):
+                pass
+            script_pipeline.parse_script_sections(script, indexer)
+            return indexer
+        return run
+
+    streamed_index = streamed(40)()
+    assert streamed_index.rows == new_rows, "streamed table rows differ"
+
+    print(f"Synthetic script: {args.scenes} scenes, {len(script):,} characters, {args.repeat} runs each")
+    baseline = None
+    # Chế độ streaming không nhằm parse nhanh hơn: lợi ích là Step 4 bắt đầu khi kịch bản còn đang về.
+    # Chỉ cần chi phí parse theo đoạn không vượt cách cũ (các đoạn được gom tới STREAM_PARSE_MIN_CHARS).
+    for name, func in (("legacy regex scans", legacy), ("single-pass indexer", single_pass),
+                       ("single-pass, 40-char stream chunks", streamed(40)),
+                       ("single-pass, 200-char stream chunks", streamed(200))):
+        best = min(timeit.repeat(func, number=args.repeat, repeat=5)) / args.repeat
+        baseline = baseline or best
+        print(f"  {name:<36} {best * 1000:8.3f} ms/run  ({baseline / best:.2f}x vs legacy)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Đo thời gian khởi động và chạy lại của app Streamlit bằng streamlit.testing (AppTest, không cần trình duyệt):
+import script_pipeline trong một tiến trình mới, lần chạy đầu của app, các lần chạy lại khi chưa có
+kết quả, thời gian submit (job chạy nền nên phải trả về ngay), các lần chạy lại khi job đang chạy
+và sau khi job đã xong (backend giả lập fake_llm, không gọi API thật).
+
+    python benchmarks/bench_streamlit_rerun.py [--app automate_script_web_clean.py] [--reruns 20]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("google.generativeai", "pandas", "openpyxl")
+
+def cold_import_seconds(app_dir, repeat):
+    """
+    Thời gian import script_pipeline trong tiến trình Python mới (trung vị) và các module nặng đã bị import theo.
+    """
+    code = ("import sys, time; t = time.perf_counter(); import script_pipeline; "
+            "print(time.perf_counter() - t); print(','.join(m for m in %r if m in sys.modules))" % (HEAVY_MODULES,))
+    timings, heavy = [], ""
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-W", "ignore", "-c", code], cwd=app_dir, capture_output=True,
+                                text=True, check=True).stdout.splitlines()
+        timings.append(float(output[0]))
+        heavy = output[1] if len(output) > 1 else ""
+    return statistics.median(timings), heavy or "none"
+
+def job_status(jobs_dir):
+    # Trạng thái của job duy nhất mà benchmark đã submit
+    for job_id in os.listdir(jobs_dir):
+        with open(os.path.join(jobs_dir, job_id, "job.json"), "r", encoding="utf-8") as f:
+            return json.load(f)["status"]
+
+def timed_runs(app, count):
+    timings = []
+    for _ in range(count):
+        start_time = time.perf_counter()
+        app.run()
+        timings.append(time.perf_counter() - start_time)
+    return statistics.median(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--app", default=os.path.join(REPO_DIR, "automate_script_web_clean.py"))
+    parser.add_argument("--reruns", type=int, default=20)
+    parser.add_argument("--import-repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app_path = os.path.abspath(args.app)
+    app_dir = os.path.dirname(app_path)
+    # Backend giả lập, cache / journal / thư viện tạm: không cần API key
+    work_dir = tempfile.mkdtemp(prefix="bench_streamlit_")
+    os.environ.update(LLM_BACKEND="fake", GEMINI_CACHE_DIR=os.path.join(work_dir, "cache"),
+                      JOB_JOURNAL_DIR=os.path.join(work_dir, "journal"),
+                      CONSISTENCY_LIBRARY_PATH=os.path.join(work_dir, "consistency_library.jsonl"),
+                      JOBS_DIR=os.path.join(work_dir, "jobs"))
+    sys.path.insert(0, app_dir)
+
+    import_seconds, heavy = cold_import_seconds(app_dir, args.import_repeat)
+    print(f"import script_pipeline (fresh process): {import_seconds * 1000:8.1f} ms  heavy modules loaded: {heavy}")
+
+    from streamlit.testing.v1 import AppTest
+    app = AppTest.from_file(app_path, default_timeout=300)
+    first_run = timed_runs(app, 1)
+    print(f"first run of the app:                   {first_run * 1000:8.1f} ms")
+    print(f"rerun, no results yet (median of {args.reruns}):  {timed_runs(app, args.reruns) * 1000:8.1f} ms")
+
+    # Submit một tập 2 phút: trang phải trả về ngay, job chạy trên worker thread của JobQueue
+    app.text_input[0].input("The First Fire")
+    app.number_input[0].set_value(2)
+    app.button[0].click()
+    submit_seconds = timed_runs(app, 1)
+    print(f"submit (enqueue, job runs in background): {submit_seconds * 1000:8.1f} ms")
+    print(f"rerun while the job runs (median of 5):  {timed_runs(app, 5) * 1000:8.1f} ms")
+
+    # AppTest không tự chạy fragment theo run_every: chờ job xong (job.json trong JOBS_DIR) rồi chạy lại trang
+    start_time = time.perf_counter()
+    while job_status(os.environ["JOBS_DIR"]) in ("queued", "running"):
+        time.sleep(0.2)
+    print(f"job finished after:                     {time.perf_counter() - start_time:8.1f} s")
+
+    # Các lần chạy lại sau khi job xong (kết quả đọc lại từ thư mục job, không gọi lại AI)
+    timed_runs(app, 1)
+    rerun_seconds = timed_runs(app, args.reruns)
+    print(f"rerun with a finished job (median of {args.reruns}): {rerun_seconds * 1000:8.1f} ms  "
+          f"expanders: {len(app.expander)}, dataframes: {len(app.dataframe)}, "
+          f"download buttons: {len(app.get('download_button'))}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+"""
+Backend LLM giả lập (offline, tất định) thay cho genai.GenerativeModel: dùng để đo và thử
+pipeline mà không tốn quota. Nhận diện loại prompt (kịch bản Step 1 hoặc outline / hàng của từng act,
+consistency keys, lô JSON Step 4) và trả về nội dung "giống thật" cho đúng số cảnh được yêu cầu.
+Có thể cấu hình độ trễ, lỗi 429 (ngẫu nhiên hoặc theo quota riêng của từng "key"),
+lỗi 503 (ngẫu nhiên hoặc sự cố kéo dài), phản hồi bị cắt và JSON hỏng.
+
+    import script_pipeline, fake_llm
+    script_pipeline.configure(backend=fake_llm.FakeGenerativeModel(latency=("lognormal", 0.8, 0.4)))
+"""
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+
+try:
+    # Cùng loại lỗi mà google-generativeai ném ra khi hết quota (HTTP 429) / server quá tải (HTTP 503)
+    from google.api_core.exceptions import ResourceExhausted as FakeQuotaError
+    from google.api_core.exceptions import ServiceUnavailable as FakeServerError
+except ImportError:
+    class FakeQuotaError(Exception):
+        """429 Resource has been exhausted (giả lập)."""
+        code = 429
+        def __str__(self):
+            return f"429 {super().__str__()}"
+
+    class FakeServerError(ConnectionError):
+        """503 Service unavailable (giả lập)."""
+        code = 503
+        def __str__(self):
+            return f"503 {super().__str__()}"
+
+SCENE_INPUT_REGEX = re.compile(r"--- SCENE (\d+) INPUT ---\n(.*?)(?:\n\n|\n---|$)", re.DOTALL)
+TOTAL_SCENES_REGEX = re.compile(r"exactly (\d+) scenes")
+TOTAL_ROWS_REGEX = re.compile(r"exactly (\d+) rows")
+OUTLINE_MARKER = "EPISODE OUTLINE"
+LIBRARY_MARKER = "ALREADY DEFINED in the series library"
+NEGATIVE_PROMPT_REGEX = re.compile(r'"negative_prompt"\s*:\s*"([^"]*)"')
+TOPIC_REGEX = re.compile(r'Video Topic: "(.*?)"')
+
+CHARACTERS = ("Kael", "Aru", "Mira", "Tor", "the Elder")
+PLACES = ("the frozen river", "the cave mouth", "the mammoth steppe", "the burnt forest", "the ridge")
+ACTIONS = ("tracks a wounded bison across", "kindles the first flame near", "hides from the cave lion at",
+           "signals the hunters from", "mourns the fallen hunter beside")
+CAMERAS = ("Wide establishing shot", "Close-up", "Low angle tracking shot", "Aerial drone shot", "Handheld follow")
+SOUNDS = ("Wind, cracking ice", "Crackling fire", "Distant roar, rain", "Heavy breathing", "Silence, dripping water")
+EMOTIONS = ("Awe", "Terror", "Hope", "Grief", "Tension")
+FILLER_WORDS = ("breath", "mist", "frost", "ember", "shadow", "stone", "hide", "bone", "sinew", "ash",
+                "ridge", "torchlight", "howl", "sky", "hunger", "instinct", "silence", "blood-red", "dawn")
+
+# Đặc tính giả lập của từng model cho FakeGenerativeModel.for_model (so sánh model theo bước, xem
+# benchmarks/bench_models.py): model lớn chậm hơn nhưng chính xác, model nhỏ nhanh hơn nhưng hay sai số cảnh / JSON
+FAKE_MODEL_PROFILES = {
+    "gemini-1.5-pro": {"latency": ("lognormal", 0.6, 0.3), "seconds_per_output_token": 0.0002},
+    "gemini-1.5-flash": {"latency": ("lognormal", 0.25, 0.3), "seconds_per_output_token": 0.00005,
+                         "malformed_rate": 0.02},
+    "gemini-1.5-flash-8b": {"latency": ("lognormal", 0.12, 0.3), "seconds_per_output_token": 0.00002,
+                            "malformed_rate": 0.4, "scene_count_error_rate": 0.5},
+}
+
+def _parse_latency(latency):
+    # latency: số giây cố định, ("fixed", s), ("uniform", lo, hi), ("normal", mean, sd),
+    # ("lognormal", median, sigma) hoặc hàm rng -> giây
+    if callable(latency):
+        return latency
+    if isinstance(latency, (int, float)):
+        return lambda rng: float(latency)
+    kind, *params = latency
+    if kind == "fixed":
+        return lambda rng: float(params[0])
+    if kind == "uniform":
+        return lambda rng: rng.uniform(params[0], params[1])
+    if kind == "normal":
+        return lambda rng: max(0.0, rng.gauss(params[0], params[1]))
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(math.log(params[0]), params[1])
+    raise ValueError(f"Unknown latency distribution: {kind!r}")
+
+class _FakeResponse:
+    def __init__(self, text, usage_metadata=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+class FakeGenerativeModel:
+    """
+    Cùng giao diện với genai.GenerativeModel mà pipeline dùng: `model_name` và
+    `generate_content(prompt, stream=False)` (response có `.text`, `.usage_metadata`).
+    Mọi lựa chọn ngẫu nhiên được seed theo (seed, prompt, lần gửi thứ mấy của prompt đó),
+    nên cùng cấu hình cho cùng kết quả dù các lô chạy song song theo thứ tự nào.
+    `quota_requests` / `quota_window_seconds`: quota của một API key như phía server - quá
+    `quota_requests` request trong cửa sổ trượt thì trả 429 kèm retry_delay (mỗi instance = một key).
+    `outage_after_calls`: sau số lần gọi này, mọi request đều lỗi 503 (API sập kéo dài).
+    `structured_output`: nhận generation_config có response_schema như API thật - phản hồi luôn là
+    JSON đúng cú pháp (không có fence), còn `malformed_rate` khi đó là tỷ lệ object sai template.
+    `straggler_rate` / `straggler_factor`: tỷ lệ lần gọi chậm gấp `straggler_factor` lần (đuôi latency).
+    `scene_count_error_rate`: tỷ lệ bảng kịch bản (Step 1) thiếu vài hàng so với số cảnh được yêu cầu.
+    """
+    def __init__(self, model_name="fake-gemini", seed=0, latency=0.0, seconds_per_output_token=0.0,
+                 rate_limit_rate=0.0, truncation_rate=0.0, malformed_rate=0.0, words_per_description=320,
+                 quota_requests=None, quota_window_seconds=60.0, server_error_rate=0.0, outage_after_calls=None,
+                 structured_output=True, straggler_rate=0.0, straggler_factor=6.0, scene_count_error_rate=0.0):
+        self.model_name = model_name
+        self.supports_response_schema = structured_output
+        self.seed = seed
+        self._latency = _parse_latency(latency)
+        self.seconds_per_output_token = seconds_per_output_token
+        self.rate_limit_rate = rate_limit_rate
+        self.truncation_rate = truncation_rate
+        self.malformed_rate = malformed_rate
+        self.words_per_description = words_per_description
+        self.quota_requests = quota_requests
+        self.quota_window_seconds = quota_window_seconds
+        self.server_error_rate = server_error_rate
+        self.outage_after_calls = outage_after_calls
+        self.straggler_rate = straggler_rate
+        self.straggler_factor = straggler_factor
+        self.scene_count_error_rate = scene_count_error_rate
+        self._quota_window = deque()
+        self.stats = {"calls": 0, "rate_limited": 0, "quota_exceeded": 0, "server_errors": 0,
+                      "truncated": 0, "malformed": 0, "schema_violations": 0, "stragglers": 0,
+                      "short_tables": 0}
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_model(cls, model_name, **kwargs):
+        """
+        Model giả lập mang tên `model_name`, với đặc tính trong FAKE_MODEL_PROFILES nếu có
+        (tên khác: không có độ trễ / lỗi, như mặc định).
+        """
+        return cls(model_name=model_name, **{**FAKE_MODEL_PROFILES.get(model_name, {}), **kwargs})
+
+    @property
+    def calls(self):
+        return self.stats["calls"]
+
+    def _rng_for(self, prompt):
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        with self._lock:
+            self.stats["calls"] += 1
+            attempt = self._attempts.get(digest, 0)
+            self._attempts[digest] = attempt + 1
+        return random.Random(f"{self.seed}:{digest}:{attempt}")
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _check_quota(self):
+        # Cửa sổ trượt như quota RPM phía server; request bị từ chối không được tính
+        if self.quota_requests is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            while self._quota_window and self._quota_window[0] <= now - self.quota_window_seconds:
+                self._quota_window.popleft()
+            if len(self._quota_window) >= self.quota_requests:
+                self.stats["quota_exceeded"] += 1
+                retry_delay = math.ceil(self._quota_window[0] + self.quota_window_seconds - now)
+                raise FakeQuotaError(f"Resource has been exhausted (e.g. check quota). "
+                                     f"retry_delay {{ seconds: {retry_delay} }}")
+            self._quota_window.append(now)
+
+    def generate_content(self, prompt, stream=False, generation_config=None, **kwargs):
+        rng = self._rng_for(prompt)
+        self._check_quota()
+        in_outage = self.outage_after_calls is not None and self.calls > self.outage_after_calls
+        if in_outage or rng.random() < self.server_error_rate:
+            time.sleep(min(self._latency(rng), 0.2))
+            self._count("server_errors")
+            raise FakeServerError("The service is currently unavailable")
+        if rng.random() < self.rate_limit_rate:
+            # Lỗi 429 thường trả về nhanh
+            time.sleep(min(self._latency(rng), 0.2))
+            self._count("rate_limited")
+            raise FakeQuotaError("Resource has been exhausted (e.g. check quota).")
+
+        structured = self.supports_response_schema and bool((generation_config or {}).get("response_schema"))
+        text = self._respond(prompt, rng, structured)
+        if rng.random() < self.truncation_rate:
+            # Bị cắt như khi chạm giới hạn token đầu ra
+            text = text[:int(len(text) * rng.uniform(0.3, 0.9))]
+            self._count("truncated")
+
+        usage_metadata = SimpleNamespace(
+            prompt_token_count=max(1, len(prompt) // 4),
+            candidates_token_count=max(1, len(text) // 4),
+            cached_content_token_count=0,
+        )
+        usage_metadata.total_token_count = usage_metadata.prompt_token_count + usage_metadata.candidates_token_count
+        delay = self._latency(rng) + usage_metadata.candidates_token_count * self.seconds_per_output_token
+        # Chỉ rút số ngẫu nhiên khi có cấu hình: các profile khác giữ nguyên chuỗi ngẫu nhiên
+        if self.straggler_rate and rng.random() < self.straggler_rate:
+            delay *= self.straggler_factor
+            self._count("stragglers")
+        if stream:
+            return self._stream(text, usage_metadata, delay)
+        time.sleep(delay)
+        return _FakeResponse(text, usage_metadata)
+
+    def _stream(self, text, usage_metadata, delay, chunk_size=200):
+        # Đoạn đầu tiên tới sau ~1/4 độ trễ, phần còn lại rải đều
+        chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)] or [""]
+        time.sleep(delay / 4)
+        for index, chunk in enumerate(chunks):
+            if index:
+                time.sleep(delay * 0.75 / len(chunks))
+            yield _FakeResponse(chunk, usage_metadata if index == len(chunks) - 1 else None)
+
+    # --- NỘI DUNG GIẢ LẬP ---
+    def _respond(self, prompt, rng, structured=False):
+        if "--- SCENE " in prompt:
+            return self._json_batch(prompt, rng, structured)
+        # Kịch bản phân cấp: các hàng của một act (prompt có kèm outline), rồi chính outline
+        match = TOTAL_ROWS_REGEX.search(prompt)
+        if match:
+            return "\n".join(["| Timecode | Scene Description | Camera Angle | Sound/Ambience | Emotion |",
+                              "|---|---|---|---|---|", *self._scene_rows(self._row_count(int(match.group(1)), rng), rng)])
+        if OUTLINE_MARKER in prompt:
+            topic = TOPIC_REGEX.search(prompt)
+            return self._script_sections(topic.group(1) if topic else "Untitled", [
+                "# Characters", *(f"- {name}: weathered Neanderthal, fur cloak, ochre marks." for name in CHARACTERS), "",
+                "# Act Breakdown",
+                "Act I: Kael wakes to a frozen dawn and finds the embers dead.",
+                "Act II: The clan hunts, loses the Elder to the cave lion and learns to strike fire.",
+                "Act III: Around the first flame, Mira mourns and the clan survives the night.",
+                "Tag: Sparks rise into the aurora as distant howls answer.",
+            ])
+        match = TOTAL_SCENES_REGEX.search(prompt)
+        if match and "scriptwriter" in prompt:
+            topic = TOPIC_REGEX.search(prompt)
+            return self._master_script(topic.group(1) if topic else "Untitled", self._row_count(int(match.group(1)), rng), rng)
+        return self._consistency_keys(prompt)
+
+    def _row_count(self, count, rng):
+        # Chỉ rút số ngẫu nhiên khi có cấu hình: các profile khác giữ nguyên chuỗi ngẫu nhiên
+        if self.scene_count_error_rate and rng.random() < self.scene_count_error_rate:
+            self._count("short_tables")
+            return max(1, count - rng.randint(1, max(1, count // 10)))
+        return count
+
+    def _scene_rows(self, count, rng):
+        rows = []
+        for i in range(count):
+            seconds = i * 8
+            rows.append(
+                f"| {seconds // 60:02d}:{seconds % 60:02d} | {rng.choice(CHARACTERS)} {rng.choice(ACTIONS)} "
+                f"{rng.choice(PLACES)} | {rng.choice(CAMERAS)} | {rng.choice(SOUNDS)} | {rng.choice(EMOTIONS)} |"
+            )
+        return rows
+
+    def _master_script(self, topic, total_scenes, rng):
+        return self._script_sections(topic, [
+            "# Script (table format)",
+            "| Timecode | Scene Description | Camera Angle | Sound/Ambience | Emotion |",
+            "|---|---|---|---|---|",
+            *self._scene_rows(total_scenes, rng),
+        ])
+
+    def _script_sections(self, topic, body_lines):
+        # Các section của kịch bản; `body_lines` (bảng cảnh hoặc phần outline) nằm sau Era Definition
+        return "\n".join([
+            "# Title", f"Life 40,000 Years Ago | {topic}", "",
+            "# Description", f"A cinematic journey into {topic.lower()}: survival, fire and the first stories.", "",
+            "# Hashtags", "#prehistoric #prehumanfile #survival #stoneage #ancienthumans", "",
+            "# Era Definition", "Era: Late Pleistocene (~40,000 years ago). Species: Homo neanderthalensis.", "",
+            *body_lines, "",
+            "# Thumbnail Prompts", "1. A lone hunter raising a torch against a blizzard.",
+            "2. Sparks falling on dry moss inside a cave.", "",
+            "# Keywords", "prehistoric, neanderthal, fire, survival, ice age", "",
+            "# CTA", "Subscribe to PrehumanFile for the next chapter of human survival.",
+        ])
+
+    def _consistency_keys(self, prompt):
+        entries = [("CHARACTER", name, "weathered Neanderthal, heavy brow, fur cloak, ochre marks on the cheeks.")
+                   for name in CHARACTERS]
+        entries += [("LOCATION", place, "snow, dark basalt, pale winter light.") for place in PLACES]
+        if LIBRARY_MARKER in prompt:
+            # Đã có thư viện: chỉ mô tả các tên có trong các cảnh được gửi và chưa được định nghĩa
+            known, _, rest = prompt.partition(LIBRARY_MARKER)
+            entries = [entry for entry in entries
+                       if entry[1].lower() in known.lower() and f"({entry[1]})" not in rest]
+            if not entries:
+                return "NONE"
+        lines = [f"- {kind} ({name}): {description}" for kind, name, description in entries]
+        if "production designer" in prompt:
+            lines.insert(0, "- ERA: Late Pleistocene (~40,000 years ago). Species: Homo neanderthalensis.")
+        return "\n".join(lines)
+
+    def _json_batch(self, prompt, rng, structured=False):
+        negative_prompt = NEGATIVE_PROMPT_REGEX.search(prompt)
+        negative_prompt = negative_prompt.group(1) if negative_prompt else "cartoon, animated"
+        objects = []
+        for scene_number, scene_input in SCENE_INPUT_REGEX.findall(prompt):
+            fields = dict(re.findall(r"^(\w+): (.*)$", scene_input, re.MULTILINE))
+            description = fields.get("Description", f"Scene {scene_number}")
+            expanded = " ".join(rng.choice(FILLER_WORDS) for _ in range(self.words_per_description))
+            objects.append({
+                "1. CORE_IDEA": {"scene_purpose": f"Scene {scene_number}: {description}", "desired_duration_seconds": 8},
+                "2. CHARACTERS_AND_ACTIONS": [{
+                    "character": rng.choice(CHARACTERS),
+                    "description": "Weathered Neanderthal, heavy brow, fur cloak.",
+                    "action_and_expression": f"{description}. {expanded}",
+                }],
+                "3. SETTING": {
+                    "location": rng.choice(PLACES),
+                    "time_and_weather": "Dusk, light snow",
+                    "key_elements": ["Smoke", "Bone tools", "Frozen ground"],
+                    "negative_prompt": negative_prompt,
+                },
+                "4. VISUAL_STYLE_AND_MOOD": {
+                    "film_genre": "Science Fiction",
+                    "primary_mood": fields.get("Emotion", "Awe"),
+                    "lighting_and_color": "Low-key firelight, cold blue shadows",
+                    "camera_work": fields.get("Camera", "Wide shot"),
+                },
+                "5. AUDIO": {
+                    "background_music": "Low ambient drones",
+                    "ambient_sound": fields.get("Sound", "Wind"),
+                    "sound_effects": ["Crackling fire", "Distant howl"],
+                },
+            })
+        if structured:
+            # Structured output: cú pháp luôn đúng, nhưng đôi khi một object không theo template
+            if objects and rng.random() < self.malformed_rate:
+                obj = rng.choice(objects)
+                if rng.random() < 0.5:
+                    obj["3. SETTING"]["negative_prompt"] = "cartoon, blurry"
+                else:
+                    obj["3. SETTING"]["location"] = ""
+                self._count("schema_violations")
+            return json.dumps(objects, ensure_ascii=False)
+        parts = [json.dumps(obj, ensure_ascii=False, indent=2) for obj in objects]
+        if parts and rng.random() < self.malformed_rate:
+            # Một object bị hỏng (thiếu dấu ':'), các object khác vẫn hợp lệ
+            index = rng.randrange(len(parts))
+            parts[index] = parts[index].replace('"scene_purpose":', '"scene_purpose"', 1)
+            self._count("malformed")
+        return "```json\n[\n" + ",\n".join(parts) + "\n]\n```"
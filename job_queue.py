@@ -0,0 +1,246 @@
+"""
+Hàng đợi job chạy nền cho app Streamlit: submit() ghi job vào bảng job trên đĩa và trả về ngay,
+các worker thread chạy pipeline (script_pipeline.run_episode) tối đa MAX_CONCURRENT_JOBS job
+cùng lúc. Mỗi job một thư mục trong JOBS_DIR: job.json (trạng thái, tiến độ, thông báo gần nhất)
+và bundle kết quả (giống batch_generate) để tải về sau, kể cả từ phiên / tab khác.
+
+    queue = JobQueue(max_concurrent_jobs=3)
+    job_id = queue.submit("The First Fire", 10, {"formats": ["xlsx"]})
+    queue.get(job_id)["progress"]; queue.cancel(job_id)
+"""
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+import script_pipeline
+from batch_generate import write_episode_bundle
+
+JOBS_DIR = os.environ.get("JOBS_DIR", ".jobs")
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", "2"))
+ACTIVE_STATUSES = ("queued", "running")
+MAX_JOB_MESSAGES = 50 # Số thông báo gần nhất giữ trong job.json
+DEFAULT_JOB_OPTIONS = {
+    "workers": script_pipeline.DEFAULT_JSON_WORKERS,
+    "rpm_limit": script_pipeline.DEFAULT_RPM_LIMIT,
+    "tpm_limit": script_pipeline.DEFAULT_TPM_LIMIT,
+    "refresh_cache": False,
+    "streaming": False,
+    "resume": False,
+    "formats": ["xlsx"],
+    "script_mode": "auto",
+    "use_library": True,
+    "hedge_mode": "off",
+    "hedge_percentile": script_pipeline.DEFAULT_HEDGE_PERCENTILE,
+    "hedge_budget": script_pipeline.DEFAULT_HEDGE_BUDGET,
+    "stage_models": {}, # route ("script" / "keys" / "json") -> model; không có thì dùng model chính
+}
+
+class JobCancelled(Exception):
+    """
+    Job bị hủy giữa chừng (ném ra từ JobReporter ở lần báo tiến độ tiếp theo).
+    """
+
+class JobReporter(script_pipeline.PipelineReporter):
+    """
+    Ghi tiến độ và thông báo của một job vào bảng job; dừng pipeline khi job bị hủy.
+    Chỉ được gọi từ thread chạy job (run_episode không gọi reporter từ worker).
+    """
+    def __init__(self, job_queue, job_id):
+        self.job_queue = job_queue
+        self.job_id = job_id
+
+    def _check_cancelled(self):
+        if self.job_queue.cancel_requested(self.job_id):
+            raise JobCancelled()
+
+    def log(self, level, message):
+        self.job_queue._append_message(self.job_id, level, message.strip())
+        self._check_cancelled()
+
+    def progress(self, percent, text):
+        self.job_queue._update(self.job_id, progress=percent, progress_text=text)
+        self._check_cancelled()
+
+class JobQueue:
+    """
+    Bảng job trên đĩa + các worker thread. An toàn khi gọi từ nhiều phiên Streamlit cùng lúc.
+    Job đang chờ / đang chạy khi tiến trình trước dừng được đánh dấu "interrupted" lúc khởi động
+    (chạy lại bằng retry(): resume từ JobJournal).
+    Các job có cùng RPM/TPM dùng chung một TokenBucketLimiter để nhiều job song song không vượt quota.
+    """
+    def __init__(self, jobs_dir=JOBS_DIR, max_concurrent_jobs=MAX_CONCURRENT_JOBS):
+        self.jobs_dir = jobs_dir
+        self.max_concurrent_jobs = max(1, int(max_concurrent_jobs))
+        self._jobs = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        os.makedirs(jobs_dir, exist_ok=True)
+        self._load()
+        for index in range(self.max_concurrent_jobs):
+            threading.Thread(target=self._worker, name=f"job-worker-{index + 1}", daemon=True).start()
+
+    def _load(self):
+        for job_id in os.listdir(self.jobs_dir):
+            try:
+                with open(os.path.join(self.jobs_dir, job_id, "job.json"), "r", encoding="utf-8") as f:
+                    job = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if job["status"] in ACTIVE_STATUSES:
+                job.update(status="interrupted", error="The server stopped before this job finished.",
+                           finished_at=time.time())
+                self._save(job)
+            self._jobs[job_id] = job
+
+    def _save(self, job):
+        # Ghi nguyên tử: trang khác không bao giờ đọc phải job.json viết dở
+        path = os.path.join(self.job_dir(job["id"]), "job.json")
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(fields)
+            self._save(job)
+
+    def _append_message(self, job_id, level, message):
+        with self._lock:
+            job = self._jobs[job_id]
+            job["messages"] = (job["messages"] + [[level, message]])[-MAX_JOB_MESSAGES:]
+            if level in ("warning", "error"):
+                job["warnings"] = job.get("warnings", 0) + 1
+            # Thông báo info (mỗi lần gọi API...) chỉ giữ trong bộ nhớ, không ghi đĩa mỗi lần
+            if level != "info":
+                self._save(job)
+
+    def job_dir(self, job_id):
+        return os.path.join(self.jobs_dir, job_id)
+
+    def submit(self, video_topic, video_duration_minutes, options=None):
+        """
+        Thêm job vào hàng đợi và trả về job_id ngay (không chờ job chạy).
+        """
+        job_id = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        job = {
+            "id": job_id,
+            "topic": video_topic,
+            "duration_minutes": int(video_duration_minutes),
+            "options": {**DEFAULT_JOB_OPTIONS, **(options or {})},
+            "status": "queued",
+            "progress": 0,
+            "progress_text": "Waiting for a free worker...",
+            "messages": [],
+            "created_at": time.time(),
+            "cancel_requested": False,
+        }
+        os.makedirs(self.job_dir(job_id), exist_ok=True)
+        with self._lock:
+            self._jobs[job_id] = job
+            self._save(job)
+        self._queue.put(job_id)
+        return job_id
+
+    def retry(self, job_id):
+        """
+        Gửi lại một job lỗi / bị hủy / bị gián đoạn, resume từ JobJournal (chỉ tạo phần còn thiếu).
+        """
+        job = self.get(job_id)
+        return self.submit(job["topic"], job["duration_minutes"], dict(job["options"], resume=True))
+
+    def cancel(self, job_id):
+        """
+        Job đang chờ bị hủy ngay; job đang chạy dừng ở lần báo tiến độ tiếp theo.
+        """
+        with self._lock:
+            job = self._jobs[job_id]
+            if job["status"] == "queued":
+                job.update(status="cancelled", finished_at=time.time(), progress_text="Cancelled before it started.")
+            elif job["status"] == "running":
+                job.update(cancel_requested=True, progress_text="Cancelling...")
+            self._save(job)
+
+    def cancel_requested(self, job_id):
+        with self._lock:
+            return self._jobs[job_id]["cancel_requested"]
+
+    def get(self, job_id):
+        with self._lock:
+            return json.loads(json.dumps(self._jobs[job_id]))
+
+    def list_jobs(self, limit=None):
+        """
+        Các job, mới nhất trước (bản sao: an toàn để hiển thị khi worker đang cập nhật).
+        """
+        with self._lock:
+            jobs = sorted(self._jobs.values(), key=lambda job: job["created_at"], reverse=True)[:limit]
+            return json.loads(json.dumps(jobs))
+
+    def read_output(self, job_id, filename):
+        with open(os.path.join(self.job_dir(job_id), filename), "rb") as f:
+            return f.read()
+
+    def _limiter(self, options):
+        # Một limiter cho mỗi cấu hình RPM/TPM (cùng quy ước "mỗi key" như run_episode)
+        pool_size = len(script_pipeline.model) if isinstance(script_pipeline.model, script_pipeline.ClientPool) else 1
+        key = (options["rpm_limit"], options["tpm_limit"], pool_size)
+        with self._lock:
+            if key not in self._limiters:
+                self._limiters[key] = script_pipeline.TokenBucketLimiter(options["rpm_limit"] * pool_size,
+                                                                         options["tpm_limit"] * pool_size)
+            return self._limiters[key]
+
+    def _worker(self):
+        while True:
+            job_id = self._queue.get()
+            with self._lock:
+                job = self._jobs[job_id]
+                if job["status"] != "queued": # Đã bị hủy khi còn chờ
+                    continue
+                job.update(status="running", started_at=time.time(), progress_text="Starting...")
+                self._save(job)
+            try:
+                self._run(job_id)
+            except Exception as e: # Không để một job lỗi làm dừng worker
+                self._update(job_id, status="failed", error=str(e), finished_at=time.time())
+
+    def _run(self, job_id):
+        job = self.get(job_id)
+        options = job["options"]
+        exporter = script_pipeline.SceneExporter(options["formats"])
+        try:
+            result = script_pipeline.run_episode(
+                job["topic"], job["duration_minutes"], reporter=JobReporter(self, job_id),
+                max_workers=options["workers"], limiter=self._limiter(options),
+                refresh_cache=options["refresh_cache"], streaming_mode=options["streaming"],
+                resume_job=options["resume"], exporter=exporter, script_mode=options["script_mode"],
+                use_library=options["use_library"], hedge_mode=options["hedge_mode"],
+                hedge_percentile=options["hedge_percentile"], hedge_budget=options["hedge_budget"], stage_models=options["stage_models"]
+            )
+        except JobCancelled:
+            exporter.close()
+            self._update(job_id, status="cancelled", finished_at=time.time(), progress_text="Cancelled.")
+            return
+        except Exception:
+            exporter.close()
+            raise
+        if result is None:
+            exporter.close()
+            self._update(job_id, status="failed", error="No usable master script", finished_at=time.time())
+            return
+
+        exporter.base_name = script_pipeline.job_output_name(job["topic"], result["run_id"])
+        outputs = exporter.finish()
+        write_episode_bundle(result, outputs, self.job_dir(job_id))
+        run_summary = result["trace"].run_summary(len(result["rows"]) - result["failed_scenes"])
+        self._update(
+            job_id, status="done", progress=100, progress_text="Complete!", finished_at=time.time(),
+            run_id=result["run_id"], scenes=len(result["rows"]), failed_scenes=result["failed_scenes"],
+            total_seconds=run_summary["total_seconds"],
+            outputs=[[export_format, filename, mime] for export_format, (filename, _, mime) in outputs.items()]
+        )
@@ -0,0 +1,3630 @@
+"""
+Pipeline tạo kịch bản + JSON prompt Veo 3, không phụ thuộc giao diện.
+Dùng chung cho app Streamlit (automate_script_web_clean.py) và CLI chạy hàng loạt (batch_generate.py).
+Tiến độ, thông báo và kết quả từng bước được báo qua một PipelineReporter.
+google.generativeai chỉ được import khi tạo model Gemini (import rất chậm, không cần cho UI / backend giả lập).
+"""
+import os
+import json
+import hashlib
+import datetime
+import math
+import time
+import threading
+import contextlib
+import contextvars
+import functools
+import multiprocessing
+import re
+import io
+import csv
+import random
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+# --- MODEL ---
+DEFAULT_MODEL_NAME = 'gemini-1.5-flash-latest'
+model = None # Được tạo bởi configure()
+
+# Backend mặc định: "gemini" (API thật) hoặc "fake" (fake_llm, offline) qua biến môi trường
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "gemini").lower()
+
+def split_config_list(value):
+    """
+    "a, b" / ["a", "b"] / None -> danh sách các giá trị không rỗng.
+    """
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [item.strip() for item in value if item and item.strip()]
+
+def _genai():
+    # Import lười: google.generativeai mất gần 1 giây để import
+    import google.generativeai as genai
+    return genai
+
+def is_genai_model(obj):
+    """
+    True nếu `obj` là genai.GenerativeModel (không import google.generativeai nếu chưa dùng tới).
+    """
+    return type(obj).__module__.startswith("google.generativeai")
+
+def create_model(api_key=None, model_name=DEFAULT_MODEL_NAME, backend=None, client_limiters=None):
+    """
+    Tạo model (không đặt làm model của tiến trình; xem configure()).
+    `backend`: "gemini", "fake" (fake_llm.FakeGenerativeModel, không cần key) hoặc một object
+    bất kỳ có `model_name` và `generate_content(prompt, stream=False)`; mặc định theo LLM_BACKEND.
+    `api_key` / `model_name` có thể là danh sách (hoặc chuỗi cách nhau bởi dấu phẩy): khi có nhiều
+    hơn một cặp (key, model), model là một ClientPool; `client_limiters` là limiter của từng cặp.
+    `model_name` dạng "a > b": ModelFallbackChain, dùng b khi a quá tải (mỗi phần tử có thể là một pool "a1,a2");
+    khi đó `client_limiters` là một danh sách limiter (hoặc None) cho mỗi phần tử của chuỗi
+    (danh sách limiter phẳng chỉ áp dụng cho phần tử đầu).
+    """
+    backend = backend or LLM_BACKEND
+    spec = ",".join(split_config_list(model_name))
+    if ">" in spec and isinstance(backend, str):
+        links = spec.split(">")
+        if client_limiters and not isinstance(client_limiters[0], (list, tuple, type(None))):
+            client_limiters = [client_limiters]
+        link_limiters = list(client_limiters or []) + [None] * len(links)
+        return ModelFallbackChain([create_model(api_key, names, backend, limiters)
+                                   for names, limiters in zip(links, link_limiters)])
+    api_keys = split_config_list(api_key)
+    model_names = split_config_list(model_name) or [DEFAULT_MODEL_NAME]
+    if backend == "fake":
+        import fake_llm
+        return fake_llm.FakeGenerativeModel.for_model(model_names[0])
+    if backend == "gemini" and len(api_keys) * len(model_names) > 1:
+        return ClientPool.for_gemini(api_keys, model_names, limiters=client_limiters)
+    if backend == "gemini":
+        genai = _genai()
+        genai.configure(api_key=api_keys[0] if api_keys else None)
+        return genai.GenerativeModel(model_names[0])
+    if isinstance(backend, str):
+        raise ValueError(f"Unknown LLM backend: {backend!r}")
+    return backend
+
+def configure(api_key=None, model_name=DEFAULT_MODEL_NAME, backend=None, client_limiters=None):
+    """
+    Cấu hình API key và chọn model cho mọi lần gọi của tiến trình này (tham số như create_model).
+    Model riêng của từng bước (run_episode(stage_models=...)) dùng cùng key và backend.
+    """
+    global model
+    model = create_model(api_key, model_name, backend, client_limiters)
+    settings = {"api_key": split_config_list(api_key), "backend": backend if isinstance(backend, str) else None}
+    with _stage_model_lock:
+        # Model của từng bước được giữ lại (kèm cooldown của chuỗi fallback) khi key / backend không đổi
+        if settings != _model_settings:
+            _model_settings.update(settings)
+            _stage_model_cache.clear()
+    return model
+
+# --- MODEL THEO TỪNG BƯỚC ---
+# Route -> các stage (tham số `stage` của call_gemini_api) đi qua route đó
+STAGE_ROUTES = {
+    "script": ("step1_script", "step1_outline", "step1_act"), # Sáng tác dài
+    "keys": ("step3_keys",), # Trích xuất ngắn
+    "json": ("step4_json",), # Mở rộng theo template, số lượng lớn
+}
+STAGE_ROUTE_BY_STAGE = {stage: route for route, stages in STAGE_ROUTES.items() for stage in stages}
+_model_settings = {"api_key": [], "backend": None}
+_stage_model_cache = {} # "a > b" -> model đã tạo (dùng chung cho mọi job của tiến trình)
+_stage_model_lock = threading.Lock()
+# Route của lần chạy hiện tại; worker của run_episode nhận context qua ContextThreadPoolExecutor
+_run_stage_models = contextvars.ContextVar("run_stage_models", default=None)
+
+def stage_model(spec):
+    """
+    Model cho một spec ("gemini-1.5-pro > gemini-1.5-flash", hoặc object model) với key / backend của configure().
+    Mỗi spec chỉ được tạo một lần.
+    """
+    if not isinstance(spec, str):
+        return spec
+    spec = spec.strip()
+    with _stage_model_lock:
+        if spec not in _stage_model_cache:
+            _stage_model_cache[spec] = create_model(_model_settings["api_key"], spec, _model_settings["backend"])
+        return _stage_model_cache[spec]
+
+def resolve_stage_models(stage_models):
+    """
+    {route: spec hoặc model} -> {route: model}; route không có / spec rỗng dùng model mặc định.
+    """
+    unknown = [route for route in (stage_models or {}) if route not in STAGE_ROUTES]
+    if unknown:
+        raise ValueError(f"Unknown model route(s): {', '.join(unknown)} (expected {', '.join(STAGE_ROUTES)})")
+    return {route: stage_model(spec) for route, spec in (stage_models or {}).items() if spec}
+
+def model_for_stage(stage):
+    """
+    Model cho một stage: route của lần chạy hiện tại nếu có, nếu không thì model của configure().
+    """
+    routes = _run_stage_models.get()
+    return (routes or {}).get(STAGE_ROUTE_BY_STAGE.get(stage)) or model
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    # Task chạy trong context (contextvars) của thread gửi nó: worker dùng cùng route model với run_episode
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+SCENE_DURATION_SECONDS = 8 # Mặc định
+JSON_BATCH_SIZE = 10
+
+# --- GIỚI HẠN TỐC ĐỘ (TOKEN BUCKET) ---
+DEFAULT_JSON_WORKERS = 4
+DEFAULT_RPM_LIMIT = 15 # Quota mặc định của gemini-1.5-flash (free tier)
+DEFAULT_TPM_LIMIT = 1_000_000
+
+class TokenBucketLimiter:
+    """
+    Token bucket dùng chung cho mọi request: giới hạn requests/phút và tokens/phút.
+    An toàn khi gọi từ nhiều thread cùng lúc.
+    """
+    def __init__(self, rpm_limit=DEFAULT_RPM_LIMIT, tpm_limit=DEFAULT_TPM_LIMIT):
+        self.rpm_limit = max(1, int(rpm_limit))
+        self.tpm_limit = max(1, int(tpm_limit))
+        # Trạng thái bucket: [requests, tokens, last_refill].
+        # Bắt đầu với bucket đầy để các request đầu tiên không phải chờ
+        self._state = [float(self.rpm_limit), float(self.tpm_limit), time.monotonic()]
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = max(0.0, now - self._state[2])
+        self._state[2] = now
+        self._state[0] = min(self.rpm_limit, self._state[0] + elapsed * self.rpm_limit / 60.0)
+        self._state[1] = min(self.tpm_limit, self._state[1] + elapsed * self.tpm_limit / 60.0)
+
+    def acquire(self, tokens=0):
+        """
+        Chờ cho tới khi có đủ 1 request và `tokens` tokens trong bucket.
+        Trả về số giây đã phải chờ.
+        """
+        waited = 0.0
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait == 0:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    def try_acquire(self, tokens=0):
+        """
+        Không chờ: lấy 1 request và `tokens` tokens nếu bucket còn đủ (trả về 0),
+        nếu không trả về số giây cần chờ.
+        """
+        # Một request lớn hơn cả bucket sẽ không bao giờ đủ -> giới hạn lại
+        tokens = min(max(0, int(tokens)), self.tpm_limit)
+        with self._lock:
+            self._refill()
+            if self._state[0] >= 1 and self._state[1] >= tokens:
+                self._state[0] -= 1
+                self._state[1] -= tokens
+                return 0
+            # Tính thời gian cần chờ để bucket thiếu nhất được nạp đủ
+            wait_requests = (1 - self._state[0]) * 60.0 / self.rpm_limit
+            wait_tokens = (tokens - self._state[1]) * 60.0 / self.tpm_limit
+            return max(wait_requests, wait_tokens, 0.01)
+
+    def headroom(self):
+        """
+        Phần ngân sách còn lại (0..1) của giới hạn đang chặt hơn (RPM hoặc TPM).
+        """
+        with self._lock:
+            self._refill()
+            return min(self._state[0] / self.rpm_limit, self._state[1] / self.tpm_limit)
+
+class SharedTokenBucketLimiter(TokenBucketLimiter):
+    """
+    Token bucket dùng chung cho nhiều tiến trình (CLI chạy nhiều tập song song):
+    trạng thái nằm trong shared memory, nên tổng RPM/TPM của mọi tiến trình vẫn nằm trong ngân sách.
+    Chỉ truyền sang tiến trình con lúc tạo tiến trình (initializer của pool).
+    """
+    def __init__(self, rpm_limit=DEFAULT_RPM_LIMIT, tpm_limit=DEFAULT_TPM_LIMIT, mp_context=None):
+        super().__init__(rpm_limit, tpm_limit)
+        mp_context = mp_context or multiprocessing.get_context()
+        # time.monotonic() dùng chung một đồng hồ cho mọi tiến trình trên cùng máy
+        self._state = mp_context.Array("d", self._state)
+        self._lock = self._state.get_lock()
+
+# --- POOL NHIỀU API KEY / MODEL ---
+QUOTA_COOLDOWN_SECONDS = 60
+RETRY_DELAY_REGEX = re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)")
+
+def is_quota_error(error):
+    """
+    Lỗi 429 / ResourceExhausted (hết quota của key), từ genai hoặc fake_llm.
+    """
+    return getattr(error, "code", None) == 429 or type(error).__name__ == "ResourceExhausted"
+
+def _glm_schema(schema):
+    # Response schema dạng dict của pipeline ({"type": "OBJECT", ...}) -> dict cho glm.Schema (trường "type_")
+    if isinstance(schema, dict):
+        return {("type_" if key == "type" else key): _glm_schema(value) for key, value in schema.items()}
+    return schema
+
+class _GeminiKeyResponse:
+    # Phản hồi (hoặc một đoạn stream) của GeminiKeyModel: `.text` và `.usage_metadata` như genai
+    def __init__(self, response):
+        self.usage_metadata = response.usage_metadata if "usage_metadata" in response else None
+        self._response = response
+
+    @property
+    def text(self):
+        if not self._response.candidates:
+            raise ValueError(f"No candidates in the response (prompt feedback: {self._response.prompt_feedback})")
+        return "".join(part.text for part in self._response.candidates[0].content.parts)
+
+class GeminiKeyModel:
+    """
+    Model Gemini gắn với một API key riêng: mỗi key một GenerativeServiceClient (API công khai của
+    google-ai-generativelanguage, client_options={"api_key": ...}), không dùng genai.configure() toàn cục.
+    Cùng giao diện với genai.GenerativeModel mà pipeline dùng.
+    """
+    supports_response_schema = True
+
+    def __init__(self, model_name, client):
+        # Cùng dạng tên với genai.GenerativeModel ("models/..."): khóa cache không đổi
+        self.model_name = model_name if model_name.startswith("models/") else f"models/{model_name}"
+        self._client = client
+
+    @classmethod
+    def for_key(cls, api_key, model_names):
+        """
+        Một model cho mỗi tên trong `model_names`, dùng chung một client của `api_key`.
+        """
+        from google.ai import generativelanguage as glm
+        client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+        return [cls(model_name, client) for model_name in model_names]
+
+    def generate_content(self, prompt, stream=False, generation_config=None, **kwargs):
+        from google.ai import generativelanguage as glm
+        generation_config = dict(generation_config or {})
+        if generation_config.get("response_schema") is not None:
+            generation_config["response_schema"] = _glm_schema(generation_config["response_schema"])
+        request = glm.GenerateContentRequest(model=self.model_name, contents=[{"role": "user", "parts": [{"text": prompt}]}],
+                                             generation_config=generation_config or None)
+        if stream:
+            return (_GeminiKeyResponse(chunk) for chunk in self._client.stream_generate_content(request))
+        return _GeminiKeyResponse(self._client.generate_content(request))
+
+class PooledClient:
+    """
+    Một (API key, model) trong ClientPool: ngân sách RPM/TPM riêng và thời điểm hết cooldown.
+    """
+    def __init__(self, model, label, limiter):
+        self.model = model
+        self.label = label
+        self.limiter = limiter
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.stats = {"calls": 0, "quota_errors": 0, "errors": 0}
+
+class ClientPool:
+    """
+    Nhiều API key và/hoặc model dùng như một model duy nhất (configure(backend=pool)):
+    mỗi request đi tới client khỏe có ít request đang chạy nhất và còn ngân sách RPM/TPM;
+    client gặp lỗi 429 bị đưa ra khỏi vòng quay trong thời gian cooldown và request được
+    gửi lại ngay qua client khác, không làm hỏng lô.
+    An toàn khi gọi từ nhiều thread cùng lúc.
+    """
+    def __init__(self, clients, cooldown_seconds=QUOTA_COOLDOWN_SECONDS):
+        self.clients = list(clients)
+        if not self.clients:
+            raise ValueError("ClientPool needs at least one client")
+        self.cooldown_seconds = cooldown_seconds
+        # Dùng cho khóa cache phản hồi và log
+        self.model_name = "+".join(sorted({client.model.model_name for client in self.clients}))
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @classmethod
+    def from_models(cls, models, rpm_limit=DEFAULT_RPM_LIMIT, tpm_limit=DEFAULT_TPM_LIMIT, limiters=None,
+                    labels=None, cooldown_seconds=QUOTA_COOLDOWN_SECONDS):
+        """
+        `limiters`: một limiter cho mỗi model (ví dụ SharedTokenBucketLimiter của CLI);
+        mặc định TokenBucketLimiter(rpm_limit, tpm_limit) riêng cho từng model.
+        """
+        limiters = limiters or [TokenBucketLimiter(rpm_limit, tpm_limit) for _ in models]
+        labels = labels or [f"client{index}/{model.model_name}" for index, model in enumerate(models, start=1)]
+        return cls([PooledClient(model, label, limiter) for model, label, limiter in zip(models, labels, limiters)],
+                   cooldown_seconds)
+
+    @classmethod
+    def for_gemini(cls, api_keys, model_names=(DEFAULT_MODEL_NAME,), **kwargs):
+        """
+        Một client cho mỗi cặp (key, model): quota của Gemini tính riêng theo key và model.
+        """
+        models, labels = [], []
+        for key_index, api_key in enumerate(api_keys, start=1):
+            # genai.configure() chỉ có một key toàn cục -> mỗi key một client riêng (GeminiKeyModel)
+            models.extend(GeminiKeyModel.for_key(api_key, model_names))
+            labels.extend(f"key{key_index}/{model_name}" for model_name in model_names)
+        return cls.from_models(models, labels=labels, **kwargs)
+
+    def __len__(self):
+        return len(self.clients)
+
+    @property
+    def supports_response_schema(self):
+        # Structured output chỉ khi mọi client đều hỗ trợ (request có thể tới bất kỳ client nào)
+        return all(supports_response_schema(client.model) for client in self.clients)
+
+    def _checkout(self, tokens):
+        # Chờ tới khi có client khỏe còn ngân sách; chọn client ít tải nhất
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                healthy = [client for client in self.clients if client.cooldown_until <= now]
+                wait = min((client.cooldown_until - now for client in self.clients if client.cooldown_until > now),
+                           default=self.cooldown_seconds)
+                for client in sorted(healthy, key=lambda client: (client.in_flight, -client.limiter.headroom())):
+                    client_wait = client.limiter.try_acquire(tokens)
+                    if client_wait == 0:
+                        client.in_flight += 1
+                        client.stats["calls"] += 1
+                        self._local.label = client.label
+                        return client
+                    wait = min(wait, client_wait)
+            time.sleep(max(wait, 0.01))
+
+    def _release(self, client, error=None):
+        with self._lock:
+            client.in_flight -= 1
+            if error is None:
+                return
+            if not is_quota_error(error):
+                client.stats["errors"] += 1
+                return
+            # Hết quota: nghỉ theo retry_delay của API nếu có
+            client.stats["quota_errors"] += 1
+            match = RETRY_DELAY_REGEX.search(str(error))
+            cooldown = int(match.group(1)) if match else self.cooldown_seconds
+            client.cooldown_until = max(client.cooldown_until, time.monotonic() + cooldown)
+
+    def served_by(self):
+        """
+        Nhãn của client đã nhận request gần nhất của thread hiện tại.
+        """
+        return getattr(self._local, "label", None)
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        """
+        Như GenerativeModel.generate_content; lỗi 429 được gửi lại qua client khác (tối đa
+        một lần cho mỗi client), chỉ ném ra khi mọi client đều hết quota.
+        """
+        if stream:
+            return self._stream(prompt, **kwargs)
+        tokens = estimate_tokens(prompt)
+        last_error = None
+        for _ in range(len(self.clients)):
+            client = self._checkout(tokens)
+            try:
+                response = client.model.generate_content(prompt, **kwargs)
+            except Exception as e:
+                self._release(client, e)
+                if not is_quota_error(e):
+                    raise
+                last_error = e
+                continue
+            self._release(client)
+            return response
+        raise last_error
+
+    def _stream(self, prompt, **kwargs):
+        # Chỉ chuyển client nếu lỗi xảy ra trước đoạn đầu tiên
+        tokens = estimate_tokens(prompt)
+        last_error = None
+        for _ in range(len(self.clients)):
+            client = self._checkout(tokens)
+            try:
+                chunks = iter(client.model.generate_content(prompt, stream=True, **kwargs))
+                first_chunk = next(chunks, None)
+            except Exception as e:
+                self._release(client, e)
+                if not is_quota_error(e):
+                    raise
+                last_error = e
+                continue
+            error = None
+            try:
+                if first_chunk is not None:
+                    yield first_chunk
+                yield from chunks
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                self._release(client, error)
+            return
+        raise last_error
+
+    def stats(self):
+        """
+        Số lần gọi / lỗi quota / lỗi khác và trạng thái cooldown của từng client.
+        """
+        with self._lock:
+            now = time.monotonic()
+            return [dict(client.stats, client=client.label, cooling_down=client.cooldown_until > now)
+                    for client in self.clients]
+
+# --- CHUỖI MODEL DỰ PHÒNG (FALLBACK) ---
+OVERLOAD_COOLDOWN_SECONDS = 30 # Model trả 5xx / timeout bị bỏ qua trong thời gian này
+OVERLOAD_ERROR_CLASSES = ("quota", "server", "deadline")
+
+class ModelFallbackChain:
+    """
+    Các model theo thứ tự ưu tiên dùng như một model: request đi tới model đầu tiên không bị quá tải;
+    model trả 429 / 5xx / timeout bị bỏ qua trong cooldown (429: theo retry_delay nếu có) và request
+    được gửi ngay tới model tiếp theo. Chỉ ném lỗi khi mọi model đều lỗi.
+    An toàn khi gọi từ nhiều thread cùng lúc.
+    """
+    def __init__(self, models, cooldown_seconds=OVERLOAD_COOLDOWN_SECONDS):
+        self.models = list(models)
+        if not self.models:
+            raise ValueError("ModelFallbackChain needs at least one model")
+        self.cooldown_seconds = cooldown_seconds
+        # Dùng cho khóa cache phản hồi và log
+        self.model_name = " > ".join(model.model_name for model in self.models)
+        self._cooldown_until = [0.0] * len(self.models)
+        self._stats = [{"model": model.model_name, "calls": 0, "overloaded": 0} for model in self.models]
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __len__(self):
+        # Số client phía sau (ngân sách RPM/TPM của job tính theo model ưu tiên)
+        return len(self.models[0]) if isinstance(self.models[0], ClientPool) else 1
+
+    @property
+    def supports_response_schema(self):
+        return all(supports_response_schema(model) for model in self.models)
+
+    def _order(self):
+        # Model đang khỏe theo thứ tự ưu tiên, rồi các model đang cooldown (hết cooldown sớm nhất trước)
+        with self._lock:
+            now = time.monotonic()
+            healthy = [index for index, until in enumerate(self._cooldown_until) if until <= now]
+            cooling = sorted((index for index, until in enumerate(self._cooldown_until) if until > now),
+                             key=lambda index: self._cooldown_until[index])
+            return healthy + cooling
+
+    def _record(self, index, error=None):
+        with self._lock:
+            self._stats[index]["calls"] += 1
+            if error is None:
+                self._cooldown_until[index] = 0.0
+                self._local.label = getattr(self.models[index], "served_by", lambda: None)() or self.models[index].model_name
+                return
+            self._stats[index]["overloaded"] += 1
+            cooldown = retry_after_seconds(error) if is_quota_error(error) else None
+            self._cooldown_until[index] = time.monotonic() + (cooldown or self.cooldown_seconds)
+
+    def served_by(self):
+        """
+        Model (hoặc client của pool) đã phục vụ request gần nhất của thread hiện tại.
+        """
+        return getattr(self._local, "label", None)
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        if stream:
+            return self._stream(prompt, **kwargs)
+        last_error = None
+        for index in self._order():
+            try:
+                response = self.models[index].generate_content(prompt, **kwargs)
+            except Exception as e:
+                if classify_error(e) not in OVERLOAD_ERROR_CLASSES:
+                    raise
+                self._record(index, e)
+                last_error = e
+                continue
+            self._record(index)
+            return response
+        raise last_error
+
+    def _stream(self, prompt, **kwargs):
+        # Chỉ chuyển model nếu lỗi xảy ra trước đoạn đầu tiên
+        last_error = None
+        for index in self._order():
+            try:
+                chunks = iter(self.models[index].generate_content(prompt, stream=True, **kwargs))
+                first_chunk = next(chunks, None)
+            except Exception as e:
+                if classify_error(e) not in OVERLOAD_ERROR_CLASSES:
+                    raise
+                self._record(index, e)
+                last_error = e
+                continue
+            self._record(index)
+            if first_chunk is not None:
+                yield first_chunk
+            yield from chunks
+            return
+        raise last_error
+
+    def stats(self):
+        """
+        Số lần gọi / lần quá tải và trạng thái cooldown của từng model.
+        """
+        with self._lock:
+            now = time.monotonic()
+            return [dict(entry, cooling_down=until > now) for entry, until in zip(self._stats, self._cooldown_until)]
+
+# --- CHÍNH SÁCH RETRY (BACKOFF + CIRCUIT BREAKER) ---
+RETRY_MAX_ATTEMPTS = 4 # Tổng số lần gửi cho một request
+RETRY_BASE_DELAY_SECONDS = 1.0
+RETRY_MAX_DELAY_SECONDS = 60.0
+DEFAULT_RETRY_BUDGET = 30 # Tổng số lần retry cho cả job
+BREAKER_FAILURE_THRESHOLD = 5 # Số lỗi tạm thời liên tiếp trước khi ngắt mạch
+BREAKER_RESET_SECONDS = 30.0
+# Lỗi tạm thời: retry được và tính vào circuit breaker
+TRANSIENT_ERROR_CLASSES = ("quota", "server", "deadline", "unknown")
+RETRY_AFTER_REGEX = re.compile(r"retry(?:[ -]after| in)\D{0,3}(\d+(?:\.\d+)?)\s*s", re.IGNORECASE)
+
+CIRCUIT_OPEN_REASON = "circuit breaker open (API unavailable)"
+HEDGE_CANCELLED_REASON = "cancelled (another request for this batch finished first)"
+
+class CircuitOpenError(Exception):
+    """
+    Circuit breaker đang mở: request bị từ chối ngay, không gửi tới API.
+    """
+
+def classify_error(error):
+    """
+    Phân loại lỗi khi gọi API: "quota" (429), "deadline", "server" (5xx, mất kết nối),
+    "safety" (bị chặn bởi bộ lọc an toàn), "invalid" (4xx khác), "circuit_open" hoặc "unknown".
+    """
+    # Chỉ import khi có lỗi
+    from google.api_core import exceptions as google_exceptions
+    if isinstance(error, CircuitOpenError):
+        return "circuit_open"
+    if is_quota_error(error):
+        return "quota"
+    if isinstance(error, (google_exceptions.DeadlineExceeded, TimeoutError)):
+        return "deadline"
+    if isinstance(error, (google_exceptions.ServerError, ConnectionError)):
+        return "server"
+    error_type = type(error).__name__
+    # BlockedPromptException / StopCandidateException, hoặc response.text khi finish_reason là SAFETY
+    if error_type in ("BlockedPromptException", "StopCandidateException") or "SAFETY" in str(error):
+        return "safety"
+    if isinstance(error, google_exceptions.ClientError):
+        return "invalid"
+    return "unknown"
+
+def retry_after_seconds(error):
+    """
+    Thời gian chờ server gợi ý (retry_delay của Gemini, header Retry-After...), hoặc None.
+    """
+    match = RETRY_DELAY_REGEX.search(str(error))
+    if match:
+        return float(match.group(1))
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        pass
+    match = RETRY_AFTER_REGEX.search(str(error))
+    return float(match.group(1)) if match else None
+
+class CircuitBreaker:
+    """
+    Sau `failure_threshold` lỗi tạm thời liên tiếp, mạch "mở": mọi request bị từ chối ngay
+    trong `reset_seconds`; sau đó chỉ một request thử được đi qua ("nửa mở"), thành công thì
+    đóng mạch, lỗi thì mở lại. An toàn khi gọi từ nhiều thread cùng lúc.
+    """
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == "closed":
+                return
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+                # Cho một request thử đi qua
+                self.state = "half_open"
+                return
+            raise CircuitOpenError(f"circuit breaker open after {self.consecutive_failures} consecutive API failures")
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self.consecutive_failures >= self.failure_threshold):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+
+    def is_open(self):
+        with self._lock:
+            return self.state == "open" and time.monotonic() - self.opened_at < self.reset_seconds
+
+class RetryPolicy:
+    """
+    Chính sách retry dùng chung cho mọi lần gọi của một job: phân loại lỗi, chờ theo gợi ý
+    của server hoặc backoff lũy thừa có jitter, giới hạn tổng số retry của job (retry budget)
+    và circuit breaker để một sự cố kéo dài làm các lô lỗi ngay thay vì chờ từng lô.
+    """
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY_SECONDS,
+                 max_delay=RETRY_MAX_DELAY_SECONDS, retry_budget=DEFAULT_RETRY_BUDGET, breaker=None):
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_budget = retry_budget
+        self.breaker = breaker or CircuitBreaker()
+        self.stats = {"retries": 0, "budget_exhausted": 0}
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        self.breaker.before_call()
+
+    def record_success(self):
+        self.breaker.record_success()
+
+    def on_error(self, error, attempt):
+        """
+        Ghi nhận lỗi của lần gửi thứ `attempt` (bắt đầu từ 0); trả về (loại lỗi, số giây chờ
+        trước khi gửi lại), hoặc (loại lỗi, None) nếu không retry.
+        """
+        error_class = classify_error(error)
+        if error_class not in TRANSIENT_ERROR_CLASSES:
+            return error_class, None
+        self.breaker.record_failure()
+        if attempt + 1 >= self.max_attempts or self.breaker.is_open():
+            return error_class, None
+        with self._lock:
+            if self.retry_budget is not None and self.stats["retries"] >= self.retry_budget:
+                self.stats["budget_exhausted"] += 1
+                return error_class, None
+            self.stats["retries"] += 1
+        hint = retry_after_seconds(error)
+        if hint is not None:
+            # Theo gợi ý của server, cộng một chút jitter để các worker không gửi lại cùng lúc
+            return error_class, min(self.max_delay, hint + random.uniform(0, self.base_delay))
+        # Full jitter: ngẫu nhiên trong [0, base * 2^attempt]
+        return error_class, random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+# --- CACHE PHẢN HỒI TRÊN ĐĨA (THEO NỘI DUNG PROMPT) ---
+CACHE_DIR = os.environ.get("GEMINI_CACHE_DIR", ".gemini_cache")
+CACHE_MAX_ENTRIES = 2000
+CACHE_MAX_BYTES = 200 * 1024 * 1024 # 200 MB
+CACHE_MAX_AGE_SECONDS = 7 * 24 * 3600 # 7 ngày
+
+class ResponseCache:
+    """
+    Cache phản hồi AI trên đĩa, khóa = hash(model, prompt, is_json).
+    Mỗi entry là một file JSON; mtime của file dùng làm "lần dùng gần nhất" cho LRU.
+    Loại bỏ theo tuổi (max_age_seconds) và theo kích thước (max_entries / max_bytes).
+    """
+    def __init__(self, cache_dir=CACHE_DIR, max_entries=CACHE_MAX_ENTRIES,
+                 max_bytes=CACHE_MAX_BYTES, max_age_seconds=CACHE_MAX_AGE_SECONDS):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_name, prompt, is_json, response_schema=None):
+        # Schema chỉ thêm vào khóa khi có: khóa của các phản hồi cũ không đổi
+        parts = [model_name, prompt, bool(is_json)] + ([response_schema] if response_schema is not None else [])
+        payload = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        """
+        Trả về phản hồi đã cache, hoặc None nếu không có / đã hết hạn.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            if time.time() - entry.get("created_at", 0) > self.max_age_seconds:
+                os.remove(path)
+                raise FileNotFoundError(path)
+            os.utime(path, None) # Đánh dấu vừa được dùng (LRU)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return entry.get("response")
+
+    def put(self, key, response):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"created_at": time.time(), "response": response}, f, ensure_ascii=False)
+        os.replace(tmp_path, path) # Ghi nguyên tử: không bao giờ đọc phải file viết dở
+        self.evict()
+
+    def evict(self):
+        """
+        Xóa các entry hết hạn, sau đó xóa entry ít dùng nhất cho tới khi
+        nằm trong giới hạn số lượng và dung lượng.
+        """
+        with self._lock:
+            try:
+                names = [n for n in os.listdir(self.cache_dir) if n.endswith(".json")]
+            except OSError:
+                return
+            now = time.time()
+            entries = []
+            for name in names:
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                # mtime >= created_at, nên mtime quá cũ chắc chắn là đã hết hạn
+                if now - stat.st_mtime > self.max_age_seconds:
+                    self._remove(path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            entries.sort() # Cũ nhất trước
+            total_bytes = sum(size for _, size, _ in entries)
+            while entries and (len(entries) > self.max_entries or total_bytes > self.max_bytes):
+                _, size, path = entries.pop(0)
+                self._remove(path)
+                total_bytes -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self):
+        """
+        Số lần tra cache có / không có phản hồi của tiến trình này (mọi job), từ lúc khởi động.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+response_cache = ResponseCache()
+
+# --- [NEW] NHẬT KÝ JOB (CHECKPOINT / RESUME) ---
+JOURNAL_DIR = os.environ.get("JOB_JOURNAL_DIR", ".job_journal")
+
+class JobJournal:
+    """
+    Nhật ký append-only (JSONL) của một job, một file cho mỗi cặp (chủ đề, thời lượng).
+    Mỗi lần chạy mới ghi một bản ghi "run_start" với run_id riêng; sau đó ghi kịch bản,
+    consistency keys và các hàng của từng lô ngay khi chúng xong.
+    Khi resume, chỉ các bản ghi của lần chạy gần nhất được đọc lại.
+    """
+    def __init__(self, video_topic, video_duration_minutes, resume=False, journal_dir=JOURNAL_DIR):
+        payload = json.dumps([video_topic.strip(), int(video_duration_minutes)], ensure_ascii=False)
+        self.job_key = hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+        self.path = os.path.join(journal_dir, f"{self.job_key}.jsonl")
+        self.script = None
+        self.keys = None
+        self.rows = {} # Scene ID -> hàng OK đã tạo
+        self.run_id = None
+        self._lock = threading.Lock()
+        os.makedirs(journal_dir, exist_ok=True)
+
+        if resume:
+            self._load()
+        self.resumed = self.run_id is not None
+        if not self.resumed:
+            self.run_id = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+            self._append({"type": "run_start", "topic": video_topic, "duration": video_duration_minutes})
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except OSError:
+            return
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue # Dòng cuối bị ghi dở khi tiến trình chết giữa chừng
+            if record.get("type") == "run_start":
+                # Bắt đầu lại từ lần chạy mới hơn
+                self.run_id = record.get("run_id")
+                self.script, self.keys, self.rows = None, None, {}
+            elif record.get("run_id") != self.run_id:
+                continue
+            elif record.get("type") == "script":
+                self.script = record["text"] if record.get("complete", True) else None
+            elif record.get("type") == "keys":
+                self.keys = record["text"]
+            elif record.get("type") == "rows":
+                for row in record["rows"]:
+                    self.rows[row["Scene ID"]] = row
+        if self.script is None:
+            # Các hàng chỉ có nghĩa với đúng kịch bản đã tạo ra chúng
+            self.rows = {}
+
+    def _append(self, record):
+        record = dict(record, run_id=self.run_id, ts=time.time())
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def record_script(self, text, complete=True):
+        # Kịch bản dở dang (stream bị ngắt) chỉ được ghi lại để tra cứu: resume sẽ tạo lại kịch bản
+        self.script = text if complete else None
+        self._append({"type": "script", "text": text, "complete": complete})
+
+    def record_keys(self, text):
+        self.keys = text
+        self._append({"type": "keys", "text": text})
+
+    def record_rows(self, rows):
+        # Chỉ lưu các hàng OK; cảnh FAILED sẽ được tạo lại khi resume
+        ok_rows = [row for row in rows if row.get("Generation Status") == "OK"]
+        if ok_rows:
+            for row in ok_rows:
+                self.rows[row["Scene ID"]] = row
+            self._append({"type": "rows", "rows": ok_rows})
+
+# --- [NEW] THƯ VIỆN NHÂN VẬT / ĐỊA ĐIỂM DÙNG CHUNG GIỮA CÁC TẬP ---
+LIBRARY_PATH = os.environ.get("CONSISTENCY_LIBRARY_PATH", ".consistency_library.jsonl")
+LIBRARY_KINDS = ("CHARACTER", "LOCATION", "OBJECT")
+KEY_ENTRY_REGEX = re.compile(r"^\W*(CHARACTER|LOCATION|OBJECT)S?\s*\(([^)]+)\)[\s*:]*(.*)$", re.IGNORECASE)
+ERA_FIELD_REGEX = re.compile(r"\bEra\s*:\s*([^.(\n]+)", re.IGNORECASE)
+SPECIES_FIELD_REGEX = re.compile(r"\bSpecies\s*:\s*([^.(\n]+)", re.IGNORECASE)
+KEYWORD_REGEX = re.compile(r"[a-z]{4,}")
+KEYWORD_STOPWORDS = frozenset(("with", "from", "into", "that", "this", "their", "against", "over", "under",
+                               "life", "years", "million", "thousand", "episode", "part"))
+PROPER_NAME_REGEX = re.compile(r"\b[A-Z][a-z]{2,}\b")
+
+def parse_era_definition(text):
+    """
+    (era, species) từ section "Era Definition" (hoặc dòng ERA của keys-first); "" nếu không có.
+    """
+    def _field(regex):
+        match = regex.search(text or "")
+        return " ".join(match.group(1).strip(" '\"*`").split()) if match else ""
+    return _field(ERA_FIELD_REGEX), _field(SPECIES_FIELD_REGEX)
+
+def parse_consistency_entries(keys_text):
+    """
+    Các entry {kind, name, description} trong text consistency keys dạng "- CHARACTER (Kael): ...";
+    dòng tiếp theo không bắt đầu entry mới được nối vào mô tả của entry trước.
+    """
+    entries = []
+    for line in (keys_text or "").splitlines():
+        line = line.strip()
+        match = KEY_ENTRY_REGEX.match(line)
+        if match:
+            entries.append({"kind": match.group(1).upper(), "name": " ".join(match.group(2).split()),
+                            "description": match.group(3).strip()})
+        elif entries and line and not line.startswith(("-", "#", "*")):
+            entries[-1]["description"] = f"{entries[-1]['description']} {line}".strip()
+    return entries
+
+def format_consistency_keys(entries, era="", species=""):
+    """
+    Text consistency keys cho Step 4 theo thứ tự cố định (loại, tên): cùng thư viện -> cùng text,
+    prompt Step 4 ổn định giữa các tập.
+    """
+    ordered = sorted(entries, key=lambda entry: (LIBRARY_KINDS.index(entry["kind"]), entry["name"].lower()))
+    lines = [f"- ERA: {era}. Species: {species}"] if era or species else []
+    lines += [f"- {entry['kind']} ({entry['name']}): {entry['description']}" for entry in ordered]
+    return "\n".join(lines)
+
+def topic_keywords(*texts):
+    words = set()
+    for text in texts:
+        words.update(KEYWORD_REGEX.findall((text or "").lower()))
+    return words - KEYWORD_STOPWORDS
+
+def entity_mentioned(entry, text):
+    # So khớp theo tên (bỏ "the" ở đầu: "the frozen river" khớp "across the frozen river")
+    name = re.sub(r"^the\s+", "", entry["name"].lower())
+    return re.search(rf"\b{re.escape(name)}\b", text.lower()) is not None
+
+def scene_is_covered(description, entries):
+    """
+    Cảnh đã được thư viện bao phủ: nhắc tới ít nhất một entry và không có tên riêng nào (chữ hoa
+    giữa câu) ngoài tên đã biết. Cảnh chưa được bao phủ mới được gửi cho AI ở Step 3.
+    """
+    if not any(entity_mentioned(entry, description) for entry in entries):
+        return False
+    known_words = {word for entry in entries for word in entry["name"].lower().split()}
+    for match in PROPER_NAME_REGEX.finditer(description):
+        if match.start() == 0 or description[:match.start()].rstrip().endswith((".", "!", "?", ":")):
+            continue # Chữ hoa đầu câu
+        if match.group(0).lower() not in known_words:
+            return False
+    return True
+
+class ConsistencyLibrary:
+    """
+    Thư viện consistency keys (nhân vật, địa điểm, đồ vật) dùng lại giữa các tập của một series.
+    File JSONL append-only, mỗi dòng một entry gắn era / species (từ "# Era Definition") và từ khóa
+    của chủ đề đã tạo ra nó; chỉ mục trong bộ nhớ theo era. Định nghĩa đầu tiên của một tên được giữ,
+    và file được đọc lại khi tiến trình khác (CLI nhiều tiến trình) ghi thêm.
+    """
+    def __init__(self, path=LIBRARY_PATH):
+        self.path = path
+        self._entries = {} # (era_key, kind, tên) -> entry
+        self._by_era = {} # era_key -> [entry]
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def era_key(era, species):
+        return " | ".join(" ".join(part.lower().split()) for part in (era, species))
+
+    def _refresh(self):
+        # Gọi khi đang giữ lock
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+        self._mtime = mtime
+        self._entries, self._by_era = {}, {}
+        for line in lines:
+            try:
+                self._index(json.loads(line))
+            except (ValueError, KeyError):
+                continue # Dòng cuối bị ghi dở
+
+    def _index(self, entry):
+        key = (entry["era_key"], entry["kind"], entry["name"].lower())
+        if key in self._entries:
+            return False
+        self._entries[key] = entry
+        self._by_era.setdefault(entry["era_key"], []).append(entry)
+        return True
+
+    def lookup(self, era="", species="", keywords=()):
+        """
+        Các entry của đúng era / species; khi chưa biết era (keys-first), các entry có từ khóa
+        chung với `keywords` (từ khóa của chủ đề).
+        """
+        with self._lock:
+            self._refresh()
+            if era or species:
+                return list(self._by_era.get(self.era_key(era, species), []))
+            keywords = set(keywords)
+            return [entry for entries in self._by_era.values() for entry in entries
+                    if keywords & set(entry.get("tags", ()))]
+
+    def add(self, entries, era="", species="", topic=""):
+        """
+        Ghi các entry mới (tên đã có trong cùng era bị bỏ qua); trả về list entry đã ghi.
+        """
+        era_key = self.era_key(era, species)
+        tags = sorted(topic_keywords(topic))
+        added = []
+        with self._lock:
+            self._refresh()
+            for entry in entries:
+                record = {"kind": entry["kind"], "name": entry["name"], "description": entry["description"],
+                          "era": era, "species": species, "era_key": era_key, "tags": tags, "topic": topic,
+                          "created_at": time.time()}
+                if self._index(record):
+                    added.append(record)
+            if added:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in added))
+                    f.flush()
+                    os.fsync(f.fileno())
+        return added
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._entries)
+
+consistency_library = ConsistencyLibrary()
+
+def estimate_tokens(text):
+    """
+    Ước lượng số token (~4 ký tự / token) để trừ vào bucket TPM.
+    """
+    return max(1, len(text or "") // 4)
+
+# --- [NEW] ĐẾM TOKEN THEO TỪNG LẦN GỌI ---
+class TokenUsageTracker:
+    """
+    Ghi lại số token prompt / phản hồi (từ response.usage_metadata) của từng lần gọi API,
+    kèm các chi tiết khác của lần gọi (thời gian, retry, kết quả...) nếu có.
+    """
+    COUNTERS = ("prompt_tokens", "response_tokens", "cached_tokens", "prefix_tokens_saved")
+
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+        self._local = threading.local() # Lần gọi gần nhất của mỗi thread (xem annotate_last_call)
+
+    def record(self, stage, usage_metadata, prefix_tokens_saved=0, **details):
+        entry = {
+            "stage": stage,
+            "prompt_tokens": getattr(usage_metadata, "prompt_token_count", 0) or 0,
+            "response_tokens": getattr(usage_metadata, "candidates_token_count", 0) or 0,
+            "cached_tokens": getattr(usage_metadata, "cached_content_token_count", 0) or 0,
+            "prefix_tokens_saved": prefix_tokens_saved,
+            **details,
+        }
+        with self._lock:
+            self.calls.append(entry)
+        self._local.last_call = entry
+        return entry
+
+    def annotate_last_call(self, **details):
+        """
+        Thêm thông tin cho lần gọi gần nhất của thread hiện tại (ví dụ kết quả parse JSON).
+        """
+        entry = getattr(self._local, "last_call", None)
+        if entry is not None:
+            with self._lock:
+                entry.update(details)
+
+    def summary(self):
+        """
+        Tổng số lần gọi API và token theo từng bước (theo thứ tự xuất hiện).
+        Lần "gọi" trả về từ response cache được đếm riêng (cache_hits).
+        """
+        totals = {}
+        with self._lock:
+            for entry in self.calls:
+                stage_total = totals.setdefault(entry["stage"], dict.fromkeys(("calls", "cache_hits") + self.COUNTERS, 0))
+                if entry.get("cache_hit"):
+                    stage_total["cache_hits"] += 1
+                    continue
+                stage_total["calls"] += 1
+                for counter in self.COUNTERS:
+                    stage_total[counter] += entry[counter]
+        return [{"stage": stage, **stage_total} for stage, stage_total in totals.items()]
+
+def percentile(values, fraction):
+    """
+    Percentile kiểu nearest-rank (0 < fraction <= 1); None nếu không có giá trị.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+class RunTracer(TokenUsageTracker):
+    """
+    Trace của một lần chạy: thời gian từng bước / từng lô (span) và chi tiết từng lần gọi API
+    (chờ limiter, thời gian gọi, retry, token, kết quả parse). to_json() để so sánh giữa các lần chạy.
+    """
+    def __init__(self, **meta):
+        super().__init__()
+        self.meta = meta
+        self.spans = []
+        self.started_at = time.time()
+        self._start = time.monotonic()
+
+    def elapsed(self):
+        return time.monotonic() - self._start
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """
+        Đo thời gian một bước: `with tracer.span("step1_script"): ...`
+        """
+        start = self.elapsed()
+        try:
+            yield
+        finally:
+            entry = {"name": name, "start": round(start, 3), "seconds": round(self.elapsed() - start, 3), **attributes}
+            with self._lock:
+                self.spans.append(entry)
+
+    def run_summary(self, scenes_generated=0):
+        """
+        Chỉ số tổng hợp của lần chạy: thời gian, p50/p95 latency, thời gian chờ, retry, token, cảnh/phút.
+        """
+        with self._lock:
+            calls = [dict(entry) for entry in self.calls]
+            spans = [dict(entry) for entry in self.spans]
+        api_calls = [entry for entry in calls if not entry.get("cache_hit")]
+        total_seconds = self.elapsed()
+
+        def _latency(entries):
+            latencies = [entry.get("wall_seconds", 0.0) for entry in entries]
+            return percentile(latencies, 0.5), percentile(latencies, 0.95)
+
+        stages = []
+        for stage in dict.fromkeys(entry["stage"] for entry in calls):
+            stage_calls = [entry for entry in api_calls if entry["stage"] == stage]
+            p50, p95 = _latency(stage_calls)
+            stages.append({
+                "stage": stage,
+                # Model của stage (nhiều model nếu có fallback / pool)
+                "models": sorted({entry["model"] for entry in calls if entry["stage"] == stage and entry.get("model")}),
+                "calls": len(stage_calls),
+                "cache_hits": sum(1 for entry in calls if entry["stage"] == stage and entry.get("cache_hit")),
+                "p50_seconds": p50,
+                "p95_seconds": p95,
+                "queue_seconds": round(sum(entry.get("queue_seconds", 0.0) for entry in stage_calls), 3),
+                "retries": sum(entry.get("retries", 0) for entry in stage_calls),
+                "prompt_tokens": sum(entry["prompt_tokens"] for entry in stage_calls),
+                "response_tokens": sum(entry["response_tokens"] for entry in stage_calls),
+            })
+        p50, p95 = _latency(api_calls)
+        return {
+            "total_seconds": round(total_seconds, 3),
+            "scenes": scenes_generated,
+            "scenes_per_minute": round(scenes_generated * 60.0 / total_seconds, 2) if total_seconds > 0 else None,
+            "api_calls": len(api_calls),
+            "cache_hits": len(calls) - len(api_calls),
+            "cache_misses": sum(1 for entry in api_calls if entry.get("cache_miss")),
+            "p50_call_seconds": p50,
+            "p95_call_seconds": p95,
+            "queue_seconds": round(sum(entry.get("queue_seconds", 0.0) for entry in api_calls), 3),
+            "retry_sleep_seconds": round(sum(entry.get("retry_sleep_seconds", 0.0) for entry in api_calls), 3),
+            "retries": sum(entry.get("retries", 0) for entry in api_calls),
+            "prompt_tokens": sum(entry["prompt_tokens"] for entry in api_calls),
+            "response_tokens": sum(entry["response_tokens"] for entry in api_calls),
+            "stage_seconds": {entry["name"]: entry["seconds"] for entry in spans if not entry["name"].endswith("_batch")},
+            "stages": stages,
+            "hedging": self.meta.get("hedging"),
+            "stage_models": self.meta.get("stage_models"),
+        }
+
+    def to_json(self, scenes_generated=0):
+        """
+        Trace đầy đủ (meta, tổng hợp, spans, từng lần gọi) dạng JSON.
+        """
+        with self._lock:
+            calls = [dict(entry) for entry in self.calls]
+            spans = [dict(entry) for entry in self.spans]
+        trace = {
+            "meta": {**self.meta, "started_at": datetime.datetime.fromtimestamp(self.started_at).isoformat(timespec="seconds")},
+            "summary": self.run_summary(scenes_generated),
+            "spans": spans,
+            "calls": calls,
+        }
+        return json.dumps(trace, ensure_ascii=False, indent=2, default=str)
+
+# --- [NEW] PHẦN PROMPT TĨNH DÙNG CHUNG (PREFIX) ---
+# Context caching cần tên model có version cố định (vd. models/gemini-1.5-flash-002), không nhận "-latest"
+VERSIONED_MODEL_REGEX = re.compile(r"-\d{3}$")
+CONTEXT_CACHE_MIN_TOKENS = 32768 # Ngưỡng tối thiểu của API để tạo context cache
+CONTEXT_CACHE_TTL_SECONDS = 3600
+
+def compact_prompt_text(text):
+    """
+    Bỏ thụt đầu dòng và dòng trống thừa trong prompt (chỉ tốn token, không thêm nội dung).
+    """
+    lines = [line.strip() for line in text.strip().splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines))
+
+def compact_json_template(json_template_string):
+    """
+    Template JSON dạng một dòng, không khoảng trắng thừa. Giá trị chuỗi
+    (ví dụ negative_prompt) được giữ nguyên từng ký tự.
+    """
+    try:
+        return json.dumps(json.loads(json_template_string), ensure_ascii=False, separators=(",", ":"))
+    except json.JSONDecodeError:
+        return compact_prompt_text(json_template_string)
+
+class PromptPrefix:
+    """
+    Phần prompt tĩnh (template, consistency keys, hướng dẫn) được tạo một lần cho mỗi tập
+    và dùng lại cho mọi lần gọi Step 4. Nếu đủ dài, prefix được đưa vào context cache
+    của API và mỗi lần gọi chỉ gửi phần riêng của lô; nếu không thì gửi bản đã rút gọn.
+    """
+    def __init__(self, text, original_text=None, cached_content=None, cached_model=None):
+        self.text = text
+        self.cached_content = cached_content
+        self.cached_model = cached_model
+        # Token tiết kiệm được mỗi lần gọi nhờ rút gọn (ước lượng)
+        self.tokens_saved = max(0, estimate_tokens(original_text) - estimate_tokens(text)) if original_text else 0
+
+    @classmethod
+    def build(cls, original_text, use_context_cache=True, log=None):
+        log = log or _print_log
+        text = compact_prompt_text(original_text)
+        # Context cache chỉ có trên API thật (không dùng với backend giả lập, pool hay chuỗi fallback),
+        # và được tạo cho đúng model đang dùng ở Step 4
+        json_model = model_for_stage("step4_json")
+        if (use_context_cache and is_genai_model(json_model)
+                and estimate_tokens(text) >= CONTEXT_CACHE_MIN_TOKENS):
+            if not VERSIONED_MODEL_REGEX.search(json_model.model_name):
+                log("info", f"   ... Context caching needs a versioned model name (e.g. gemini-1.5-flash-002), "
+                            f"not {json_model.model_name}. Sending the compacted prefix with each call.")
+                return cls(text, original_text)
+            try:
+                from google.generativeai import caching as genai_caching
+                cached_content = genai_caching.CachedContent.create(
+                    model=json_model.model_name, contents=[text],
+                    ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL_SECONDS)
+                )
+                cached_model = _genai().GenerativeModel.from_cached_content(cached_content=cached_content)
+                log("info", f"   ... Shared prompt prefix stored in API context cache (~{estimate_tokens(text)} tokens).")
+                return cls(text, original_text, cached_content, cached_model)
+            except Exception as e:
+                log("warning", f"   ! Context caching unavailable ({e}). Sending the compacted prefix with each call.")
+        return cls(text, original_text)
+
+    def release(self):
+        """
+        Xóa context cache trên server (nếu có) khi job kết thúc.
+        """
+        if self.cached_content is not None:
+            try:
+                self.cached_content.delete()
+            except Exception:
+                pass
+            self.cached_content = None
+            self.cached_model = None
+
+def _print_log(level, message):
+    """
+    Logger mặc định khi không có reporter: in ra console.
+    """
+    print(f"[{level.upper()}] {message}")
+
+# --- [NEW] PARSER JSON "CỨU DỮ LIỆU" CHO PHẢN HỒI BỊ CẮT ---
+JSON_FENCE_REGEX = re.compile(r"```(?:json)?\s*(.*?)\s*(?:```|$)", re.DOTALL | re.IGNORECASE)
+
+def strip_json_fence(text_response):
+    """
+    Bỏ ```json ... ``` bao quanh phản hồi, kể cả khi AI thêm text phía sau
+    hoặc phản hồi bị cắt trước dấu ``` đóng.
+    """
+    match = JSON_FENCE_REGEX.search(text_response)
+    if match:
+        return match.group(1).strip()
+    return text_response.strip()
+
+class JsonListSalvager:
+    """
+    Parser tăng dần cho một JSON list có thể bị cắt cụt hoặc bọc trong ```json ... ```.
+    `feed()` nhận từng đoạn text và trả về các object top-level vừa hoàn chỉnh dạng
+    (index, object); index là vị trí của phần tử trong list (= vị trí cảnh trong lô).
+    Text trước dấu '[' / '{' đầu tiên và sau dấu ']' cuối được bỏ qua.
+    """
+    def __init__(self):
+        self._text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._top_level = None # '[' hoặc '{'
+        self._element_start = None
+        self._element_index = 0
+        self.complete = False # Đã gặp dấu đóng của giá trị top-level
+        self.objects = {} # index -> object
+        self.malformed = [] # index các phần tử hoàn chỉnh nhưng không parse được
+
+    def feed(self, chunk):
+        self._text += chunk
+        completed = []
+        text = self._text
+        while self._pos < len(text) and not self.complete:
+            ch = text[self._pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif self._top_level is None:
+                if ch in "[{":
+                    self._top_level = ch
+                    self._depth = 1
+                    if ch == "{":
+                        self._element_start = self._pos
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "[{":
+                if self._depth == 1 and self._top_level == "[" and ch == "{":
+                    self._element_start = self._pos
+                self._depth += 1
+            elif ch in "]}":
+                self._depth -= 1
+                # Object nằm trực tiếp trong list vừa đóng (hoặc object top-level)
+                element_closed = self._element_start is not None and (
+                    (self._top_level == "[" and self._depth == 1) or (self._top_level == "{" and self._depth == 0)
+                )
+                if element_closed:
+                    element_text = text[self._element_start:self._pos + 1]
+                    try:
+                        obj = json.loads(element_text)
+                        self.objects[self._element_index] = obj
+                        completed.append((self._element_index, obj))
+                    except json.JSONDecodeError:
+                        self.malformed.append(self._element_index)
+                    self._element_index += 1
+                    self._element_start = None
+                if self._depth == 0:
+                    self.complete = True
+            self._pos += 1
+        return completed
+
+def salvage_json_list(text_response):
+    """
+    Trích xuất mọi object top-level hoàn chỉnh từ một JSON list (có thể bị cắt / có fence).
+    Trả về (objects_by_index, complete, malformed_indices).
+    """
+    salvager = JsonListSalvager()
+    salvager.feed(text_response)
+    return salvager.objects, salvager.complete, salvager.malformed
+
+# --- [NEW] STRUCTURED OUTPUT: RESPONSE SCHEMA VÀ KIỂM TRA OBJECT THEO TEMPLATE ---
+EXACT_TEMPLATE_FIELDS = ("negative_prompt",) # Phải giữ nguyên từng ký tự như trong template
+# Được phép rỗng: cảnh không có nhân vật / không có hiệu ứng âm thanh; trường có "(if any" trong template cũng vậy
+OPTIONAL_TEMPLATE_FIELDS = ("2. CHARACTERS_AND_ACTIONS", "sound_effects")
+OPTIONAL_TEMPLATE_MARKER = "(if any"
+SCHEMA_TYPES = {str: "STRING", bool: "BOOLEAN", int: "INTEGER", float: "NUMBER"}
+_MISSING = object()
+
+def supports_response_schema(backend):
+    """
+    Backend nhận generation_config với response_schema (structured output): model genai, hoặc
+    backend khai báo `supports_response_schema = True` (fake_llm, ClientPool của các model đó).
+    """
+    return is_genai_model(backend) or bool(getattr(backend, "supports_response_schema", False))
+
+def template_to_schema(value):
+    """
+    Response schema (dạng Schema của API Gemini) suy ra từ một giá trị mẫu của template:
+    dict -> OBJECT với mọi key bắt buộc, list -> ARRAY theo phần tử đầu, còn lại theo kiểu giá trị.
+    """
+    if isinstance(value, dict):
+        return {"type": "OBJECT", "properties": {key: template_to_schema(child) for key, child in value.items()},
+                "required": list(value)}
+    if isinstance(value, list):
+        return {"type": "ARRAY", "items": template_to_schema(value[0] if value else "")}
+    return {"type": SCHEMA_TYPES.get(type(value), "STRING")}
+
+class TemplateValidator:
+    """
+    Kiểm tra object JSON theo template. Template được "biên dịch" một lần thành danh sách phẳng
+    (đường dẫn, kiểu, giá trị bắt buộc); validate() chỉ duyệt danh sách đó.
+    Lỗi: thiếu key, sai kiểu, chuỗi / list / object rỗng (trừ trường tùy chọn, xem OPTIONAL_TEMPLATE_FIELDS),
+    trường EXACT_TEMPLATE_FIELDS khác template.
+    """
+    def __init__(self, template):
+        # (đường dẫn, kiểu, giá trị bắt buộc hoặc None, không được rỗng); "*" = mọi phần tử của list
+        self.checks = []
+        self._compile(template, ())
+
+    def _compile(self, value, path):
+        non_empty = not (path and path[-1] in OPTIONAL_TEMPLATE_FIELDS)
+        if isinstance(value, dict):
+            self.checks.append((path, dict, None, non_empty))
+            for key, child in value.items():
+                self._compile(child, path + (key,))
+        elif isinstance(value, list):
+            self.checks.append((path, list, None, non_empty))
+            if value:
+                self._compile(value[0], path + ("*",))
+        else:
+            expected_type = (int, float) if isinstance(value, (int, float)) and not isinstance(value, bool) else type(value)
+            exact = value if path and path[-1] in EXACT_TEMPLATE_FIELDS else None
+            non_empty = non_empty and not (isinstance(value, str) and OPTIONAL_TEMPLATE_MARKER in value.lower())
+            self.checks.append((path, expected_type, exact, non_empty))
+
+    @classmethod
+    def _resolve(cls, obj, path, label=""):
+        # (nhãn, giá trị) tại `path`; chỉ key cuối có thể là _MISSING (key cha thiếu do check của cha báo)
+        if not path:
+            yield label or "object", obj
+            return
+        key = path[0]
+        if key == "*":
+            if isinstance(obj, list):
+                for i, item in enumerate(obj):
+                    yield from cls._resolve(item, path[1:], f"{label}[{i}]")
+            return
+        if not isinstance(obj, dict):
+            return
+        name = f"{label}.{key}" if label else key
+        if key in obj:
+            yield from cls._resolve(obj[key], path[1:], name)
+        elif len(path) == 1:
+            yield name, _MISSING
+
+    def validate(self, obj):
+        """
+        Danh sách lỗi của `obj` (rỗng nếu hợp lệ).
+        """
+        problems = []
+        for path, expected_type, exact, non_empty in self.checks:
+            for label, value in self._resolve(obj, path):
+                if value is _MISSING:
+                    problems.append(f"missing {label}")
+                elif not isinstance(value, expected_type) or (isinstance(value, bool) and expected_type is not bool):
+                    problems.append(f"wrong type for {label}")
+                elif exact is not None and value != exact:
+                    problems.append(f"{label} differs from the template")
+                elif non_empty and isinstance(value, (str, list, dict)) and not (value.strip() if isinstance(value, str) else value):
+                    problems.append(f"empty {label}")
+        return problems
+
+@functools.lru_cache(maxsize=8)
+def get_json_contract(json_template_string):
+    """
+    (response_schema, validator) cho một template Step 4, tạo một lần cho mỗi template;
+    (None, None) nếu template không phải JSON hợp lệ.
+    """
+    try:
+        template = json.loads(json_template_string)
+    except json.JSONDecodeError:
+        return None, None
+    return {"type": "ARRAY", "items": template_to_schema(template)}, TemplateValidator(template)
+
+def call_gemini_api(prompt, is_json=False, limiter=None, log=None, refresh_cache=False,
+                    prompt_prefix=None, usage=None, stage="api", retry_policy=None, response_schema=None,
+                    cache_if=None):
+    """
+    Helper function to call the API and handle errors.
+    `limiter`: TokenBucketLimiter dùng chung (thay cho time.sleep cố định).
+    `log`: hàm log(level, message); các worker thread truyền vào hàm riêng vì
+    reporter của UI chỉ được gọi từ thread chính.
+    `refresh_cache`: bỏ qua cache khi đọc (vẫn ghi kết quả mới vào cache).
+    `prompt_prefix`: PromptPrefix dùng chung, đặt trước `prompt` (hoặc lấy từ context cache).
+    `usage`: TokenUsageTracker / RunTracer nhận số token và thời gian của lần gọi, ghi theo `stage`.
+    `retry_policy`: RetryPolicy dùng chung của job (retry budget, circuit breaker); mặc định một
+    RetryPolicy riêng cho lần gọi này.
+    `response_schema`: với is_json, dùng structured output của API (response_mime_type JSON + schema)
+    nếu backend hỗ trợ, thay cho câu dặn "chỉ trả về JSON" trong prompt.
+    `cache_if(text)`: chỉ ghi phản hồi mới vào cache khi hàm trả về True (phản hồi đã được caller kiểm tra,
+    ví dụ JSON đầy đủ); mặc định mọi phản hồi khác rỗng.
+    Model được chọn theo `stage` (model_for_stage: route của run_episode, mặc định model của configure()).
+    """
+    log = log or _print_log
+    retry_policy = retry_policy or RetryPolicy()
+    start_time = time.monotonic()
+
+    routed_model = model_for_stage(stage)
+    generation_model = routed_model
+    if prompt_prefix is not None:
+        # Khóa cache luôn dựa trên prompt đầy đủ, dù prefix có nằm trong context cache hay không
+        cache_prompt = f"{prompt_prefix.text}\n\n{prompt}"
+        if prompt_prefix.cached_model is not None:
+            generation_model = prompt_prefix.cached_model
+        else:
+            prompt = cache_prompt
+    else:
+        cache_prompt = prompt
+
+    if not (is_json and supports_response_schema(generation_model)):
+        response_schema = None
+    generate_kwargs = {"generation_config": {"response_mime_type": "application/json",
+                                             "response_schema": response_schema}} if response_schema else {}
+
+    cache_key = ResponseCache.make_key(routed_model.model_name, cache_prompt, is_json, response_schema)
+    if not refresh_cache:
+        cached_response = response_cache.get(cache_key)
+        if cached_response is not None:
+            log("info", f"   ... ⚡ Using cached AI response (Model: {routed_model.model_name})")
+            if usage is not None:
+                usage.record(stage, None, cache_hit=True, outcome="cached",
+                             wall_seconds=round(time.monotonic() - start_time, 3), model=routed_model.model_name)
+            return cached_response
+
+    log("info", f"   ... 🤖 Sending request to AI (Model: {routed_model.model_name})...")
+
+    if is_json and response_schema is None:
+        prompt_full = f"{prompt}\n\nPlease respond with only a valid JSON string (or a JSON list). Do not add any other text, explanations, or markdown."
+    else:
+        prompt_full = prompt
+
+    # Số liệu cho trace: thời gian chờ limiter, số lần retry, thời gian sleep trước khi retry
+    # cache_miss: đã tra response cache mà không có (không tính khi refresh_cache bỏ qua cache)
+    trace = {"queue_seconds": 0.0, "retries": 0, "retry_sleep_seconds": 0.0, "cache_miss": not refresh_cache}
+
+    def _generate():
+        retry_policy.before_call()
+        if limiter is not None:
+            trace["queue_seconds"] += limiter.acquire(estimate_tokens(prompt_full))
+        response = generation_model.generate_content(prompt_full, **generate_kwargs)
+        trace["usage_metadata"] = getattr(response, "usage_metadata", None)
+        # ClientPool: key / model đã phục vụ request này
+        if hasattr(generation_model, "served_by"):
+            trace["client"] = generation_model.served_by()
+        text_response = response.text.strip()
+        if is_json:
+            text_response = strip_json_fence(text_response) # Remove ```json and ```
+        return text_response
+
+    def _record(outcome):
+        if usage is not None:
+            usage.record(stage, trace.pop("usage_metadata", None),
+                         prompt_prefix.tokens_saved if prompt_prefix is not None else 0,
+                         outcome=outcome, wall_seconds=round(time.monotonic() - start_time, 3),
+                         queue_seconds=round(trace["queue_seconds"], 3), retries=trace["retries"],
+                         retry_sleep_seconds=round(trace["retry_sleep_seconds"], 3), client=trace.get("client"),
+                         model=routed_model.model_name, cache_miss=trace["cache_miss"])
+
+    attempt = 0
+    while True:
+        try:
+            text_response = _generate()
+            retry_policy.record_success()
+            break
+        except Exception as e:
+            error_class, delay = retry_policy.on_error(e, attempt)
+            if delay is None:
+                log("error", f"   --- 😥 Error calling API ({error_class}): {e}. Skipping this step. ---")
+                _record(f"error ({error_class}): {e}")
+                return None # Return None on failure
+            log("warning", f"   --- 😥 Error calling API ({error_class}): {e} ---")
+            log("warning", f"   --- Will retry in {delay:.1f} seconds (attempt {attempt + 2}/{retry_policy.max_attempts}) ---")
+            trace["retries"] += 1
+            sleep_start = time.monotonic()
+            time.sleep(delay)
+            trace["retry_sleep_seconds"] += time.monotonic() - sleep_start
+            attempt += 1
+
+    _record("ok" if text_response else "empty")
+
+    if text_response and (cache_if is None or cache_if(text_response)):
+        try:
+            response_cache.put(cache_key, text_response)
+        except OSError as e:
+            log("warning", f"   ! Could not write response cache: {e}")
+    return text_response
+
+def stream_gemini_api(prompt, limiter=None, log=None, refresh_cache=False, usage=None, stage="api",
+                      retry_policy=None, cache_if=None):
+    """
+    Giống call_gemini_api (text, không JSON) nhưng là generator trả về từng đoạn text
+    ngay khi AI gửi tới (stream=True). Phản hồi đã cache được trả về trong một đoạn duy nhất.
+    Chỉ retry khi chưa nhận được đoạn nào. Giá trị return của generator (StopIteration.value) là True
+    khi phản hồi đầy đủ, False khi stream bị ngắt giữa chừng hoặc lỗi.
+    `cache_if`: như call_gemini_api (chỉ xét phản hồi đầy đủ).
+    """
+    log = log or _print_log
+    retry_policy = retry_policy or RetryPolicy()
+    start_time = time.monotonic()
+
+    routed_model = model_for_stage(stage)
+    cache_key = ResponseCache.make_key(routed_model.model_name, prompt, False)
+    if not refresh_cache:
+        cached_response = response_cache.get(cache_key)
+        if cached_response is not None:
+            log("info", f"   ... ⚡ Using cached AI response (Model: {routed_model.model_name})")
+            if usage is not None:
+                usage.record(stage, None, cache_hit=True, outcome="cached",
+                             wall_seconds=round(time.monotonic() - start_time, 3), model=routed_model.model_name)
+            yield cached_response
+            return True
+
+    log("info", f"   ... 🤖 Streaming request to AI (Model: {routed_model.model_name})...")
+
+    chunks = []
+    completed = False
+    usage_metadata = None
+    outcome = "ok"
+    trace = {"queue_seconds": 0.0, "retries": 0, "retry_sleep_seconds": 0.0, "first_chunk_seconds": None,
+             "cache_miss": not refresh_cache}
+    attempt = 0
+    while True:
+        try:
+            retry_policy.before_call()
+            if limiter is not None:
+                trace["queue_seconds"] += limiter.acquire(estimate_tokens(prompt))
+            for chunk in routed_model.generate_content(prompt, stream=True):
+                # usage_metadata của đoạn cuối chứa tổng số token của cả phản hồi
+                usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+                if trace["first_chunk_seconds"] is None:
+                    trace["first_chunk_seconds"] = round(time.monotonic() - start_time, 3)
+                chunks.append(chunk.text)
+                yield chunk.text
+            completed = True
+            retry_policy.record_success()
+            if hasattr(routed_model, "served_by"):
+                trace["client"] = routed_model.served_by()
+            break
+        except Exception as e:
+            error_class, delay = retry_policy.on_error(e, attempt)
+            if chunks:
+                # Phần đầu đã được gửi cho caller -> không thể retry lại từ đầu
+                log("error", f"   --- 😥 Stream interrupted ({error_class}): {e}. Keeping the partial response. ---")
+                outcome = f"interrupted ({error_class}): {e}"
+                break
+            if delay is None:
+                log("error", f"   --- 😥 Error calling API ({error_class}): {e}. Skipping this step. ---")
+                outcome = f"error ({error_class}): {e}"
+                break
+            log("warning", f"   --- 😥 Error calling API ({error_class}): {e} ---")
+            log("warning", f"   --- Will retry in {delay:.1f} seconds (attempt {attempt + 2}/{retry_policy.max_attempts}) ---")
+            trace["retries"] += 1
+            sleep_start = time.monotonic()
+            time.sleep(delay)
+            trace["retry_sleep_seconds"] += time.monotonic() - sleep_start
+            attempt += 1
+
+    if usage is not None:
+        # wall_seconds gồm cả thời gian caller xử lý từng đoạn (stream được tiêu thụ song song)
+        usage.record(stage, usage_metadata, outcome=outcome, wall_seconds=round(time.monotonic() - start_time, 3),
+                     queue_seconds=round(trace["queue_seconds"], 3), retries=trace["retries"],
+                     retry_sleep_seconds=round(trace["retry_sleep_seconds"], 3),
+                     first_chunk_seconds=trace["first_chunk_seconds"], client=trace.get("client"),
+                     model=routed_model.model_name, cache_miss=trace["cache_miss"])
+
+    # Chỉ cache phản hồi đầy đủ
+    text_response = "".join(chunks).strip()
+    if completed and text_response and (cache_if is None or cache_if(text_response)):
+        try:
+            response_cache.put(cache_key, text_response)
+        except OSError as e:
+            log("warning", f"   ! Could not write response cache: {e}")
+    return completed
+
+# --- [NEW] PHÂN TÍCH KỊCH BẢN MỘT LƯỢT (SECTION INDEX + BẢNG) ---
+# Tên heading trong kịch bản -> khóa trong dict kết quả
+SCRIPT_SECTIONS = {
+    "title": "title",
+    "description": "description",
+    "hashtags": "hashtags",
+    "era definition": "era_definition",
+    "script": "script",
+    "thumbnail prompts": "thumbnail_prompts",
+    "keywords": "keywords",
+    "cta": "cta",
+}
+SECTION_DEFAULTS = {
+    "title": "Title Not Found",
+    "description": "Description Not Found",
+    "hashtags": "#hashtags #not #found",
+    "era_definition": "Era Definition Not Found",
+    "thumbnail_prompts": "Thumbnails Not Found",
+    "keywords": "Keywords Not Found",
+    "cta": "CTA Not Found",
+}
+# Cột của bảng cảnh, theo thứ tự mặc định (khi bảng không có header), và các từ khóa nhận diện header
+TABLE_FIELDS = ("timecode", "description", "camera", "sound", "emotion")
+TABLE_COLUMN_ALIASES = {
+    "timecode": ("timecode", "time"),
+    "description": ("description", "scene"),
+    "camera": ("camera", "shot", "angle"),
+    "sound": ("sound", "ambience", "audio"),
+    "emotion": ("emotion", "mood"),
+}
+# "# Script (table format)", "## Title:", "**# CTA**"... ; "#hashtag" (không có khoảng trắng) không phải heading
+SECTION_HEADING_REGEX = re.compile(
+    r"^[*_]*#{1,6}\s*(%s)\b(.*)$" % "|".join(re.escape(name) for name in SCRIPT_SECTIONS), re.IGNORECASE
+)
+OTHER_HEADING_REGEX = re.compile(r"^#{1,6}\s+\S")
+TABLE_CELL_SPLIT_REGEX = re.compile(r"(?<!\\)\|")
+TIMECODE_CELL_REGEX = re.compile(r"\d{1,2}:\d{2}")
+TABLE_INDEX_COLUMNS = {"#", "no", "no.", "stt"} # Cột số thứ tự trong header, không ánh xạ tới trường nào
+
+STREAM_PARSE_MIN_CHARS = 1024 # ~6 hàng bảng: gom các đoạn stream nhỏ trước khi tách dòng
+
+class ScriptIndexer:
+    """
+    Tokenizer một lượt cho kịch bản Markdown: nhận text theo từng đoạn (có thể từ stream),
+    ghi lại nội dung của từng section (# Title, # Description, ... # CTA) và trả về các hàng
+    của bảng cảnh khi dòng đó hoàn chỉnh. Bảng có thêm / thiếu cột được ánh xạ theo header.
+    Các đoạn được gom tới `min_feed_chars` ký tự rồi mới xử lý: chi phí mỗi lần feed không nhân lên theo
+    số đoạn stream (đoạn nhỏ khiến parse chậm hơn cả cách cũ), hàng chỉ về muộn hơn vài dòng.
+    """
+    def __init__(self, min_feed_chars=STREAM_PARSE_MIN_CHARS):
+        self.min_feed_chars = min_feed_chars
+        self._pending = [] # Các đoạn chưa xử lý
+        self._pending_chars = 0
+        self._buffer = ""
+        self._section = None # Khóa section hiện tại (None = trước heading đầu tiên)
+        self._section_lines = {}
+        self._columns = None # Chỉ số cột cho từng trường của bảng hiện tại
+        self._table_is_scenes = False
+        self._header_candidate = None # (dòng, ánh xạ cột) của dòng giống header, chờ dòng phân cách
+        self.rows = []
+
+    def feed(self, chunk):
+        """
+        Thêm một đoạn text; trả về danh sách các hàng bảng vừa hoàn chỉnh.
+        """
+        self._pending.append(chunk)
+        self._pending_chars += len(chunk)
+        if self._pending_chars < self.min_feed_chars:
+            return []
+        text = self._buffer + "".join(self._pending)
+        self._pending, self._pending_chars = [], 0
+        if "\n" not in text:
+            # Chưa có dòng nào hoàn chỉnh
+            self._buffer = text
+            return []
+        *lines, self._buffer = text.split("\n")
+        return self._process_lines(lines)
+
+    def close(self):
+        """
+        Xử lý phần còn lại (các đoạn đang gom và dòng cuối không có ký tự xuống dòng); trả về các hàng bảng cuối.
+        """
+        text = self._buffer + "".join(self._pending)
+        self._buffer, self._pending, self._pending_chars = "", [], 0
+        lines = text.split("\n")
+        if not lines[-1]:
+            lines.pop() # Văn bản kết thúc bằng xuống dòng: không có dòng cuối dở dang
+        new_rows = self._process_lines(lines)
+        if self._header_candidate is not None:
+            # Dòng giống header ở cuối văn bản, không có dòng phân cách: là hàng dữ liệu
+            candidate_line, _ = self._header_candidate
+            self._header_candidate = None
+            last_rows = []
+            self._table_row(candidate_line, self._split_cells(candidate_line), last_rows)
+            self.rows.extend(last_rows)
+            new_rows.extend(last_rows)
+        return new_rows
+
+    def _process_lines(self, lines):
+        new_rows = []
+        for raw_line in lines:
+            line = raw_line.strip()
+            if self._header_candidate is not None:
+                # Dòng trước giống header: chỉ là header khi ngay sau nó là dòng phân cách "|---|"
+                candidate_line, candidate_columns = self._header_candidate
+                self._header_candidate = None
+                if line.startswith("|") and not line.strip("|-: "):
+                    self._start_table(candidate_columns, is_header=True)
+                    if not self._table_is_scenes:
+                        self._section_lines.setdefault(self._section, []).extend((candidate_line, line))
+                    continue
+                self._table_row(candidate_line, self._split_cells(candidate_line), new_rows)
+            if line.startswith("|"):
+                self._table_line(line, new_rows)
+                continue
+            # Dòng trống, "**Act II – ...**" hay heading lạ chen giữa bảng không kết thúc bảng:
+            # các hàng sau vẫn dùng ánh xạ cột hiện tại cho tới header mới hoặc section mới
+            if line.startswith(("#", "*", "_")):
+                match = SECTION_HEADING_REGEX.match(line)
+                if match:
+                    self._section = SCRIPT_SECTIONS[match.group(1).lower()]
+                    self._columns = None
+                    self._table_is_scenes = False
+                    # "# Title: The First Fire" -> nội dung nằm ngay trên dòng heading
+                    rest = match.group(2).strip(" *_")
+                    if rest.startswith(":") and rest[1:].strip():
+                        self._section_lines.setdefault(self._section, []).append(rest[1:].strip())
+                    continue
+                if OTHER_HEADING_REGEX.match(line):
+                    # Heading lạ kết thúc section trước đó
+                    self._section = "other"
+                    continue
+            self._section_lines.setdefault(self._section, []).append(line)
+        self.rows.extend(new_rows)
+        return new_rows
+
+    @staticmethod
+    def _split_cells(line):
+        inner = line.strip("|")
+        if "\\|" in inner:
+            return [cell.strip().replace("\\|", "|") for cell in TABLE_CELL_SPLIT_REGEX.split(inner)]
+        return [cell.strip() for cell in inner.split("|")]
+
+    @staticmethod
+    def _header_columns(cells):
+        """
+        Ánh xạ trường -> chỉ số cột nếu dòng là header theo nghĩa chặt (mọi ô là tên cột đã biết,
+        không ô nào giống timecode), ngược lại None.
+        """
+        lowered = [cell.lower() for cell in cells]
+        named = [cell for cell in lowered if cell]
+        if len(named) < 2 or any(TIMECODE_CELL_REGEX.search(cell) for cell in named):
+            return None
+        if not all(cell in TABLE_INDEX_COLUMNS or (
+                len(cell.split()) <= 3 and any(alias in cell for aliases in TABLE_COLUMN_ALIASES.values()
+                                               for alias in aliases)) for cell in named):
+            return None
+        columns = {}
+        for field in TABLE_FIELDS:
+            # Từ khóa đứng trước được ưu tiên ("Scene Description" thắng "Scene #")
+            for alias in TABLE_COLUMN_ALIASES[field]:
+                index = next((i for i, cell in enumerate(lowered)
+                              if alias in cell and i not in columns.values()), None)
+                if index is not None:
+                    columns[field] = index
+                    break
+        return columns
+
+    def _start_table(self, columns, is_header):
+        # Cặp (trường, chỉ số cột) theo thứ tự TABLE_FIELDS; trường không có cột -> None
+        self._columns = [(field, columns.get(field)) for field in TABLE_FIELDS]
+        # Chỉ lấy bảng trong section Script (hoặc trước heading đầu tiên), hoặc bảng có header của bảng cảnh
+        self._table_is_scenes = self._section in (None, "script") or (
+            is_header and {"timecode", "description"} <= columns.keys())
+
+    def _table_line(self, line, new_rows):
+        if not line.strip("|-: "):
+            # Dòng phân cách "|---|:---:|" không đi sau header
+            if not self._table_is_scenes:
+                self._section_lines.setdefault(self._section, []).append(line)
+            return
+        cells = self._split_cells(line)
+        # Hàng dữ liệu thường có timecode: loại nhanh trước khi so tên cột
+        columns = None if TIMECODE_CELL_REGEX.search(line) else self._header_columns(cells)
+        if columns is not None:
+            # Chờ dòng kế tiếp để biết đây là header hay một hàng dữ liệu
+            self._header_candidate = (line, columns)
+            return
+        self._table_row(line, cells, new_rows)
+
+    def _table_row(self, line, cells, new_rows):
+        if self._columns is None:
+            # Bảng không có header: cột theo thứ tự mặc định
+            self._start_table({field: index for index, field in enumerate(TABLE_FIELDS)}, is_header=False)
+        if not self._table_is_scenes:
+            # Bảng khác (ví dụ trong Thumbnail Prompts) là nội dung của section
+            self._section_lines.setdefault(self._section, []).append(line)
+            return
+        if not any(cells):
+            return
+        # Cột thiếu -> chuỗi rỗng; cột thừa bị bỏ qua
+        num_cells = len(cells)
+        new_rows.append({field: cells[index] if index is not None and index < num_cells else ""
+                         for field, index in self._columns})
+
+    def section(self, key):
+        """
+        Nội dung của một section (đã bỏ dòng trống đầu/cuối), hoặc None nếu không có.
+        """
+        lines = self._section_lines.get(key)
+        if lines is None:
+            return None
+        return "\n".join(lines).strip()
+
+def index_script(markdown_text):
+    """
+    Phân tích toàn bộ kịch bản trong một lượt và trả về ScriptIndexer.
+    """
+    indexer = ScriptIndexer()
+    indexer.feed(markdown_text)
+    indexer.close()
+    return indexer
+
+def script_has_scene_table(markdown_text):
+    # Điều kiện cache cho kịch bản Step 1: có ít nhất một hàng bảng cảnh
+    return bool(index_script(markdown_text).rows)
+
+def complete_table_rows(table_text):
+    """
+    Các hàng bảng cảnh của `table_text`; hàng cuối bị cắt giữa chừng (chạm giới hạn output) bị bỏ.
+    """
+    rows = index_script(table_text).rows if table_text else []
+    if rows and not all(rows[-1].get(field) for field in TABLE_FIELDS):
+        rows.pop()
+    return rows
+
+def iter_markdown_table_rows(text_chunks, indexer=None):
+    """
+    Nhận các đoạn text (ví dụ từ stream) và yield từng hàng của bảng ngay khi dòng đó đã hoàn chỉnh.
+    Truyền `indexer` để dùng lại chỉ mục section sau khi stream xong (parse_script_sections).
+    """
+    indexer = indexer if indexer is not None else ScriptIndexer()
+    for chunk in text_chunks:
+        yield from indexer.feed(chunk)
+    yield from indexer.close()
+
+def parse_markdown_table(markdown_text):
+    """
+    Trích xuất dữ liệu từ bảng Markdown trong kịch bản.
+    """
+    return index_script(markdown_text).rows
+
+def parse_script_sections(markdown_text, indexer=None):
+    """
+    Trích xuất Tiêu đề, Mô tả, Hashtags, Era Definition, Thumbnail Prompts, Keywords, CTA.
+    Section không có trong kịch bản nhận giá trị "... Not Found".
+    """
+    indexer = indexer if indexer is not None else index_script(markdown_text)
+    data = {}
+    for key, default in SECTION_DEFAULTS.items():
+        data[key] = indexer.section(key) or default
+    # Tiêu đề chỉ là dòng đầu tiên của section
+    data['title'] = data['title'].split("\n", 1)[0].strip()
+    return data
+
+# --- [NEW] HÀM XỬ LÝ MỘT LÔ JSON (CHẠY TRONG WORKER THREAD) ---
+def build_scene_row(scene_number, scene_data_from_table, json_data):
+    """
+    Ghép dữ liệu bảng Markdown và JSON Veo 3 thành một hàng cho Excel.
+    """
+    # Dữ liệu cơ bản từ bảng Markdown
+    row_data = {
+        "Scene ID": scene_number,
+        "Table: Timecode": scene_data_from_table['timecode'],
+        "Table: Description": scene_data_from_table['description'],
+        "Table: Camera": scene_data_from_table['camera'],
+        "Table: Sound": scene_data_from_table['sound'],
+        "Table: Emotion": scene_data_from_table['emotion'],
+    }
+
+    # Thêm toàn bộ JSON
+    # JSON gọn (không thụt lề): mỗi hàng nhẹ hơn nhiều khi xuất / lưu journal
+    row_data["JSON Prompt (Full)"] = json.dumps(json_data, ensure_ascii=False, separators=(",", ":"))
+
+    # Thêm các cột đã "làm phẳng" từ JSON (để tham khảo)
+    core_idea = json_data.get("1. CORE_IDEA", {})
+    row_data["JSON: Scene Purpose"] = core_idea.get("scene_purpose", "N/A")
+    chars = json_data.get("2. CHARACTERS_AND_ACTIONS", [{}])
+    if chars:
+        row_data["JSON: Character 1"] = chars[0].get("character", "N/A")
+        # Lấy mô tả chi tiết 300-400 từ
+        row_data["JSON: Detailed Description (300-400 words)"] = chars[0].get("action_and_expression", "N/A")
+
+    row_data["Generation Status"] = "OK"
+    return row_data
+
+def build_failure_row(scene_number, scene_data_from_table, reason):
+    """
+    Hàng "thất bại" rõ ràng cho Excel khi không thể tạo JSON cho cảnh này,
+    để file xuất ra luôn có đủ mọi cảnh.
+    """
+    return {
+        "Scene ID": scene_number,
+        "Table: Timecode": scene_data_from_table['timecode'],
+        "Table: Description": scene_data_from_table['description'],
+        "Table: Camera": scene_data_from_table['camera'],
+        "Table: Sound": scene_data_from_table['sound'],
+        "Table: Emotion": scene_data_from_table['emotion'],
+        "JSON Prompt (Full)": "",
+        "Generation Status": f"FAILED: {reason}",
+    }
+
+# --- [NEW] KHÔI PHỤC LÔ JSON LỖI (CHIA NHỎ & THỬ LẠI) ---
+MAX_SCENE_ATTEMPTS = 3 # Số lần lỗi tối đa của một cảnh trước khi ghi hàng FAILED
+BATCH_EXTRA_CALLS_PER_SCENE = 1.0 # Ngân sách request thêm (chia đôi, gửi lại) của một lô, tính theo số cảnh
+
+class AdaptiveBatchSizer:
+    """
+    Kích thước lô thích ứng dùng chung cho cả job (AIMD):
+    giảm một nửa khi phản hồi bị cắt / lỗi, tăng dần 1 sau mỗi lần thành công.
+    """
+    def __init__(self, initial_size=JSON_BATCH_SIZE, min_size=1, max_size=JSON_BATCH_SIZE):
+        self.min_size = min_size
+        self.max_size = max_size
+        self._size = max(min_size, min(initial_size, max_size))
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        with self._lock:
+            return self._size
+
+    def record_success(self):
+        with self._lock:
+            self._size = min(self.max_size, self._size + 1)
+
+    def record_truncation(self, objects_received):
+        # Phản hồi chỉ chứa được `objects_received` cảnh -> không gửi nhiều hơn thế lần sau
+        with self._lock:
+            self._size = max(self.min_size, min(self._size // 2, max(objects_received, 1)))
+
+    def record_failure(self):
+        with self._lock:
+            self._size = max(self.min_size, self._size // 2)
+
+def build_json_batch_prefix(consistency_keys, json_template_string):
+    """
+    Phần tĩnh của prompt Step 4 (vai trò, consistency keys, template, hướng dẫn):
+    giống hệt nhau cho mọi lô của một tập nên chỉ tạo một lần (xem PromptPrefix).
+    """
+    return f"""
+            You are a JSON generation bot.
+            You will be given a list of structured scene inputs (from a Markdown table) and consistency keys.
+            You MUST return a valid JSON LIST, containing one JSON object for each scene,
+            filled according to the JSON TEMPLATE.
+
+            CONSISTENCY KEYS (MUST ADHERE IF RELEVANT):
+            "{consistency_keys}"
+
+            JSON TEMPLATE (Use this for each object in the list):
+            {compact_json_template(json_template_string)}
+
+            INSTRUCTIONS:
+            Fill in the JSON TEMPLATE for EACH of the scenes in the STRUCTURED SCENE INPUTS below.
+
+            - **action_and_expression**: THIS IS CRITICAL. EXPAND the 1-line input "Description" (e.g., "Kael watches the herd") into a detailed, 300-400 word cinematic description of the action, character expression, and environment for this specific scene. Be vivid and immersive.
+            - "scene_purpose": Base this on the input "Description".
+            - "camera_work": Use the input "Camera" (e.g., "Close-up")
+            - "primary_mood": Use the input "Emotion" (e.g., "Terror")
+            - "ambient_sound": Use the input "Sound" (e.g., "Roar, rain")
+            - "character" / "description" / "location": Use the CONSISTENCY KEYS.
+            - "negative_prompt": MUST be kept exactly as it is.
+            """
+
+def build_json_batch_prompt(scene_entries):
+    """
+    Phần riêng của prompt Step 4 cho danh sách (scene_number, scene_data), gửi sau PromptPrefix.
+    Số cảnh không nhất thiết liên tiếp (khi gửi lại các cảnh còn thiếu).
+    """
+    # Xây dựng chuỗi thông tin đầu vào cho batch này
+    batch_input_string = ""
+    for scene_num, scene_data in scene_entries:
+        batch_input_string += f"--- SCENE {scene_num} INPUT ---\n"
+        batch_input_string += f"Timecode: {scene_data['timecode']}\n"
+        batch_input_string += f"Description: {scene_data['description']}\n"
+        batch_input_string += f"Camera: {scene_data['camera']}\n"
+        batch_input_string += f"Sound: {scene_data['sound']}\n"
+        batch_input_string += f"Emotion: {scene_data['emotion']}\n\n"
+
+    # --- Tạo prompt NÂNG CẤP cho batch 4 ---
+    return (
+        f"STRUCTURED SCENE INPUTS (Generate one JSON object for each of these {len(scene_entries)} scenes):\n"
+        f"{batch_input_string}---\n"
+        "Respond with only a valid JSON LIST (e.g., [ {...}, {...}, ... ])."
+    )
+
+def request_json_list(scene_entries, prompt_prefix, limiter=None, log=None, refresh_cache=False, usage=None,
+                      retry_policy=None, json_template_string=None):
+    """
+    Gửi một lô và trả về (objects_by_index, invalid_by_index, error). objects_by_index ánh xạ vị trí
+    cảnh trong lô -> object JSON hợp lệ, gồm cả các object "cứu" được từ phản hồi bị cắt.
+    Với `json_template_string`, lần gọi dùng response schema của template và mỗi object được
+    TemplateValidator kiểm tra; object không đạt nằm trong invalid_by_index (vị trí -> lỗi).
+    objects_by_index là None nếu không có phản hồi hoặc không cứu được object nào.
+    """
+    log = log or _print_log
+    response_schema, validator = get_json_contract(json_template_string) if json_template_string else (None, None)
+
+    def parse(text):
+        objects_by_index, complete, malformed = salvage_json_list(text)
+        # Object thừa (nhiều hơn số cảnh gửi đi) bị bỏ qua
+        objects_by_index = {i: obj for i, obj in objects_by_index.items() if i < len(scene_entries)}
+        invalid_by_index = {}
+        if validator is not None:
+            for index, obj in objects_by_index.items():
+                problems = validator.validate(obj)
+                if problems:
+                    invalid_by_index[index] = problems
+            for index in invalid_by_index:
+                del objects_by_index[index]
+        return objects_by_index, invalid_by_index, complete, malformed
+
+    parsed = {} # Kết quả parse của phản hồi mới (tính trong cache_if), dùng lại bên dưới
+    def cacheable(text):
+        # Chỉ cache list hoàn chỉnh có đủ số cảnh và mọi object đều đúng template
+        parsed["text"], parsed["result"] = text, parse(text)
+        objects_by_index, invalid_by_index, complete, malformed = parsed["result"]
+        return complete and not malformed and not invalid_by_index and len(objects_by_index) == len(scene_entries)
+
+    json_response_string = call_gemini_api(build_json_batch_prompt(scene_entries), is_json=True,
+                                           limiter=limiter, log=log, refresh_cache=refresh_cache,
+                                           prompt_prefix=prompt_prefix, usage=usage, stage="step4_json",
+                                           retry_policy=retry_policy, response_schema=response_schema,
+                                           cache_if=cacheable)
+
+    if not json_response_string:
+        return None, {}, "no response"
+
+    if parsed.get("text") is json_response_string:
+        objects_by_index, invalid_by_index, complete, malformed = parsed["result"]
+    else:
+        objects_by_index, invalid_by_index, complete, malformed = parse(json_response_string) # Phản hồi từ cache
+    if usage is not None:
+        # Kết quả parse của lần gọi vừa rồi (cùng thread) cho trace
+        usage.annotate_last_call(
+            scenes_requested=len(scene_entries), objects_parsed=len(objects_by_index) + len(invalid_by_index),
+            objects_invalid=len(invalid_by_index),
+            parse_outcome="complete" if complete and not malformed else ("truncated" if not complete else "malformed")
+        )
+    if not objects_by_index and not invalid_by_index:
+        if complete and not malformed:
+            return {}, {}, None # List rỗng hợp lệ: mọi cảnh đều "thiếu"
+        return None, {}, "invalid JSON" if not complete else f"no valid objects ({len(malformed)} malformed)"
+
+    if not complete or malformed:
+        recovered = ", ".join(str(scene_entries[i][0]) for i in sorted(objects_by_index))
+        log("info", f"   ... Salvaged {len(objects_by_index)}/{len(scene_entries)} objects from a "
+                    f"{'truncated' if not complete else 'partially malformed'} response (scenes {recovered}).")
+    return objects_by_index, invalid_by_index, None
+
+def process_json_batch(batch_num, start_index, batch_of_scenes_data, prompt_prefix,
+                       limiter=None, refresh_cache=False, batch_sizer=None, usage=None, retry_policy=None,
+                       json_template_string=None, cancel_event=None, extra_call_budget=None):
+    """
+    Gọi AI cho một lô cảnh và trả về (rows, messages).
+    Lô lỗi được chia đôi và thử lại; phản hồi thiếu cảnh thì chỉ gửi lại các cảnh còn thiếu,
+    và với `json_template_string` chỉ các cảnh có object không đúng template (xem request_json_list).
+    Mọi request gửi lại (kể cả vì JSON không hợp lệ) tính vào `extra_call_budget` (mặc định
+    BATCH_EXTRA_CALLS_PER_SCENE x số cảnh); hết ngân sách thì các cảnh còn lại được đánh dấu lỗi.
+    Khi circuit breaker của `retry_policy` đang mở, các cảnh còn lại được đánh dấu lỗi ngay.
+    Khi `cancel_event` được set (một phương án khác của lô đã xong, xem BatchHedger), không gửi thêm request.
+    Luôn trả về đúng một hàng cho mỗi cảnh (hàng JSON hoặc hàng FAILED).
+    Không gọi reporter ở đây: các thông báo được gom lại để thread chính hiển thị.
+    """
+    messages = []
+    log = lambda level, message: messages.append((level, message))
+    batch_sizer = batch_sizer or AdaptiveBatchSizer()
+    if extra_call_budget is None:
+        extra_call_budget = math.ceil(len(batch_of_scenes_data) * BATCH_EXTRA_CALLS_PER_SCENE)
+    extra_calls = 0
+
+    rows_by_scene = {}
+    attempts = {} # Số lần cảnh được gửi đi
+    failures = {} # Số lần cảnh bị "quy lỗi" (gửi một mình mà lỗi, hoặc bị thiếu trong phản hồi)
+    last_error = {}
+    scene_entries = [(start_index + 1 + j, scene_data) for j, scene_data in enumerate(batch_of_scenes_data)]
+
+    # Hàng đợi các nhóm cảnh cần gửi; cắt theo kích thước lô hiện tại
+    pending_groups = deque()
+    def enqueue(entries):
+        size = batch_sizer.size
+        for k in range(0, len(entries), size):
+            pending_groups.append(entries[k:k + size])
+    enqueue(scene_entries)
+
+    while pending_groups:
+        if cancel_event is not None and cancel_event.is_set():
+            for scene_num, _ in [entry for pending in pending_groups for entry in pending]:
+                last_error[scene_num] = HEDGE_CANCELLED_REASON
+            break
+        group = pending_groups.popleft()
+        # Chỉ lần gửi đầu tiên được dùng cache; khi thử lại thì cần phản hồi mới
+        is_retry = any(scene_num in attempts for scene_num, _ in group)
+        if is_retry:
+            if extra_calls >= extra_call_budget:
+                # Các nhóm gửi lần đầu luôn đứng trước nhóm gửi lại: mọi nhóm còn lại đều là gửi lại
+                remaining = [entry for pending in [group, *pending_groups] for entry in pending]
+                for scene_num, _ in remaining:
+                    last_error[scene_num] = (f"{last_error.get(scene_num, 'unknown error')} "
+                                             f"(retry budget of {extra_call_budget} extra calls exhausted)")
+                log("error", f"   ! Batch {batch_num}: retry budget of {extra_call_budget} extra calls exhausted. "
+                             f"Failing {len(remaining)} remaining scenes.")
+                break
+            extra_calls += 1
+        for scene_num, _ in group:
+            attempts[scene_num] = attempts.get(scene_num, 0) + 1
+
+        objects_by_index, invalid_by_index, error = request_json_list(
+            group, prompt_prefix, limiter=limiter, log=log,
+            refresh_cache=refresh_cache or is_retry, usage=usage, retry_policy=retry_policy,
+            json_template_string=json_template_string
+        )
+
+        if objects_by_index is None and retry_policy is not None and retry_policy.breaker.is_open():
+            # API đang lỗi liên tục: không chia lô / gửi lại nữa
+            for scene_num, _ in [entry for pending in [group, *pending_groups] for entry in pending]:
+                last_error[scene_num] = CIRCUIT_OPEN_REASON
+            log("error", f"   ! Batch {batch_num}: API unavailable (circuit breaker open). Failing the remaining scenes.")
+            break
+
+        if objects_by_index is None:
+            batch_sizer.record_failure()
+            for scene_num, _ in group:
+                last_error[scene_num] = error
+            if len(group) > 1:
+                # Chia đôi lô lỗi; chưa biết cảnh nào gây lỗi nên không tính vào failures.
+                # Số lần chia tối đa là log2(kích thước lô) nên vòng lặp luôn kết thúc.
+                half = len(group) // 2
+                log("warning", f"   ! Batch {batch_num}: {error} for scenes {group[0][0]}-{group[-1][0]}. Splitting into {half} + {len(group) - half} scenes and retrying.")
+                pending_groups.append(group[:half])
+                pending_groups.append(group[half:])
+                continue
+            scene_num = group[0][0]
+            failures[scene_num] = failures.get(scene_num, 0) + 1
+            if failures[scene_num] < MAX_SCENE_ATTEMPTS:
+                log("warning", f"   ! Batch {batch_num}: {error} for scene {scene_num}. Retrying.")
+                pending_groups.append(group)
+            continue
+
+        # Ghép các object nhận được theo vị trí trong lô
+        for index, json_data in objects_by_index.items():
+            scene_num, scene_data = group[index]
+            rows_by_scene[scene_num] = build_scene_row(scene_num, scene_data, json_data)
+
+        # Object sai template: chỉ các cảnh đó được gửi lại, không coi là phản hồi bị cắt
+        for index, problems in invalid_by_index.items():
+            scene_num = group[index][0]
+            last_error[scene_num] = f"does not match the JSON template ({'; '.join(problems[:3])})"
+            failures[scene_num] = failures.get(scene_num, 0) + 1
+
+        received = len(objects_by_index) + len(invalid_by_index)
+        missing = [entry for index, entry in enumerate(group)
+                   if index not in objects_by_index and index not in invalid_by_index]
+        if missing:
+            # Phản hồi ngắn / bị cắt (giới hạn token) -> chỉ gửi lại các cảnh còn thiếu
+            batch_sizer.record_truncation(received)
+            for scene_num, _ in missing:
+                last_error[scene_num] = f"only {received}/{len(group)} objects returned"
+                failures[scene_num] = failures.get(scene_num, 0) + 1
+        elif not invalid_by_index:
+            batch_sizer.record_success()
+            continue
+
+        invalid = [group[index] for index in sorted(invalid_by_index)]
+        if invalid:
+            log("warning", f"   ! Batch {batch_num}: scenes {', '.join(str(n) for n, _ in invalid)} do not match "
+                           f"the JSON template ({'; '.join(invalid_by_index[min(invalid_by_index)][:3])}).")
+        retryable = [entry for entry in sorted(missing + invalid, key=lambda entry: entry[0])
+                     if failures[entry[0]] < MAX_SCENE_ATTEMPTS]
+        if retryable:
+            log("warning", f"   ! Batch {batch_num}: received {len(objects_by_index)}/{len(group)} valid objects. Re-requesting scenes {', '.join(str(n) for n, _ in retryable)}.")
+            enqueue(retryable)
+
+    # Mọi cảnh đều có hàng: JSON hoặc FAILED
+    rows = []
+    for scene_num, scene_data in scene_entries:
+        if scene_num in rows_by_scene:
+            rows.append(rows_by_scene[scene_num])
+        else:
+            reason = last_error.get(scene_num, "unknown error")
+            if reason not in (CIRCUIT_OPEN_REASON, HEDGE_CANCELLED_REASON): # Đã báo một lần cho cả lô / bị bỏ
+                log("error", f"   ! Scene {scene_num} failed after {attempts.get(scene_num, 0)} attempts: {reason}")
+            rows.append(build_failure_row(scene_num, scene_data, reason))
+    return rows, messages
+
+# --- HEDGED REQUESTS CHO CÁC LÔ STEP 4 CHẬM ---
+HEDGE_MODES = ("off", "duplicate", "split")
+DEFAULT_HEDGE_PERCENTILE = 0.9 # Lô chạy lâu hơn percentile này của các lô đã xong thì được hedge
+DEFAULT_HEDGE_BUDGET = 0.1 # Số request thêm tối đa, tính theo tỷ lệ số lô của tập
+HEDGE_MIN_SAMPLES = 4 # Số lô phải xong trước khi có ngưỡng
+HEDGE_POLL_SECONDS = 0.25
+
+def batch_is_complete(rows):
+    return all(row.get("Generation Status", "OK") == "OK" for row in rows)
+
+class BatchHedger:
+    """
+    Cắt đuôi latency của Step 4: khi một lô đã chạy lâu hơn `percentile` thời gian của các lô đã xong,
+    gửi thêm một phương án cho lô đó ("duplicate": gửi lại nguyên lô, "split": hai nửa song song,
+    mỗi nửa chỉ phải sinh một nửa số mô tả). Phương án xong trước với mọi cảnh OK được dùng, các phương án
+    còn lại bị hủy (future chưa chạy bị hủy, worker đang chạy dừng sau request hiện tại).
+    Chỉ hedge khi mọi lô đã bắt đầu chạy: trước đó một lô chậm chỉ giữ một worker, các lô khác vẫn chạy,
+    còn ở cuối Step 4 lô chậm nhất quyết định thời gian của cả tập - ngân sách được dành cho lúc đó.
+    Tổng số request thêm không vượt quá `budget` x số lô. mode="off": như as_completed, không hedge.
+    """
+    def __init__(self, mode="off", percentile=DEFAULT_HEDGE_PERCENTILE, budget=DEFAULT_HEDGE_BUDGET,
+                 min_samples=HEDGE_MIN_SAMPLES, clock=time.monotonic):
+        if mode not in HEDGE_MODES:
+            raise ValueError(f"Unknown hedge mode: {mode!r}")
+        self.mode = mode
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.clock = clock
+        self.latencies = []
+        self.stats = {"hedged_batches": 0, "extra_requests": 0, "hedges_won": 0, "seconds_saved": 0.0,
+                      "losers_unfinished": 0}
+        self._started = {} # start_index -> thời điểm lô bắt đầu chạy trên worker
+        self._cancel_events = {}
+        self._won_at = {} # future của phương án thua -> thời điểm phương án hedge thắng
+        self._lock = threading.Lock()
+
+    def cancel_event(self, start_index):
+        # Một event cho mỗi lô, dùng chung cho mọi phương án (chỉ được set khi lô đã có kết quả)
+        return self._cancel_events.setdefault(start_index, threading.Event())
+
+    def batch_started(self, start_index):
+        # Gọi từ worker: thời gian chờ worker rảnh không tính vào latency của lô
+        with self._lock:
+            self._started.setdefault(start_index, self.clock())
+
+    def threshold(self):
+        """
+        Số giây mà một lô đang chạy phải vượt quá để được hedge; None khi chưa đủ mẫu.
+        """
+        if self.mode == "off" or len(self.latencies) < self.min_samples:
+            return None
+        return percentile(self.latencies, self.percentile)
+
+    def _hedge_cost(self):
+        return 2 if self.mode == "split" else 1
+
+    def _can_hedge(self, num_batches):
+        return self.stats["extra_requests"] + self._hedge_cost() <= self.budget * num_batches
+
+    def _record_loser(self, future):
+        # Phương án bị thua xong sau: thời gian tiết kiệm = lúc nó xong - lúc hedge thắng
+        with self._lock:
+            won_at = self._won_at.pop(future, None)
+            if won_at is not None:
+                self.stats["seconds_saved"] += self.clock() - won_at
+
+    def finish(self):
+        """
+        Tổng kết sau Step 4. seconds_saved là cận dưới: request thua chưa xong (losers_unfinished)
+        chỉ được tính tới thời điểm này.
+        """
+        with self._lock:
+            now = self.clock()
+            self.stats["seconds_saved"] += sum(now - won_at for won_at in self._won_at.values())
+            self.stats["losers_unfinished"] = len(self._won_at)
+            self._won_at = {}
+            self.stats["seconds_saved"] = round(self.stats["seconds_saved"], 3)
+            return dict(self.stats, mode=self.mode, threshold_seconds=self.threshold())
+
+    def completed(self, futures, outcome, launch):
+        """
+        Yield (start_index, rows, messages) cho từng lô theo thứ tự có kết quả.
+        `futures`: future -> start_index của các lô đã gửi.
+        `outcome(start_index, variant_futures)` -> (rows, messages) của một phương án đã xong.
+        `launch(start_index, mode)` -> danh sách future của phương án hedge (cùng phủ cả lô).
+        """
+        if self.mode == "off":
+            for future in as_completed(futures):
+                yield (futures[future], *outcome(futures[future], [future]))
+            return
+
+        variants = {start_index: [[future]] for future, start_index in futures.items()}
+        owner = {future: (start_index, 0) for future, start_index in futures.items()}
+        fallback = {} # start_index -> (rows, messages) có cảnh lỗi, dùng khi không phương án nào tốt hơn
+        pending = set(futures)
+        num_batches = len(variants)
+        while pending:
+            done, pending = wait(pending, timeout=HEDGE_POLL_SECONDS, return_when=FIRST_COMPLETED)
+            for future in done:
+                owner_entry = owner.pop(future, None)
+                if owner_entry is None:
+                    continue # Phương án của một lô vừa có kết quả trong cùng lượt wait() này
+                start_index, variant_index = owner_entry
+                batch_variants = variants.get(start_index)
+                if batch_variants is None or not all(f.done() for f in batch_variants[variant_index]):
+                    continue # Lô đã có kết quả, hoặc nửa còn lại của phương án split chưa xong
+                rows, messages = outcome(start_index, batch_variants[variant_index])
+                others = [f for index, variant in enumerate(batch_variants) if index != variant_index for f in variant]
+                if not batch_is_complete(rows):
+                    previous = fallback.get(start_index)
+                    if previous is None or sum(batch_is_complete([row]) for row in rows) > sum(
+                            batch_is_complete([row]) for row in previous[0]):
+                        fallback[start_index] = (rows, messages)
+                    if any(not f.done() for f in others):
+                        continue # Còn phương án khác đang chạy: chờ nó
+                    rows, messages = fallback[start_index]
+                elif variant_index > 0:
+                    with self._lock:
+                        self.stats["hedges_won"] += 1
+                        won_at = self.clock()
+                        for loser in batch_variants[0]:
+                            if not loser.done():
+                                self._won_at[loser] = won_at
+                    for loser in batch_variants[0]:
+                        loser.add_done_callback(self._record_loser)
+                # Lô đã có kết quả: latency tính từ lúc lô bắt đầu chạy tới lúc này, dù phương án nào thắng
+                # (chỉ tính phương án gốc thì các lô chậm bị bỏ khỏi mẫu và ngưỡng tụt dần)
+                self.latencies.append(self.clock() - self._started.get(start_index, self.clock()))
+                self.cancel_event(start_index).set()
+                for other in others:
+                    other.cancel()
+                    owner.pop(other, None)
+                pending -= set(others)
+                del variants[start_index]
+                fallback.pop(start_index, None)
+                yield start_index, rows, messages
+
+            # Lô chạy quá ngưỡng và chưa được hedge: gửi thêm một phương án nếu còn ngân sách
+            threshold = self.threshold()
+            if threshold is None or len(self._started) < num_batches:
+                continue
+            now = self.clock()
+            slow = sorted((self._started[start_index], start_index) for start_index, batch_variants in variants.items()
+                          if len(batch_variants) == 1 and now - self._started[start_index] > threshold)
+            for _, start_index in slow: # Lô chạy lâu nhất trước
+                if not self._can_hedge(num_batches):
+                    break
+                batch_variants = variants[start_index]
+                hedge_futures = launch(start_index, self.mode)
+                batch_variants.append(hedge_futures)
+                for hedge_future in hedge_futures:
+                    owner[hedge_future] = (start_index, len(batch_variants) - 1)
+                pending |= set(hedge_futures)
+                self.stats["hedged_batches"] += 1
+                self.stats["extra_requests"] += len(hedge_futures)
+
+# --- [NEW] CÁC HÀM TẠO PROMPT ---
+def build_master_script_prompt(video_topic, video_duration_minutes, total_scenes, consistency_keys=None):
+    """
+    Prompt cho Step 1 (kịch bản tổng). Nếu có `consistency_keys` (chế độ keys-first)
+    thì yêu cầu AI dùng đúng các nhân vật / địa điểm đó.
+    """
+    prompt_task_1_prehumanfile = f"""
+        You are a cinematic scriptwriter for the YouTube channel “PrehumanFile,” which produces visually immersive, emotional, AI-generated documentaries about prehistoric survival.  
+        
+        Your task: Write a full cinematic script (VEO 3–ready format) for one episode based on the user’s provided video topic and duration.
+
+        === INPUT ===
+        Video Topic: "{video_topic}"
+        Video Duration: "{video_duration_minutes} minutes"
+
+        === OUTPUT STYLE & STRUCTURE ===
+
+        🎯 1. VIDEO OVERVIEW
+        - Title suggestion (fit YouTube style: “Life X Million Years Ago | [Conflict/Emotion/Outcome]”)
+        - One-line tagline
+        - Short description (SEO-optimized, cinematic tone)
+        - Recommended hashtags (#prehistoric #prehumanfile #survival #stoneage #ancienthumans)
+
+        🎬 2. CINEMATIC SCRIPT STRUCTURE ({video_duration_minutes} minutes total)
+        Divide into 3 ACTS and a CLOSING TAG.
+        Your script table must contain exactly {total_scenes} scenes.
+        
+        | Timecode | Scene Description (1 line, cinematic) | Camera Angle | Sound/Ambience | Emotion |
+        |-----------|----------------------------------------|----------------|----------------|----------|
+
+        Follow this model:
+        - **Act I – Awakening (10% duration):** Introduce environment + first instinct (fear or awe).
+        - **Act II – Confrontation (60% duration):** Main survival conflict: danger, strategy, or loss.
+        - **Act III – Resolution (25% duration):** Survival outcome, emotional reflection.
+        - **Tag Scene (5% duration):** A haunting or hopeful visual to tease the next episode.
+
+        Each scene = one {SCENE_DURATION_SECONDS}s micro-shot (for VEO 3 input).  
+        Use compact English (one line per scene, no line breaks inside).  
+
+        🎥 3. CINEMATIC VISUAL GUIDELINES
+        - **Scientific Consistency:** You MUST define the specific prehistoric era (e.g., Late Pleistocene) and hominid species (e.g., Neanderthal, Homo erectus) based on the topic.
+        - **Mandatory Consistency:** All animals, plants, and tools mentioned MUST be scientifically accurate for that specific era and species.
+        - Aspect ratio 16:9, golden-hour or storm lighting, Panavision anamorphic lens.
+        - Focus on prehistoric realism: stone tools, mammoths, volcano smoke, tribal faces.
+        - Lighting tone: fire-orange, fog-blue, or earthy neutrals.
+        - Human motion should feel natural, grounded, emotional (close-ups on eyes, hands, fire).
+
+        🔊 4. AUDIO & ATMOSPHERE
+        - Ambient base: wind, crackling fire, breathing, animal calls.
+        - Emotional layer: deep tribal drums, low strings, heartbeat pulse.
+        - Use silence strategically (before climax or aftermath).
+        - Sound motif: final 2 seconds = “flame burst + deep drum” (brand signature).
+
+        💥 5. HOOK & CTA
+        - First 8 seconds: visual shock or emotional hook (“Fear → Curiosity → Survival”).
+        - Add one text overlay hook at 0:05 like: “When fire dies, how do you survive the night?”
+        - CTA end-screen line: “Continue the PrehumanFile — next chapter below 🔥”.
+
+        📜 6. ADDITIONAL OUTPUTS
+        - 3 alternative YouTube titles (SEO-friendly + emotionally charged)
+        - 3 highly detailed, 50-word cinematic thumbnail prompts (for AI image generation)
+        - 5 SEO keywords related to the episode
+        - Short caption (for YouTube Shorts version, <100 characters)
+
+        === OUTPUT FORMAT ===
+        Return everything as clear Markdown sections:
+        # Title
+        (Suggested Title)
+
+        # Description
+        (Tagline and Description)
+        
+        # Hashtags
+        (Hashtags)
+        
+        # Era Definition
+        (e.g., "Era: Late Pleistocene. Species: Homo neanderthalensis")
+
+        # Script (table format)
+        (The full Markdown table with exactly {total_scenes} scenes)
+        
+        # Thumbnail Prompts
+        (3 prompt lines)
+
+        # Keywords
+        (5 keywords)
+
+        # CTA
+        (CTA Line and Hook Text)
+
+        Tone: cinematic, emotional, survival-driven, with a mythic prehistoric atmosphere.
+        """
+    if consistency_keys:
+        prompt_task_1_prehumanfile += f"""
+        === PREDEFINED CONSISTENCY KEYS ===
+        The following characters, locations and objects have already been designed for this episode.
+        Use these exact names, species and era in the script and in the "Era Definition" section:
+        "{consistency_keys}"
+        """
+    return prompt_task_1_prehumanfile
+
+def compact_script_for_keys(markdown_script):
+    """
+    Bản rút gọn của kịch bản cho Step 3: giữ các phần văn bản (Title, Era Definition...)
+    nhưng thay bảng bằng danh sách mô tả cảnh (bỏ Timecode / Camera / Sound / Emotion,
+    vốn không giúp gì cho việc nhận diện nhân vật và địa điểm).
+    """
+    text_lines = [line for line in markdown_script.split('\n') if not line.strip().startswith('|')]
+    descriptions = [scene['description'] for scene in parse_markdown_table(markdown_script)]
+    compact_script = "\n".join(text_lines).strip()
+    if descriptions:
+        compact_script += "\n\n# Scene Descriptions\n" + "\n".join(
+            f"{i}. {description}" for i, description in enumerate(descriptions, start=1)
+        )
+    return compact_script
+
+def build_consistency_keys_prompt(markdown_script):
+    """
+    Prompt cho Step 3: trích xuất consistency keys từ kịch bản tổng (bản rút gọn).
+    """
+    return f"""
+        Based on the following full master script:
+        "{compact_script_for_keys(markdown_script)}"
+        
+        Identify the MAIN CHARACTERS, KEY LOCATIONS, or special OBJECTS that will appear repeatedly.
+        For each item, provide a detailed visual description to ensure consistency in all scenes.
+        Pay close attention to the "Era Definition" (Species, Era) from the script.
+
+        Example:
+        - CHARACTER (Kael): 'A young Neanderthal hunter, lean, wearing rough furs, has a scar over
+        his left eye, carries a flint-tipped spear. (Based on Homo neanderthalensis)'
+        - LOCATION (The Valley): 'A misty, volcanic valley, black rock, sparse giant ferns (Pleistocene era), a river of slow-moving lava in the distance.'
+
+        Please respond concisely, focusing on visual descriptions.
+        Please respond in English.
+        """
+
+def build_keys_first_prompt(video_topic, video_duration_minutes, library_entries=None):
+    """
+    Prompt cho chế độ keys-first: thiết kế consistency keys chỉ từ chủ đề,
+    để Step 4 có thể bắt đầu trong khi kịch bản còn đang được stream.
+    `library_entries`: entry đã có trong ConsistencyLibrary, AI dùng lại thay vì thiết kế lại.
+    """
+    prompt = f"""
+        You are the lead character and production designer for the YouTube channel “PrehumanFile,” which produces AI-generated documentaries about prehistoric survival.
+
+        An episode is about to be written for this topic:
+        Video Topic: "{video_topic}"
+        Video Duration: "{video_duration_minutes} minutes"
+
+        First, define the specific prehistoric era (e.g., Late Pleistocene) and hominid species (e.g., Neanderthal, Homo erectus) that fit the topic.
+        Then design the MAIN CHARACTERS, KEY LOCATIONS, or special OBJECTS that the episode will need.
+        For each item, provide a detailed visual description to ensure consistency in all scenes.
+        All animals, plants, and tools MUST be scientifically accurate for that era and species.
+
+        Example:
+        - ERA: 'Late Pleistocene. Species: Homo neanderthalensis'
+        - CHARACTER (Kael): 'A young Neanderthal hunter, lean, wearing rough furs, has a scar over
+        his left eye, carries a flint-tipped spear. (Based on Homo neanderthalensis)'
+        - LOCATION (The Valley): 'A misty, volcanic valley, black rock, sparse giant ferns (Pleistocene era), a river of slow-moving lava in the distance.'
+
+        Please respond concisely, focusing on visual descriptions.
+        Please respond in English.
+        """
+    if library_entries:
+        prompt += f"""
+        === SERIES LIBRARY ===
+        These items are ALREADY DEFINED for this series. Reuse them if they fit the topic (keep their era),
+        do not describe them again, and only design the items that are still missing:
+        {format_consistency_keys(library_entries)}
+        """
+    return prompt
+
+def build_library_keys_prompt(era_definition, known_entries, scene_descriptions):
+    """
+    Prompt Step 3 khi đã có thư viện: chỉ gửi các cảnh chưa được bao phủ và tên các entry đã có,
+    AI chỉ mô tả nhân vật / địa điểm / đồ vật mới.
+    """
+    known_lines = "\n".join(f"- {entry['kind']} ({entry['name']})" for entry in known_entries) or "- (none)"
+    scene_lines = "\n".join(f"{i}. {description}" for i, description in enumerate(scene_descriptions, start=1))
+    return f"""
+        Era Definition of the master script: "{era_definition}"
+
+        Scenes of the script that mention characters, locations or objects not yet defined:
+        "{scene_lines}"
+
+        These recurring items are ALREADY DEFINED in the series library (do not describe them again):
+        {known_lines}
+
+        Identify only the OTHER main characters, key locations, or special objects in these scenes that will appear repeatedly.
+        For each item, provide a detailed visual description to ensure consistency in all scenes,
+        one item per line in exactly this format:
+        - CHARACTER (Name): 'visual description (Based on the species of the Era Definition)'
+        - LOCATION (Name): 'visual description'
+        - OBJECT (Name): 'visual description'
+        If every recurring item is already defined, reply with: NONE
+        Please respond in English.
+        """
+
+def resolve_consistency_keys(library, video_topic, markdown_script, scene_list_data, era_definition,
+                             limiter=None, log=None, refresh_cache=False, usage=None, retry_policy=None):
+    """
+    Step 3 dùng ConsistencyLibrary: entry cùng era / species được nhắc trong kịch bản được dùng lại,
+    chỉ các cảnh chưa được bao phủ (scene_is_covered) được gửi cho AI để tìm entry mới, và không gọi AI
+    nếu không còn cảnh nào. Entry mới được ghi vào thư viện. Kịch bản không có era / species:
+    Step 3 như cũ. Trả về text keys, hoặc None nếu lần gọi AI lỗi.
+    """
+    log = log or _print_log
+    era, species = parse_era_definition(era_definition)
+    if not (era or species):
+        return call_gemini_api(build_consistency_keys_prompt(markdown_script), limiter=limiter, log=log,
+                               refresh_cache=refresh_cache, usage=usage, stage="step3_keys", retry_policy=retry_policy)
+
+    known = library.lookup(era, species)
+    reused = [entry for entry in known if entity_mentioned(entry, markdown_script)]
+    uncovered = list(dict.fromkeys(scene["description"] for scene in scene_list_data
+                                   if not scene_is_covered(scene["description"], known)))
+    if not known:
+        # Era mới với thư viện: trích xuất đầy đủ như cũ, kết quả làm nền cho các tập sau
+        prompt = build_consistency_keys_prompt(markdown_script)
+    elif uncovered:
+        prompt = build_library_keys_prompt(era_definition, reused, uncovered)
+    else:
+        prompt = None
+
+    parsed, unparsed_text = [], ""
+    if prompt is not None:
+        response = call_gemini_api(prompt, limiter=limiter, log=log, refresh_cache=refresh_cache, usage=usage,
+                                   stage="step3_keys", retry_policy=retry_policy)
+        if response is None:
+            return None
+        parsed = parse_consistency_entries(response)
+        if not parsed and response.strip().strip(".").upper() != "NONE":
+            unparsed_text = response.strip() # Không đúng định dạng: vẫn dùng cho tập này, không lưu
+    added = library.add(parsed, era, species, video_topic)
+
+    # Entry AI định nghĩa lại một tên đã có thì dùng bản của thư viện (ổn định giữa các tập)
+    parsed_names = {(entry["kind"], entry["name"].lower()) for entry in parsed}
+    entries = [entry for entry in library.lookup(era, species)
+               if (entry["kind"], entry["name"].lower()) in parsed_names or entity_mentioned(entry, markdown_script)]
+    log("info", f"   -> Consistency library ({era or species}): reused {len(reused)} entries, {len(added)} new; "
+                + (f"{len(uncovered) if known else len(scene_list_data)} scenes sent to the model."
+                   if prompt is not None else "no model call needed."))
+    if usage is not None:
+        usage.meta["consistency_library"] = {"era": era, "species": species, "reused": len(reused),
+                                             "new": len(added), "model_call": prompt is not None}
+    keys_text = format_consistency_keys(entries, era, species)
+    return f"{keys_text}\n{unparsed_text}".strip() if unparsed_text else keys_text
+
+def resolve_keys_first_consistency_keys(library, video_topic, video_duration_minutes, limiter=None, log=None,
+                                        refresh_cache=False, usage=None, retry_policy=None):
+    """
+    Keys-first dùng ConsistencyLibrary: entry có từ khóa chung với chủ đề được đưa vào prompt như đã
+    định nghĩa sẵn, AI chỉ thiết kế phần còn thiếu; entry mới được ghi vào thư viện theo dòng ERA
+    của phản hồi. Trả về text keys, hoặc None nếu lần gọi AI lỗi.
+    """
+    log = log or _print_log
+    known = library.lookup(keywords=topic_keywords(video_topic))
+    response = call_gemini_api(build_keys_first_prompt(video_topic, video_duration_minutes, known),
+                               limiter=limiter, log=log, refresh_cache=refresh_cache, usage=usage,
+                               stage="step3_keys", retry_policy=retry_policy)
+    if response is None:
+        return None
+    era, species = parse_era_definition(response)
+    if not (era or species) and known:
+        era, species = known[0]["era"], known[0]["species"]
+    parsed = parse_consistency_entries(response)
+    if not (era or species) or not (parsed or known):
+        return response
+
+    known_names = {(entry["era_key"], entry["kind"], entry["name"].lower()) for entry in known}
+    parsed_names = {(entry["kind"], entry["name"].lower()) for entry in parsed}
+    added = library.add(parsed, era, species, video_topic)
+    era_key = library.era_key(era, species)
+    entries = [entry for entry in library.lookup(era, species)
+               if (entry["kind"], entry["name"].lower()) in parsed_names
+               or (era_key, entry["kind"], entry["name"].lower()) in known_names]
+    log("info", f"   -> Consistency library ({era or species}): {len(known)} entries matched the topic, {len(added)} new.")
+    if usage is not None:
+        usage.meta["consistency_library"] = {"era": era, "species": species, "reused": len(known),
+                                             "new": len(added), "model_call": True}
+    return format_consistency_keys(entries, era, species)
+
+# --- [NEW] KỊCH BẢN PHÂN CẤP: OUTLINE + CÁC ACT SONG SONG (CHO VIDEO DÀI) ---
+SCRIPT_MODES = ("auto", "single", "hierarchical")
+HIERARCHICAL_AUTO_MIN_SCENES = 150 # Từ ~20 phút, một lần gọi dễ vượt giới hạn token đầu ra
+MAX_SCRIPT_ROWS_PER_CALL = 60 # ~40 token / hàng: mỗi lần gọi vẫn nằm gọn trong giới hạn output
+MAX_ACT_ROWS_ATTEMPTS = 3
+# (tên act, tỷ lệ thời lượng, nội dung) - cùng cấu trúc 10/60/25/5% như prompt Step 1
+ACT_STRUCTURE = (
+    ("Act I – Awakening", 0.10, "Introduce environment + first instinct (fear or awe)."),
+    ("Act II – Confrontation", 0.60, "Main survival conflict: danger, strategy, or loss."),
+    ("Act III – Resolution", 0.25, "Survival outcome, emotional reflection."),
+    ("Tag Scene", 0.05, "A haunting or hopeful visual to tease the next episode."),
+)
+ACT_LINE_REGEX = re.compile(r"^\W*(act\s+iii|act\s+ii|act\s+i|tag)\b[^:\n]*:\s*(.+)$", re.IGNORECASE | re.MULTILINE)
+ACT_KEYS = ("act i", "act ii", "act iii", "tag")
+
+def use_hierarchical_script(script_mode, total_scenes):
+    """
+    "auto": phân cấp khi số cảnh từ HIERARCHICAL_AUTO_MIN_SCENES trở lên.
+    """
+    if script_mode not in SCRIPT_MODES:
+        raise ValueError(f"Unknown script mode: {script_mode!r}")
+    return script_mode == "hierarchical" or (script_mode == "auto" and total_scenes >= HIERARCHICAL_AUTO_MIN_SCENES)
+
+def split_scenes_across_acts(total_scenes, structure=ACT_STRUCTURE):
+    """
+    Chia đúng `total_scenes` cảnh cho các act theo tỷ lệ (phần dư lớn nhất), mỗi act ít nhất 1 cảnh
+    nếu đủ cảnh.
+    """
+    shares = [total_scenes * fraction for _, fraction, _ in structure]
+    counts = [int(share) for share in shares]
+    by_remainder = sorted(range(len(structure)), key=lambda i: shares[i] - counts[i], reverse=True)
+    for i in by_remainder[:total_scenes - sum(counts)]:
+        counts[i] += 1
+    if total_scenes >= len(structure):
+        for i, count in enumerate(counts):
+            if count == 0:
+                # Lấy một cảnh từ act dài nhất
+                counts[counts.index(max(counts))] -= 1
+                counts[i] = 1
+    return counts
+
+def format_timecode(seconds):
+    return f"{seconds // 60:02d}:{seconds % 60:02d}"
+
+def build_outline_prompt(video_topic, video_duration_minutes, total_scenes, act_scene_counts, consistency_keys=None):
+    """
+    Prompt ngắn cho bước đầu của chế độ phân cấp: mọi section của kịch bản trừ bảng cảnh,
+    cộng nhân vật và tóm tắt từng act (bảng cảnh được tạo song song theo act sau đó).
+    """
+    act_lines = "\n".join(
+        f"        - **{name} ({count} scenes, {fraction:.0%} duration):** {purpose}"
+        for (name, fraction, purpose), count in zip(ACT_STRUCTURE, act_scene_counts)
+    )
+    prompt = f"""
+        You are a cinematic scriptwriter for the YouTube channel “PrehumanFile,” which produces visually immersive, emotional, AI-generated documentaries about prehistoric survival.
+
+        Your task: Write the EPISODE OUTLINE for one episode (the scene table will be written separately, act by act).
+
+        === INPUT ===
+        Video Topic: "{video_topic}"
+        Video Duration: "{video_duration_minutes} minutes" ({total_scenes} scenes of {SCENE_DURATION_SECONDS}s)
+
+        The episode has 3 ACTS and a CLOSING TAG:
+{act_lines}
+
+        - **Scientific Consistency:** You MUST define the specific prehistoric era (e.g., Late Pleistocene) and hominid species (e.g., Neanderthal, Homo erectus) based on the topic.
+        - All animals, plants, and tools MUST be scientifically accurate for that era and species.
+        - First 8 seconds: visual shock or emotional hook (“Fear → Curiosity → Survival”).
+        - CTA end-screen line: “Continue the PrehumanFile — next chapter below 🔥”.
+
+        === OUTPUT FORMAT ===
+        Return everything as clear Markdown sections (no scene table):
+        # Title
+        (Suggested Title, YouTube style: “Life X Million Years Ago | [Conflict/Emotion/Outcome]”)
+
+        # Description
+        (Tagline and SEO-optimized Description)
+
+        # Hashtags
+        (Hashtags)
+
+        # Era Definition
+        (e.g., "Era: Late Pleistocene. Species: Homo neanderthalensis")
+
+        # Characters
+        (One line per main character or key location, with a short visual description)
+
+        # Act Breakdown
+        (One line per act, exactly in this form: "Act I: <3-5 sentence synopsis>", "Act II: ...", "Act III: ...", "Tag: ...")
+
+        # Thumbnail Prompts
+        (3 highly detailed, 50-word cinematic thumbnail prompts)
+
+        # Keywords
+        (5 keywords)
+
+        # CTA
+        (CTA Line and Hook Text)
+
+        Tone: cinematic, emotional, survival-driven, with a mythic prehistoric atmosphere.
+        """
+    if consistency_keys:
+        prompt += f"""
+        === PREDEFINED CONSISTENCY KEYS ===
+        Use these exact names, species and era in the outline:
+        "{consistency_keys}"
+        """
+    return prompt
+
+def parse_act_synopses(outline_text):
+    """
+    Tóm tắt của từng act trong phần "Act Breakdown" của outline; act không tìm thấy
+    thì dùng mô tả mặc định trong ACT_STRUCTURE.
+    """
+    synopses = {}
+    for label, synopsis in ACT_LINE_REGEX.findall(outline_text or ""):
+        key = " ".join(label.lower().split())
+        synopses.setdefault(key, synopsis.strip().strip("*").strip())
+    return [synopses.get(key) or purpose for key, (_, _, purpose) in zip(ACT_KEYS, ACT_STRUCTURE)]
+
+def build_act_rows_prompt(video_topic, outline_text, act_index, act_synopsis, first_scene, num_rows,
+                          act_first_scene, act_scenes, total_scenes):
+    """
+    Prompt cho một đoạn hàng của bảng cảnh (một act, hoặc một phần của act dài).
+    """
+    act_name, _, act_purpose = ACT_STRUCTURE[act_index]
+    last_scene = first_scene + num_rows - 1
+    position = ("the opening" if first_scene == act_first_scene else
+                "the closing" if last_scene == act_first_scene + act_scenes - 1 else "a middle")
+    return f"""
+        You are a cinematic scriptwriter for the YouTube channel “PrehumanFile” (prehistoric survival documentaries).
+        Episode topic: "{video_topic}"
+
+        === EPISODE OUTLINE ===
+        {outline_text}
+
+        === YOUR PART ===
+        {act_name}: {act_purpose}
+        Act synopsis: {act_synopsis}
+        Write scenes {first_scene}-{last_scene} of {total_scenes}: {position} part of this act
+        (the act covers scenes {act_first_scene}-{act_first_scene + act_scenes - 1}).
+        Each scene = one {SCENE_DURATION_SECONDS}s micro-shot (for VEO 3 input), compact English, one line per scene.
+        Use the era, species and characters from the outline.
+
+        Return ONLY a Markdown table with exactly {num_rows} rows (no other text):
+        | Timecode | Scene Description (1 line, cinematic) | Camera Angle | Sound/Ambience | Emotion |
+        |-----------|----------------------------------------|----------------|----------------|----------|
+        """
+
+def plan_act_chunks(act_scene_counts, max_rows=MAX_SCRIPT_ROWS_PER_CALL):
+    """
+    Các lần gọi của chế độ phân cấp: list (act_index, first_scene, num_rows, act_first_scene, act_scenes),
+    act dài được chia thành các đoạn đều nhau, mỗi đoạn tối đa `max_rows` hàng.
+    """
+    chunks = []
+    act_first_scene = 1
+    for act_index, act_scenes in enumerate(act_scene_counts):
+        num_chunks = max(1, math.ceil(act_scenes / max_rows))
+        for k in range(num_chunks):
+            start = act_scenes * k // num_chunks
+            end = act_scenes * (k + 1) // num_chunks
+            if end > start:
+                chunks.append((act_index, act_first_scene + start, end - start, act_first_scene, act_scenes))
+        act_first_scene += act_scenes
+    return chunks
+
+def build_filler_scene(act_index, act_synopsis):
+    # Hàng thay thế khi AI không viết được cảnh: giữ đúng số cảnh và timecode
+    return {"timecode": "", "description": f"{ACT_STRUCTURE[act_index][0]}: {act_synopsis}",
+            "camera": "Wide establishing shot", "sound": "Ambient wind", "emotion": "Tension"}
+
+def generate_act_rows(video_topic, outline_text, act_synopses, chunk, total_scenes, limiter=None,
+                      refresh_cache=False, usage=None, retry_policy=None):
+    """
+    Tạo đúng `num_rows` hàng cho một đoạn của chế độ phân cấp và trả về (rows, messages).
+    Thiếu hàng thì gửi lại phần còn thiếu; sau MAX_ACT_ROWS_ATTEMPTS lần vẫn thiếu thì thêm
+    hàng dựa trên tóm tắt của act để số cảnh luôn chính xác.
+    Chạy trong worker thread: không gọi reporter, thông báo được gom lại.
+    """
+    messages = []
+    log = lambda level, message: messages.append((level, message))
+    act_index, first_scene, num_rows, act_first_scene, act_scenes = chunk
+    act_name = ACT_STRUCTURE[act_index][0]
+    rows = []
+    for attempt in range(MAX_ACT_ROWS_ATTEMPTS):
+        needed = num_rows - len(rows)
+        table_text = call_gemini_api(
+            build_act_rows_prompt(video_topic, outline_text, act_index, act_synopses[act_index],
+                                  first_scene + len(rows), needed, act_first_scene, act_scenes, total_scenes),
+            limiter=limiter, log=log, refresh_cache=refresh_cache or attempt > 0, usage=usage,
+            stage="step1_act", retry_policy=retry_policy,
+            cache_if=lambda text: len(complete_table_rows(text)) >= needed # Chỉ cache bảng đủ hàng
+        )
+        new_rows = complete_table_rows(table_text)[:needed]
+        if table_text and usage is not None:
+            usage.annotate_last_call(scenes_requested=needed, parse_outcome=f"{len(new_rows)} scenes")
+        rows.extend(new_rows)
+        if len(rows) == num_rows:
+            return rows, messages
+        log("warning", f"   ! {act_name}: received {len(new_rows)}/{needed} rows for scenes "
+                       f"{first_scene + len(rows) - len(new_rows)}-{first_scene + num_rows - 1}. Re-requesting the rest.")
+
+    log("warning", f"   ! {act_name}: {num_rows - len(rows)} scenes could not be written; "
+                   f"filling scenes {first_scene + len(rows)}-{first_scene + num_rows - 1} from the act synopsis.")
+    rows.extend(build_filler_scene(act_index, act_synopses[act_index]) for _ in range(num_rows - len(rows)))
+    return rows, messages
+
+def assemble_hierarchical_script(outline_text, scene_rows):
+    """
+    Ghép outline và các hàng của mọi act thành một kịch bản Markdown như Step 1 thường,
+    với Timecode tính lại từ vị trí cảnh (SCENE_DURATION_SECONDS mỗi cảnh).
+    """
+    table_lines = ["| Timecode | Scene Description | Camera Angle | Sound/Ambience | Emotion |",
+                   "|---|---|---|---|---|"]
+    for i, row in enumerate(scene_rows):
+        row["timecode"] = format_timecode(i * SCENE_DURATION_SECONDS)
+        cells = [str(row.get(field) or "").replace("|", "/") for field in TABLE_FIELDS]
+        table_lines.append("| " + " | ".join(cells) + " |")
+    return f"{outline_text.strip()}\n\n# Script (table format)\n" + "\n".join(table_lines)
+
+def generate_hierarchical_script(video_topic, video_duration_minutes, total_scenes, executor, limiter=None,
+                                 log=None, refresh_cache=False, usage=None, retry_policy=None,
+                                 consistency_keys=None, progress=None):
+    """
+    Step 1 cho video dài: một lần gọi outline ngắn (section, nhân vật, tóm tắt act), sau đó các
+    đoạn hàng của từng act được tạo song song trên `executor` (mỗi lần gọi tối đa
+    MAX_SCRIPT_ROWS_PER_CALL hàng) rồi ghép lại. Thời gian chỉ còn phụ thuộc đoạn chậm nhất thay vì
+    cả bảng, và kịch bản luôn có đúng `total_scenes` cảnh.
+    Trả về kịch bản Markdown, hoặc None nếu không tạo được outline (gọi lại chế độ một lần gọi).
+    """
+    log = log or _print_log
+    act_scene_counts = split_scenes_across_acts(total_scenes)
+    outline_text = call_gemini_api(
+        build_outline_prompt(video_topic, video_duration_minutes, total_scenes, act_scene_counts, consistency_keys),
+        limiter=limiter, log=log, refresh_cache=refresh_cache, usage=usage, stage="step1_outline",
+        retry_policy=retry_policy
+    )
+    if not outline_text:
+        return None
+    act_synopses = parse_act_synopses(outline_text)
+    chunks = plan_act_chunks(act_scene_counts)
+    log("info", f"   -> Outline ready. Writing {total_scenes} scenes in {len(chunks)} parallel calls "
+                f"({', '.join(str(count) for count in act_scene_counts)} scenes per act).")
+
+    def traced_act_rows(chunk_num, chunk):
+        # Chạy trong worker thread: span cho từng đoạn hàng
+        span = (usage.span("step1_act_batch", batch=chunk_num, act=ACT_STRUCTURE[chunk[0]][0],
+                           first_scene=chunk[1], scenes=chunk[2]) if usage is not None else contextlib.nullcontext())
+        with span:
+            return generate_act_rows(video_topic, outline_text, act_synopses, chunk, total_scenes, limiter,
+                                     refresh_cache, usage, retry_policy)
+
+    futures = {executor.submit(traced_act_rows, chunk_num, chunk): chunk
+               for chunk_num, chunk in enumerate(chunks, start=1)}
+    rows_by_first_scene = {}
+    for future in as_completed(futures):
+        act_index, first_scene, num_rows, _, _ = futures[future]
+        try:
+            rows, messages = future.result()
+        except Exception as e:
+            rows = []
+            messages = [("warning", f"   ! Unknown error writing scenes {first_scene}-{first_scene + num_rows - 1}. Error: {e}")]
+        for level, message in messages:
+            log(level, message)
+        rows_by_first_scene[first_scene] = rows
+        if progress is not None:
+            progress(len(rows_by_first_scene), len(chunks))
+
+    scene_rows = []
+    for act_index, first_scene, num_rows, _, _ in chunks:
+        rows = rows_by_first_scene[first_scene]
+        # Đoạn lỗi hoàn toàn: vẫn giữ đúng số cảnh, dùng tóm tắt của act
+        scene_rows.extend(rows or [build_filler_scene(act_index, act_synopses[act_index]) for _ in range(num_rows)])
+    return assemble_hierarchical_script(outline_text, scene_rows)
+
+def build_json_template(scene_duration_seconds=SCENE_DURATION_SECONDS):
+    """
+    Template JSON Veo 3 (từ file Prompt AI Veo 3.txt của bạn)
+    """
+    return f"""
+        {{
+            "1. CORE_IDEA": {{
+                "scene_purpose": "Briefly describe the purpose of this scene (based on the scene description)",
+                "desired_duration_seconds": {scene_duration_seconds}
+            }},
+            "2. CHARACTERS_AND_ACTIONS": [
+                {{
+                    "character": "Character Name 1 (if any, use name from consistency keys)",
+                    "description": "Appearance description (TAKE FROM CONSISTENCY KEYS IF AVAILABLE)",
+                    "action_and_expression": "Describe the specific action and expression IN THIS SCENE"
+                }}
+            ],
+            "3. SETTING": {{
+                "location": "Location (TAKE FROM CONSISTENCY KEYS IF AVAILABLE, or describe new)",
+                "time_and_weather": "Time of day and weather in this scene",
+                "key_elements": ["Key Element 1", "Key Element 2", "Key Element 3"],
+                "negative_prompt": "cartoon, animated, stylized, illustration, low-resolution, blurry, morphing artifacts, distorted features, unrealistic movement, fast motion, shaky cam, text, watermark, humans, man-made objects, modern technology, grass, flowering plants, mammals, incorrect anatomy, unrealistic physics, gore, blood."
+            }},
+            "4. VISUAL_STYLE_AND_MOOD": {{
+                "film_genre": "Science Fiction",
+                "primary_mood": "The primary mood or atmosphere (e.g., 'Mystical', 'Joyful', 'Mysterious and tense')",
+                "lighting_and_color": "Description of lighting and dominant colors (e.g., 'Soft lighting, pastel tones', 'High contrast, neon colors')",
+                "camera_work": "Description of camera techniques (e.g., 'Low angle shot', 'Handheld camera')"
+            }},
+            "5. AUDIO": {{
+                "background_music": "Type of background music (e.g., 'Epic orchestral score', 'Gentle lo-fi music')",
+                "ambient_sound": "A rich, layered description of the soundscape (e.g., 'the buzz of prehistoric insects, distant calls of unknown creatures')",
+                "sound_effects": ["Sound Effect 1 (e.g., 'deep footfalls')", "Sound Effect 2 (e.g., 'a low growl')"]
+            }}
+        }}
+        """
+
+def build_metadata_text(other_script_data):
+    """
+    Nội dung tệp video_metadata.txt từ các phần đã phân tích của kịch bản.
+    """
+    metadata_content = f"""
+# ===============================
+# PREHUMANFILE VIDEO METADATA
+# ===============================
+
+# TITLE
+{other_script_data.get('title', 'N/A')}
+
+# DESCRIPTION
+{other_script_data.get('description', 'N/A')}
+
+# HASHTAGS
+{other_script_data.get('hashtags', 'N/A')}
+
+# KEYWORDS
+{other_script_data.get('keywords', 'N/A')}
+
+# THUMBNAIL PROMPTS
+{other_script_data.get('thumbnail_prompts', 'N/A')}
+            """
+    return metadata_content.strip()
+
+# --- [NEW] XUẤT KẾT QUẢ RA BỘ NHỚ (NHIỀU ĐỊNH DẠNG) ---
+DEFAULT_OUTPUT_BASENAME = "prehumanfile_veo3_prompts"
+# Thứ tự cột của file xuất (giống thứ tự khóa trong build_scene_row)
+EXPORT_COLUMNS = (
+    "Scene ID", "Table: Timecode", "Table: Description", "Table: Camera", "Table: Sound", "Table: Emotion",
+    "JSON Prompt (Full)", "JSON: Scene Purpose", "JSON: Character 1",
+    "JSON: Detailed Description (300-400 words)", "Generation Status",
+)
+EXPORT_FORMATS = {
+    # định dạng -> (đuôi file, MIME type)
+    "xlsx": (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv": (".csv", "text/csv"),
+    "jsonl": (".jsonl", "application/x-ndjson"),
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+}
+
+def slugify(text, max_length=60):
+    slug = re.sub(r"[^a-z0-9]+", "-", text.lower()).strip("-")[:max_length].strip("-")
+    return slug or "episode"
+
+def job_output_name(video_topic, run_id):
+    """
+    Tên file xuất riêng cho từng job, để các job / người dùng đồng thời không ghi đè lên nhau.
+    """
+    return f"{DEFAULT_OUTPUT_BASENAME}_{slugify(video_topic, 40)}_{run_id}"
+
+def _export_values(row):
+    return [row.get(column, "") for column in EXPORT_COLUMNS]
+
+class _XlsxExportWriter:
+    # openpyxl write-only: các hàng được ghi tuần tự ra file tạm, bộ nhớ không tăng theo số cảnh
+    def __init__(self):
+        from openpyxl import Workbook
+        self._workbook = Workbook(write_only=True)
+        self._sheet = self._workbook.create_sheet("Veo 3 Prompts")
+        self._sheet.append(list(EXPORT_COLUMNS))
+
+    def write_rows(self, rows):
+        for row in rows:
+            self._sheet.append(_export_values(row))
+
+    def getvalue(self):
+        buffer = io.BytesIO()
+        self._workbook.save(buffer)
+        return buffer.getvalue()
+
+    def close(self):
+        # Đóng file tạm của sheet write-only (bỏ kết quả); không đóng thì openpyxl báo lỗi khi bị thu gom
+        self._sheet.close()
+
+class _CsvExportWriter:
+    def __init__(self):
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._writer.writerow(EXPORT_COLUMNS)
+
+    def write_rows(self, rows):
+        self._writer.writerows(_export_values(row) for row in rows)
+
+    def getvalue(self):
+        # utf-8-sig để Excel mở đúng tiếng Việt / ký tự đặc biệt
+        return self._buffer.getvalue().encode("utf-8-sig")
+
+class _JsonlExportWriter:
+    def __init__(self):
+        self._buffer = io.BytesIO()
+
+    def write_rows(self, rows):
+        for row in rows:
+            record = dict(zip(EXPORT_COLUMNS, _export_values(row)))
+            self._buffer.write((json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8"))
+
+    def getvalue(self):
+        return self._buffer.getvalue()
+
+class _ParquetExportWriter:
+    # Mỗi lần ghi là một row group; cần pyarrow (tùy chọn)
+    def __init__(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self._pa = pa
+        self._schema = pa.schema([(column, pa.int64() if column == "Scene ID" else pa.string())
+                                  for column in EXPORT_COLUMNS])
+        self._buffer = io.BytesIO()
+        self._writer = pq.ParquetWriter(self._buffer, self._schema)
+
+    def write_rows(self, rows):
+        columns = {column: [row.get(column) for row in rows] for column in EXPORT_COLUMNS}
+        self._writer.write_table(self._pa.Table.from_pydict(columns, schema=self._schema))
+
+    def getvalue(self):
+        self._writer.close()
+        return self._buffer.getvalue()
+
+EXPORT_WRITERS = {
+    "xlsx": _XlsxExportWriter,
+    "csv": _CsvExportWriter,
+    "jsonl": _JsonlExportWriter,
+    "parquet": _ParquetExportWriter,
+}
+
+def available_export_formats():
+    """
+    Các định dạng xuất dùng được trong môi trường hiện tại (Parquet cần pyarrow, xlsx cần openpyxl).
+    """
+    formats = []
+    for export_format, module_name in (("xlsx", "openpyxl"), ("csv", None), ("jsonl", None), ("parquet", "pyarrow")):
+        if module_name:
+            try:
+                __import__(module_name)
+            except ImportError:
+                continue
+        formats.append(export_format)
+    return formats
+
+class SceneExporter:
+    """
+    Ghi các hàng cảnh vào bộ nhớ (BytesIO) cho từng định dạng ngay khi các lô hoàn thành.
+    Các lô xong không theo thứ tự nên hàng được giữ lại tới khi đủ đoạn liên tiếp từ cảnh tiếp theo,
+    để file xuất luôn theo đúng thứ tự cảnh. Không ghi gì ra đĩa.
+    """
+    def __init__(self, formats=("xlsx",), base_name=DEFAULT_OUTPUT_BASENAME):
+        unknown = [export_format for export_format in formats if export_format not in EXPORT_WRITERS]
+        if unknown:
+            raise ValueError(f"Unknown export format(s): {', '.join(unknown)}")
+        self.base_name = base_name
+        self._writers = {export_format: EXPORT_WRITERS[export_format]() for export_format in dict.fromkeys(formats)}
+        self._pending = {} # Scene ID -> hàng chưa ghi
+        self._next_scene = 1
+        self.rows_written = 0
+
+    def add_rows(self, rows):
+        for row in rows:
+            self._pending[row["Scene ID"]] = row
+        ready = []
+        while self._next_scene in self._pending:
+            ready.append(self._pending.pop(self._next_scene))
+            self._next_scene += 1
+        self._write(ready)
+
+    def _write(self, rows):
+        if rows:
+            for writer in self._writers.values():
+                writer.write_rows(rows)
+            self.rows_written += len(rows)
+
+    def finish(self):
+        """
+        Ghi nốt các hàng còn lại và trả về {định dạng: (tên file, bytes, MIME type)}.
+        """
+        self._write([self._pending[scene_number] for scene_number in sorted(self._pending)])
+        self._pending = {}
+        outputs = {}
+        for export_format, writer in self._writers.items():
+            extension, mime = EXPORT_FORMATS[export_format]
+            outputs[export_format] = (self.base_name + extension, writer.getvalue(), mime)
+        return outputs
+
+    def close(self):
+        """
+        Bỏ các file đang ghi dở (job bị hủy / lỗi) mà không tạo bytes.
+        """
+        for writer in self._writers.values():
+            if hasattr(writer, "close"):
+                writer.close()
+
+# --- [NEW] GIAO DIỆN BÁO TIẾN ĐỘ (PROGRESS CALLBACK) ---
+class PipelineReporter:
+    """
+    Nhận tiến độ, thông báo và kết quả trung gian của pipeline. Mặc định in ra console;
+    UI (Streamlit) và CLI ghi đè các phương thức cần thiết.
+    Chỉ được gọi từ thread chính của run_episode.
+    """
+    def log(self, level, message):
+        # level: "info" / "success" / "warning" / "error"
+        _print_log(level, message)
+
+    def progress(self, percent, text):
+        pass
+
+    def artifact(self, name, value):
+        """
+        Kết quả trung gian, theo thứ tự xuất hiện:
+        "keys" (str), "script" (str), "sections" (dict), "scene_table" (list), "metadata" (str),
+        "usage" (list các dict theo bước), "trace" (dict tổng hợp của RunTracer.run_summary()).
+        """
+        pass
+
+# --- LOGIC CHÍNH ---
+def run_episode(video_topic, video_duration_minutes, reporter=None, max_workers=DEFAULT_JSON_WORKERS,
+                rpm_limit=DEFAULT_RPM_LIMIT, tpm_limit=DEFAULT_TPM_LIMIT, limiter=None,
+                refresh_cache=False, streaming_mode=False, resume_job=False, exporter=None, script_mode="auto",
+                use_library=True, hedge_mode="off", hedge_percentile=DEFAULT_HEDGE_PERCENTILE,
+                hedge_budget=DEFAULT_HEDGE_BUDGET, stage_models=None):
+    """
+    Chạy Step 1-4 cho một tập và trả về dict kết quả (script, keys, sections, metadata,
+    rows, usage, failed_scenes, run_id), hoặc None nếu không tạo được kịch bản.
+    `limiter`: limiter dùng chung (ví dụ SharedTokenBucketLimiter của CLI); nếu không có,
+    tạo TokenBucketLimiter(rpm_limit, tpm_limit) riêng cho tập này.
+    `streaming_mode` (keys-first): tạo consistency keys từ chủ đề trước, sau đó stream
+    kịch bản và gửi từng lô JSON_BATCH_SIZE cảnh sang Step 4 ngay khi các hàng bảng về tới.
+    `resume_job`: dùng lại kịch bản, keys và các cảnh đã xong trong JobJournal của lần chạy
+    gần nhất, chỉ tạo phần còn thiếu.
+    `exporter`: SceneExporter nhận các hàng ngay khi từng lô xong (Step 5 chỉ còn lấy bytes).
+    `script_mode`: "single" (một lần gọi cho cả kịch bản), "hierarchical" (outline rồi các act song song,
+    xem generate_hierarchical_script) hoặc "auto" (phân cấp từ HIERARCHICAL_AUTO_MIN_SCENES cảnh).
+    `use_library`: Step 3 dùng lại nhân vật / địa điểm trong consistency_library (xem resolve_consistency_keys)
+    và ghi các entry mới vào đó.
+    `hedge_mode`: "duplicate" / "split" gửi thêm request cho các lô Step 4 chạy lâu hơn `hedge_percentile`
+    thời gian của các lô đã xong, tối đa `hedge_budget` x số lô request thêm (xem BatchHedger).
+    `stage_models`: model riêng cho từng route của STAGE_ROUTES ("script", "keys", "json"), dạng spec
+    ("gemini-1.5-pro > gemini-1.5-flash": dùng model sau khi model trước quá tải) hoặc object model;
+    route không có dùng model của configure().
+    """
+    reporter = reporter or PipelineReporter()
+    log = reporter.log
+    reporter.progress(0, "Starting...")
+    # Trace của lần chạy: thời gian từng bước / lô, từng lần gọi API và token
+    usage = RunTracer(topic=video_topic, duration_minutes=video_duration_minutes, streaming_mode=streaming_mode,
+                      max_workers=max_workers, model=getattr(model, "model_name", None))
+    # Một limiter dùng chung cho tất cả các bước của job này; với ClientPool, rpm/tpm là ngân sách
+    # của mỗi key (pool tự giới hạn từng key) nên limiter của job là tổng các key
+    pool_size = len(model) if isinstance(model, ClientPool) else 1
+    limiter = limiter or TokenBucketLimiter(rpm_limit * pool_size, tpm_limit * pool_size)
+    # Backoff, retry budget và circuit breaker dùng chung cho mọi lần gọi của job
+    retry_policy = RetryPolicy()
+    routes = resolve_stage_models(stage_models)
+    usage.meta["stage_models"] = {route: getattr(routes.get(route, model), "model_name", None) for route in STAGE_ROUTES}
+
+    # Tính toán tổng số cảnh
+    total_scenes = math.ceil((video_duration_minutes * 60) / SCENE_DURATION_SECONDS)
+    log("info", f"Calculating for {video_duration_minutes} minutes... ({total_scenes} scenes @ {SCENE_DURATION_SECONDS}s each)")
+    hierarchical = use_hierarchical_script(script_mode, total_scenes)
+    usage.meta["script_mode"] = "hierarchical" if hierarchical else "single"
+
+    journal = JobJournal(video_topic, video_duration_minutes, resume=resume_job)
+    if journal.resumed:
+        log("info", f"Resuming run {journal.run_id}: script {'restored' if journal.script else 'missing'}, "
+                    f"consistency keys {'restored' if journal.keys else 'missing'}, "
+                    f"{len(journal.rows)} scenes already generated.")
+    elif resume_job:
+        log("info", "No previous run found for this topic and duration. Starting a new run.")
+
+    json_template_string = build_json_template(SCENE_DURATION_SECONDS)
+    consistency_keys = "None"
+    # Worker chạy trong context của run_episode (route model của lần chạy này)
+    executor = ContextThreadPoolExecutor(max_workers=max(1, int(max_workers)))
+    # Hedge chạy trên executor riêng: không phải xếp hàng sau các lô chưa bắt đầu
+    hedger = BatchHedger(hedge_mode, hedge_percentile, hedge_budget)
+    hedge_executor = ContextThreadPoolExecutor(max_workers=max(1, int(max_workers))) if hedge_mode != "off" else None
+    futures = {}
+    batch_inputs = {} # start_index -> (batch_num, batch_of_scenes_data)
+    future_inputs = {} # future -> (start_index, các cảnh), để tạo hàng FAILED nếu worker lỗi
+    rows_by_scene = {} # Scene ID -> hàng cho Excel (kể cả hàng lấy lại từ journal)
+    # Kích thước lô thích ứng dùng chung cho mọi worker của job
+    batch_sizer = AdaptiveBatchSizer(JSON_BATCH_SIZE)
+    usage.meta["run_id"] = journal.run_id
+    prompt_prefix = None
+
+    def traced_json_batch(batch_num, run_start, run_scenes, batch_prompt_prefix, submitted_at, cancel_event,
+                          hedge=None):
+        # Chạy trong worker thread: span cho từng lô, kèm thời gian chờ worker rảnh
+        if hedge is None:
+            hedger.batch_started(run_start)
+        with usage.span("step4_hedge_batch" if hedge else "step4_batch", batch=batch_num, first_scene=run_start + 1,
+                        scenes=len(run_scenes), queued_seconds=round(usage.elapsed() - submitted_at, 3),
+                        **({"hedge": hedge} if hedge else {})):
+            return process_json_batch(batch_num, run_start, run_scenes, batch_prompt_prefix,
+                                      limiter, refresh_cache, batch_sizer, usage, retry_policy, json_template_string,
+                                      cancel_event)
+
+    def launch_hedge(start_index, mode):
+        # Phương án dự phòng cho một lô chậm: nguyên lô, hoặc hai nửa gửi song song
+        batch_num, run_scenes = batch_inputs[start_index]
+        half = len(run_scenes) // 2
+        parts = ([(start_index, run_scenes[:half]), (start_index + half, run_scenes[half:])]
+                 if mode == "split" and half else [(start_index, run_scenes)])
+        hedge_futures = []
+        for part_start, part_scenes in parts:
+            future = hedge_executor.submit(traced_json_batch, batch_num, part_start, part_scenes, prompt_prefix,
+                                           usage.elapsed(), hedger.cancel_event(start_index), mode)
+            future_inputs[future] = (part_start, part_scenes)
+            hedge_futures.append(future)
+        return hedge_futures
+
+    def batch_outcome(start_index, variant_futures):
+        # (rows, messages) của một phương án đã xong; worker lỗi -> hàng FAILED cho các cảnh của nó
+        batch_num = batch_inputs[start_index][0]
+        rows, messages = [], []
+        for future in variant_futures:
+            try:
+                future_rows, future_messages = future.result()
+            except Exception as e:
+                part_start, part_scenes = future_inputs[future]
+                future_rows = [build_failure_row(part_start + 1 + j, scene_data, f"unexpected error: {e}")
+                               for j, scene_data in enumerate(part_scenes)]
+                future_messages = [("warning", f"   ! Unknown error processing JSON list for batch {batch_num}. Error: {e}")]
+            rows.extend(future_rows)
+            messages.extend(future_messages)
+        return rows, messages
+
+    def dispatch_batch(start_index, batch_of_scenes_data):
+        # Gửi một lô sang worker. Prefix tĩnh của Step 4 được tạo một lần cho cả tập,
+        # khi lô đầu tiên được gửi (lúc đó consistency_keys đã có).
+        nonlocal prompt_prefix
+        batch_num = start_index // JSON_BATCH_SIZE + 1
+        # Cảnh đã có trong journal thì lấy lại; chỉ gửi các đoạn cảnh liên tiếp còn thiếu
+        missing_runs = []
+        for j, scene_data in enumerate(batch_of_scenes_data):
+            scene_number = start_index + 1 + j
+            if scene_number in journal.rows:
+                rows_by_scene[scene_number] = journal.rows[scene_number]
+                if exporter is not None:
+                    exporter.add_rows([journal.rows[scene_number]])
+            elif missing_runs and missing_runs[-1][0] + len(missing_runs[-1][1]) == start_index + j:
+                missing_runs[-1][1].append(scene_data)
+            else:
+                missing_runs.append((start_index + j, [scene_data]))
+
+        for run_start, run_scenes in missing_runs:
+            if prompt_prefix is None:
+                prompt_prefix = PromptPrefix.build(build_json_batch_prefix(consistency_keys, json_template_string), log=log)
+            future = executor.submit(traced_json_batch, batch_num, run_start, run_scenes,
+                                     prompt_prefix, usage.elapsed(), hedger.cancel_event(run_start))
+            futures[future] = run_start
+            batch_inputs[run_start] = (batch_num, run_scenes)
+            future_inputs[future] = (run_start, run_scenes)
+
+    routes_token = _run_stage_models.set(routes)
+    try:
+        if streaming_mode:
+            # --- [STEP 3 TRƯỚC] (keys-first): GENERATE CONSISTENCY KEYS FROM TOPIC ---
+            with usage.span("step3_keys"):
+                reporter.progress(5, "[1/5] Generating Consistency Keys from topic (keys-first mode)...")
+                if journal.keys:
+                    consistency_keys = journal.keys
+                else:
+                    if use_library:
+                        consistency_keys = resolve_keys_first_consistency_keys(
+                            consistency_library, video_topic, video_duration_minutes, limiter=limiter, log=log,
+                            refresh_cache=refresh_cache, usage=usage, retry_policy=retry_policy
+                        )
+                    else:
+                        consistency_keys = call_gemini_api(build_keys_first_prompt(video_topic, video_duration_minutes),
+                                                           limiter=limiter, log=log, refresh_cache=refresh_cache,
+                                                           usage=usage, stage="step3_keys", retry_policy=retry_policy)
+                    if consistency_keys:
+                        journal.record_keys(consistency_keys)
+                if not consistency_keys:
+                    log("warning", "   ! Warning: Could not generate consistency keys. Continuing without them.")
+                    consistency_keys = "None"
+                reporter.artifact("keys", consistency_keys)
+
+        script_streamed = False # True khi bảng đã được phân tích và các lô đã được gửi trong lúc stream
+        script_restored = bool(journal.script)
+        script_complete = True # False khi stream kịch bản bị ngắt giữa chừng
+        markdown_script = None
+        with usage.span("step1_script", hierarchical=hierarchical):
+            if script_restored:
+                # Resume: dùng lại kịch bản đã lưu, không gọi lại Step 1
+                reporter.progress(10, "[1/5] Restored master script from the job journal...")
+                markdown_script = journal.script
+            elif hierarchical:
+                # --- [STEP 1] (phân cấp): OUTLINE, THEN ACTS IN PARALLEL ---
+                # Ở chế độ keys-first, bảng được ghép xong mới gửi các lô (không chồng với stream)
+                reporter.progress(10, "[1/5] Generating episode outline...")
+                markdown_script = generate_hierarchical_script(
+                    video_topic, video_duration_minutes, total_scenes, executor, limiter=limiter, log=log,
+                    refresh_cache=refresh_cache, usage=usage, retry_policy=retry_policy,
+                    consistency_keys=None if consistency_keys == "None" else consistency_keys,
+                    progress=lambda done, total: reporter.progress(
+                        10 + int(done * (15/total)), f"[1/5] Writing scene table: {done}/{total} parts done...")
+                )
+                if not markdown_script:
+                    log("warning", "   ! Warning: Could not generate the episode outline. Falling back to a single script call.")
+                    hierarchical = False
+                    usage.meta["script_mode"] = "single"
+            if markdown_script is None and streaming_mode:
+                # --- [STEP 1 + 2] STREAM SCRIPT, PARSE ROWS AND DISPATCH BATCHES ---
+                reporter.progress(10, "[2/5] Streaming master script and dispatching JSON batches...")
+                script_chunks = []
+
+                def _collect_chunks():
+                    nonlocal script_complete
+                    script_stream = stream_gemini_api(
+                        build_master_script_prompt(video_topic, video_duration_minutes, total_scenes,
+                                                   consistency_keys=None if consistency_keys == "None" else consistency_keys),
+                        limiter=limiter, log=log, refresh_cache=refresh_cache, usage=usage, stage="step1_script",
+                        retry_policy=retry_policy, cache_if=script_has_scene_table
+                    )
+                    while True:
+                        try:
+                            chunk = next(script_stream)
+                        except StopIteration as stop:
+                            # Giá trị return của stream_gemini_api: phản hồi có đầy đủ không
+                            script_complete = bool(stop.value)
+                            return
+                        script_chunks.append(chunk)
+                        yield chunk
+
+                script_index = ScriptIndexer()
+                scene_list_data = []
+                pending_start = 0
+                for scene_data in iter_markdown_table_rows(_collect_chunks(), script_index):
+                    scene_list_data.append(scene_data)
+                    if len(scene_list_data) - pending_start == JSON_BATCH_SIZE:
+                        dispatch_batch(pending_start, scene_list_data[pending_start:])
+                        pending_start = len(scene_list_data)
+                        reporter.progress(
+                            10 + int(min(len(scene_list_data), total_scenes) * (15/total_scenes)),
+                            f"[2/5] Streaming script: {len(scene_list_data)}/{total_scenes} scenes received, {len(futures)} JSON batches dispatched..."
+                        )
+                # Lô cuối (có thể ít hơn JSON_BATCH_SIZE cảnh)
+                if len(scene_list_data) > pending_start:
+                    dispatch_batch(pending_start, scene_list_data[pending_start:])
+
+                markdown_script = "".join(script_chunks).strip()
+                script_streamed = True
+            elif markdown_script is None:
+                # --- [STEP 1] (Đã Nâng cấp): GENERATE "PREHUMANFILE" SCRIPT ---
+                reporter.progress(10, "[1/5] Generating 'PrehumanFile' master script...")
+                markdown_script = call_gemini_api(
+                    build_master_script_prompt(video_topic, video_duration_minutes, total_scenes),
+                    limiter=limiter, log=log, refresh_cache=refresh_cache, usage=usage, stage="step1_script",
+                    retry_policy=retry_policy, cache_if=script_has_scene_table
+                )
+
+        if not markdown_script:
+            log("error", "Error: Could not generate master script. Exiting.")
+            return None
+        if not script_complete:
+            log("warning", "   ! Warning: The master script stream was interrupted. Continuing with the partial script; "
+                           "it will be regenerated on resume.")
+        if not script_restored:
+            journal.record_script(markdown_script, complete=script_complete)
+
+        reporter.artifact("script", markdown_script)
+
+        # --- [STEP 2] (Đã Nâng cấp): PARSE MARKDOWN SCRIPT ---
+        with usage.span("step2_parse"):
+            reporter.progress(25, "[2/5] Parsing generated script...")
+
+            # Phân tích bảng và các section trong một lượt
+            # (ở chế độ streaming, kịch bản đã được phân tích trong lúc stream)
+            if not script_streamed:
+                script_index = index_script(markdown_script)
+                scene_list_data = script_index.rows
+
+            if not scene_list_data:
+                log("error", "   ! Critical Error: AI did not return a valid Markdown Table for the script. Stopping.")
+                return None
+
+            if not script_restored and not hierarchical:
+                # Kết quả parse của lần gọi Step 1 (lần gọi gần nhất của thread này;
+                # ở chế độ phân cấp mỗi lần gọi act đã tự ghi kết quả)
+                usage.annotate_last_call(parse_outcome=f"{len(scene_list_data)} scenes", scenes_requested=total_scenes)
+
+            num_scenes_generated = len(scene_list_data)
+            if num_scenes_generated != total_scenes:
+                log("warning", f"   ! Warning: AI generated {num_scenes_generated} scenes instead of {total_scenes} as requested. Continuing.")
+            else:
+                log("info", f"   -> Parsed a total of {num_scenes_generated} scenes from Markdown table.")
+
+        # Phân tích các phần khác (Tiêu đề, Mô tả...)
+        other_script_data = parse_script_sections(markdown_script, script_index)
+        reporter.artifact("sections", other_script_data)
+        reporter.artifact("scene_table", scene_list_data)
+        metadata_content = build_metadata_text(other_script_data)
+        reporter.artifact("metadata", metadata_content)
+
+        if not streaming_mode:
+            # --- [STEP 3] (Đã Nâng cấp): GENERATE CONSISTENCY KEYS ---
+            with usage.span("step3_keys"):
+                reporter.progress(40, "[3/5] Generating Consistency Keys...")
+                if journal.keys:
+                    consistency_keys = journal.keys
+                else:
+                    if use_library:
+                        consistency_keys = resolve_consistency_keys(
+                            consistency_library, video_topic, markdown_script, scene_list_data,
+                            other_script_data.get("era_definition"), limiter=limiter, log=log,
+                            refresh_cache=refresh_cache, usage=usage, retry_policy=retry_policy
+                        )
+                    else:
+                        consistency_keys = call_gemini_api(build_consistency_keys_prompt(markdown_script),
+                                                           limiter=limiter, log=log, refresh_cache=refresh_cache,
+                                                           usage=usage, stage="step3_keys", retry_policy=retry_policy)
+                    if consistency_keys:
+                        journal.record_keys(consistency_keys)
+                if not consistency_keys:
+                    log("warning", "   ! Warning: Could not generate consistency keys. Continuing without them.")
+                    consistency_keys = "None"
+                reporter.artifact("keys", consistency_keys)
+
+        # --- [STEP 4] (Đã Nâng cấp): GENERATE VEO 3 JSON PROMPT (IN BATCHES) ---
+        with usage.span("step4_json", overlapped_with_stream=script_streamed):
+            reporter.progress(60, "[4/5] Processing JSON details in batches...")
+
+            all_scenes_data = [] # Đây là danh sách cuối cùng cho Excel
+
+            # Chia danh sách cảnh thành các lô (batch) độc lập rồi xử lý song song
+            # (ở chế độ streaming, các lô đã được gửi đi trong lúc stream)
+            if not script_streamed:
+                for i in range(0, len(scene_list_data), JSON_BATCH_SIZE):
+                    dispatch_batch(i, scene_list_data[i:i + JSON_BATCH_SIZE])
+
+            num_batches = len(futures)
+            completed_batches = 0
+            if journal.rows and rows_by_scene:
+                log("info", f"   -> Restored {len(rows_by_scene)} scenes from the job journal; {num_batches} JSON batches left to generate.")
+
+            # Cập nhật tiến độ theo thứ tự hoàn thành, không phải thứ tự gửi
+            # (với hedging: theo thứ tự có kết quả, phương án nào của lô xong trước thì dùng)
+            for start_index, rows, messages in hedger.completed(futures, batch_outcome, launch_hedge):
+                batch_num = batch_inputs[start_index][0]
+                for level, message in messages:
+                    log(level, message)
+                # Ghi vào journal ngay khi lô xong để lần resume sau không phải tạo lại
+                journal.record_rows(rows)
+                for row in rows:
+                    rows_by_scene[row["Scene ID"]] = row
+                if exporter is not None:
+                    exporter.add_rows(rows)
+                completed_batches += 1
+                reporter.progress(60 + int(completed_batches * (35/num_batches)), f"[4/5] Processed JSON batch {batch_num} ({completed_batches}/{num_batches} done)...")
+
+            if hedge_mode != "off":
+                usage.meta["hedging"] = hedger.finish()
+                hedge_stats = usage.meta["hedging"]
+                log("info", f"   -> Hedging ({hedge_mode}): {hedge_stats['hedged_batches']} slow batches hedged with "
+                            f"{hedge_stats['extra_requests']} extra requests, {hedge_stats['hedges_won']} finished first, "
+                            f"at least {hedge_stats['seconds_saved']:.1f}s of batch time saved "
+                            f"({hedge_stats['losers_unfinished']} slower requests still running).")
+
+            # Ghép kết quả lại theo đúng thứ tự cảnh
+            for scene_number in sorted(rows_by_scene):
+                all_scenes_data.append(rows_by_scene[scene_number])
+
+            failed_scenes = sum(1 for row in all_scenes_data if row.get("Generation Status", "OK") != "OK")
+            if failed_scenes:
+                log("warning", f"   ! {failed_scenes}/{len(all_scenes_data)} scenes could not be generated and are marked FAILED in the export.")
+            if retry_policy.breaker.times_opened:
+                log("warning", f"   ! The API failed repeatedly: the circuit breaker opened {retry_policy.breaker.times_opened} time(s) "
+                               "and batches were failed fast. Resume the job later to retry the failed scenes.")
+
+        # Trạng thái retry của job cho trace
+        usage.meta["retry_policy"] = dict(retry_policy.stats, retry_budget=retry_policy.retry_budget,
+                                          breaker_opened=retry_policy.breaker.times_opened)
+
+        # Token đã dùng theo từng bước (lấy từ usage_metadata của API)
+        usage_summary = usage.summary()
+        reporter.artifact("usage", usage_summary)
+        scenes_ok = len(all_scenes_data) - failed_scenes
+        reporter.artifact("trace", usage.run_summary(scenes_ok))
+
+        return {
+            "topic": video_topic,
+            "duration_minutes": video_duration_minutes,
+            "run_id": journal.run_id,
+            "script": markdown_script,
+            "keys": consistency_keys,
+            "sections": other_script_data,
+            "metadata": metadata_content,
+            "rows": all_scenes_data,
+            "usage": usage_summary,
+            "failed_scenes": failed_scenes,
+            "trace": usage,
+        }
+    finally:
+        # Không để worker chạy tiếp khi job đã dừng giữa chừng
+        executor.shutdown(wait=False, cancel_futures=True)
+        if hedge_executor is not None:
+            hedge_executor.shutdown(wait=False, cancel_futures=True)
+        _run_stage_models.reset(routes_token)
+        if prompt_prefix is not None:
+            prompt_prefix.release()
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# Cache, journal và thư viện consistency của test nằm trong thư mục tạm (phải đặt trước khi import pipeline)
+_work_dir = tempfile.mkdtemp(prefix="tests_")
+os.environ["GEMINI_CACHE_DIR"] = os.path.join(_work_dir, "cache")
+os.environ["JOB_JOURNAL_DIR"] = os.path.join(_work_dir, "journal")
+os.environ["CONSISTENCY_LIBRARY_PATH"] = os.path.join(_work_dir, "consistency_library.jsonl")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,60 @@
+from concurrent.futures import Future
+import itertools
+import script_pipeline
+
+def _finished(rows):
+    future = Future()
+    future.set_result((rows, []))
+    return future
+
+def test_both_variants_finishing_in_the_same_wait():
+    # Lô chậm và phương án hedge của nó cùng xong trước lượt wait() tiếp theo: chỉ yield lô một lần
+    ticks = itertools.count()
+    hedger = script_pipeline.BatchHedger("duplicate", percentile=0.5, budget=1.0, min_samples=1,
+                                         clock=lambda: next(ticks))
+    fast = _finished([{"Scene ID": 1}])
+    slow = Future()
+    hedger.batch_started(0)
+    hedger.batch_started(10)
+
+    def launch(start_index, mode):
+        hedge = Future()
+        slow.set_result(([{"Scene ID": 11}], []))
+        hedge.set_result(([{"Scene ID": 11}], []))
+        return [hedge]
+
+    def outcome(start_index, variant_futures):
+        return variant_futures[0].result()
+
+    results = list(hedger.completed({fast: 0, slow: 10}, outcome, launch))
+    assert sorted(start_index for start_index, _, _ in results) == [0, 10]
+    assert hedger.finish()["hedged_batches"] == 1
+
+def test_threshold_keeps_samples_of_batches_won_by_hedges():
+    # Hai lô nhanh chạy 10s; hai lô chậm (bắt đầu từ t=-20) được hedge và phương án hedge thắng ở t=40
+    now = [0]
+    hedger = script_pipeline.BatchHedger("duplicate", percentile=0.75, budget=1.0, min_samples=2,
+                                         clock=lambda: now[0])
+    fast = [_finished([{"Scene ID": 1}]), _finished([{"Scene ID": 11}])]
+    slow = [Future(), Future()]
+    hedger.batch_started(0)
+    hedger.batch_started(10)
+    now[0] = -20
+    hedger.batch_started(20)
+    hedger.batch_started(30)
+    now[0] = 10
+
+    def launch(start_index, mode):
+        now[0] = 40
+        return [_finished([{"Scene ID": start_index + 1}])]
+
+    def outcome(start_index, variant_futures):
+        return variant_futures[0].result()
+
+    results = list(hedger.completed({fast[0]: 0, fast[1]: 10, slow[0]: 20, slow[1]: 30}, outcome, launch))
+    assert sorted(start_index for start_index, _, _ in results) == [0, 10, 20, 30]
+    stats = hedger.finish()
+    assert stats["hedges_won"] == 2
+    # Mẫu của lô được hedge là thời gian từ lúc lô bắt đầu tới khi có kết quả: ngưỡng không tụt về các lô nhanh
+    assert sorted(hedger.latencies) == [10, 10, 60, 60]
+    assert stats["threshold_seconds"] == 60
@@ -0,0 +1,30 @@
+import time
+import pytest
+import script_pipeline
+
+def test_breaker_opens_half_opens_and_closes():
+    breaker = script_pipeline.CircuitBreaker(failure_threshold=2, reset_seconds=0.05)
+    breaker.record_failure()
+    breaker.before_call()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.is_open()
+    with pytest.raises(script_pipeline.CircuitOpenError):
+        breaker.before_call()
+
+    time.sleep(0.06)
+    breaker.before_call() # Request thử
+    assert breaker.state == "half_open"
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.consecutive_failures == 0
+    assert breaker.times_opened == 1
+
+def test_failed_probe_reopens_the_breaker():
+    breaker = script_pipeline.CircuitBreaker(failure_threshold=1, reset_seconds=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.times_opened == 2
+    with pytest.raises(script_pipeline.CircuitOpenError):
+        breaker.before_call()
@@ -0,0 +1,18 @@
+import fake_llm
+import script_pipeline
+
+def test_quota_error_fails_over_to_the_next_key():
+    exhausted = fake_llm.FakeGenerativeModel(model_name="fake-key1", rate_limit_rate=1.0)
+    healthy = fake_llm.FakeGenerativeModel(model_name="fake-key2")
+    pool = script_pipeline.ClientPool.from_models([exhausted, healthy], labels=["key1", "key2"])
+
+    for i in range(3):
+        response = pool.generate_content(f"Extract the consistency keys for episode {i}.")
+        assert response.text
+        assert pool.served_by() == "key2"
+
+    stats = {client["client"]: client for client in pool.stats()}
+    # Key hết quota chỉ bị thử một lần rồi nằm ngoài vòng quay trong thời gian cooldown
+    assert stats["key1"]["quota_errors"] == 1 and stats["key1"]["cooling_down"]
+    assert stats["key2"]["calls"] == 3 and not stats["key2"]["cooling_down"]
+    assert exhausted.stats["rate_limited"] == 1
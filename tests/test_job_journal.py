@@ -0,0 +1,67 @@
+import json
+import re
+import fake_llm
+import script_pipeline
+
+class _InterruptedScriptModel(fake_llm.FakeGenerativeModel):
+    """
+    Model giả lập mà stream (chỉ Step 1 dùng stream) bị ngắt ở giữa phản hồi khi `interrupt` bật.
+    """
+    interrupt = True
+
+    def _stream(self, text, usage_metadata, delay, chunk_size=200):
+        chunks = list(super()._stream(text, usage_metadata, delay, chunk_size))
+        for index, chunk in enumerate(chunks):
+            if self.interrupt and index == len(chunks) // 2:
+                raise fake_llm.FakeServerError("Connection reset by peer")
+            yield chunk
+
+def test_interrupted_script_stream_is_regenerated_on_resume():
+    model = _InterruptedScriptModel(model_name="fake-interrupted")
+    script_pipeline.configure(backend=model)
+    topic = "The interrupted fire"
+    first = script_pipeline.run_episode(topic, 1, streaming_mode=True, refresh_cache=True, use_library=False)
+    assert first is not None
+
+    journal = script_pipeline.JobJournal(topic, 1, resume=True)
+    assert journal.resumed and journal.script is None and journal.rows == {}
+
+    model.interrupt = False
+    second = script_pipeline.run_episode(topic, 1, streaming_mode=True, resume_job=True, use_library=False)
+    assert second["run_id"] == first["run_id"]
+    assert len(second["script"]) > len(first["script"])
+    assert script_pipeline.JobJournal(topic, 1, resume=True).script == second["script"]
+
+class _RecordingModel(fake_llm.FakeGenerativeModel):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.prompts = []
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        self.prompts.append(prompt)
+        return super().generate_content(prompt, stream=stream, **kwargs)
+
+def test_resume_skips_batches_already_in_the_journal():
+    model = _RecordingModel(model_name="fake-resume")
+    script_pipeline.configure(backend=model)
+    topic = "The resumed hunt"
+    first = script_pipeline.run_episode(topic, 3, refresh_cache=True, use_library=False)
+    assert all(row["Generation Status"] == "OK" for row in first["rows"])
+
+    # Tiến trình chết trước khi lô cuối được ghi: bỏ bản ghi "rows" cuối cùng của journal
+    journal_path = script_pipeline.JobJournal(topic, 3, resume=True).path
+    with open(journal_path, encoding="utf-8") as f:
+        lines = f.readlines()
+    last_rows = max(i for i, line in enumerate(lines) if json.loads(line)["type"] == "rows")
+    lost_scenes = sorted(row["Scene ID"] for row in json.loads(lines[last_rows])["rows"])
+    with open(journal_path, "w", encoding="utf-8") as f:
+        f.writelines(lines[:last_rows] + lines[last_rows + 1:])
+
+    model.prompts = []
+    second = script_pipeline.run_episode(topic, 3, resume_job=True, refresh_cache=True, use_library=False)
+    json_prompts = [prompt for prompt in model.prompts if "--- SCENE " in prompt]
+    # Chỉ các cảnh bị mất được gửi lại; kịch bản và keys lấy từ journal
+    assert len(model.prompts) == len(json_prompts) == 1
+    assert sorted(int(n) for n in re.findall(r"--- SCENE (\d+)", json_prompts[0])) == lost_scenes
+    assert second["run_id"] == first["run_id"]
+    assert [row["Scene ID"] for row in second["rows"]] == [row["Scene ID"] for row in first["rows"]]
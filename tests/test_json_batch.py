@@ -0,0 +1,59 @@
+import threading
+import script_pipeline
+
+class _InvalidJsonModel:
+    """
+    Backend luôn trả về JSON không hợp lệ; đếm số request.
+    """
+    model_name = "invalid-json"
+    supports_response_schema = False
+
+    def __init__(self):
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        with self._lock:
+            self.calls += 1
+        return type("Response", (), {"text": '[{"1. SCENE_INFO": ', "usage_metadata": None})()
+
+def _scenes(count):
+    return [{"timecode": f"00:{8 * i:02d}", "description": f"Scene {i}", "camera": "Wide shot",
+             "sound": "Wind", "emotion": "Calm"} for i in range(count)]
+
+def test_invalid_json_retries_stop_at_the_extra_call_budget():
+    model = _InvalidJsonModel()
+    script_pipeline.configure(backend=model)
+    rows, messages = script_pipeline.process_json_batch(1, 0, _scenes(10), None, refresh_cache=True,
+                                                        extra_call_budget=4)
+    assert model.calls == 1 + 4
+    assert len(rows) == 10
+    assert all(row["Generation Status"].startswith("FAILED") for row in rows)
+    assert any("retry budget of 4 extra calls exhausted" in row["Generation Status"] for row in rows)
+    assert any("retry budget" in message for _, message in messages)
+
+class _FixedResponseModel(_InvalidJsonModel):
+    def __init__(self, model_name, text):
+        super().__init__()
+        self.model_name = model_name
+        self.text = text
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        super().generate_content(prompt, stream=stream, **kwargs)
+        return type("Response", (), {"text": self.text, "usage_metadata": None})()
+
+def test_only_complete_json_lists_are_cached():
+    entries = list(enumerate(_scenes(2), start=1))
+    truncated = _FixedResponseModel("truncated-json", '[{"scene": 1}, {"sce')
+    script_pipeline.configure(backend=truncated)
+    for _ in range(2):
+        objects_by_index, _, _ = script_pipeline.request_json_list(entries, None)
+        assert objects_by_index == {0: {"scene": 1}}
+    assert truncated.calls == 2
+
+    complete = _FixedResponseModel("complete-json", '[{"scene": 1}, {"scene": 2}]')
+    script_pipeline.configure(backend=complete)
+    for _ in range(2):
+        objects_by_index, _, _ = script_pipeline.request_json_list(entries, None)
+        assert objects_by_index == {0: {"scene": 1}, 1: {"scene": 2}}
+    assert complete.calls == 1
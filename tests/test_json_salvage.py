@@ -0,0 +1,21 @@
+import script_pipeline
+
+def test_truncated_array_keeps_complete_objects():
+    text = '```json\n[{"scene": 1, "text": "a ] b"}, {"scene": 2, "nested": {"x": [1, 2]}}, {"scene": 3, "te'
+    objects, complete, malformed = script_pipeline.salvage_json_list(text)
+    assert objects == {0: {"scene": 1, "text": "a ] b"}, 1: {"scene": 2, "nested": {"x": [1, 2]}}}
+    assert not complete
+    assert malformed == []
+
+def test_malformed_element_keeps_its_position():
+    objects, complete, malformed = script_pipeline.salvage_json_list('[{"scene": 1}, {"scene": 2,}, {"scene": 3}]')
+    assert objects == {0: {"scene": 1}, 2: {"scene": 3}}
+    assert complete
+    assert malformed == [1]
+
+def test_salvager_yields_objects_as_chunks_arrive():
+    salvager = script_pipeline.JsonListSalvager()
+    text = '[{"scene": 1, "quote": "say \\"hi\\""}, {"scene": 2}]'
+    completed = [item for start in range(0, len(text), 5) for item in salvager.feed(text[start:start + 5])]
+    assert completed == [(0, {"scene": 1, "quote": 'say "hi"'}), (1, {"scene": 2})]
+    assert salvager.complete
@@ -0,0 +1,52 @@
+import script_pipeline
+
+INTERRUPTED_SCRIPT = """# Title: The First Fire
+
+# Script (table format)
+| Timecode | Scene Description | Camera Angle | Sound/Ambience | Emotion |
+|---|---|---|---|---|
+| 00:00 | A hunter walks through the snow | Wide shot | Wind | Calm |
+| 00:08 | The hunter sees tracks | Close-up | Crunching snow | Curious |
+
+**Act II – Confrontation**
+| 00:16 | The lion attacks the scene | Low angle shot | Roar | Terror |
+| 00:24 | The hunter lights a torch | Medium shot | Crackling fire | Resolve |
+
+# CTA
+Subscribe for more.
+"""
+
+def _parse(text, chunk_size=None):
+    indexer = script_pipeline.ScriptIndexer(min_feed_chars=1)
+    if chunk_size is None:
+        indexer.feed(text)
+    else:
+        for start in range(0, len(text), chunk_size):
+            indexer.feed(text[start:start + chunk_size])
+    indexer.close()
+    return indexer
+
+def test_interrupted_table_keeps_its_columns():
+    for chunk_size in (None, 7):
+        rows = _parse(INTERRUPTED_SCRIPT, chunk_size).rows
+        assert [row["timecode"] for row in rows] == ["00:00", "00:08", "00:16", "00:24"]
+        assert rows[2] == {"timecode": "00:16", "description": "The lion attacks the scene",
+                           "camera": "Low angle shot", "sound": "Roar", "emotion": "Terror"}
+
+def test_header_needs_a_separator_line():
+    text = ("# Script\n"
+            "| 00:00 | Sunrise | Wide shot | Birds | Calm |\n"
+            "| Scene | Shot | Sound |\n"
+            "| 00:08 | Sunset | Aerial | Wind | Quiet |\n")
+    rows = _parse(text).rows
+    assert [row["description"] for row in rows] == ["Sunrise", "Shot", "Sunset"]
+    assert rows[2]["emotion"] == "Quiet"
+
+def test_reordered_header_maps_columns():
+    text = ("# Script\n"
+            "| Emotion | Timecode | Scene Description |\n"
+            "|---|---|---|\n"
+            "| Calm | 00:00 | Sunrise |")
+    indexer = _parse(text)
+    assert indexer.rows == [{"timecode": "00:00", "description": "Sunrise", "camera": "", "sound": "", "emotion": "Calm"}]
+    assert indexer.section("title") is None
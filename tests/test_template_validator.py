@@ -0,0 +1,28 @@
+import json
+import script_pipeline
+
+def _valid_scene():
+    template = json.loads(script_pipeline.build_json_template())
+    template["3. SETTING"]["location"] = "The frozen river"
+    return template
+
+def _validator():
+    _, validator = script_pipeline.get_json_contract(script_pipeline.build_json_template())
+    return validator
+
+def test_scene_without_characters_is_valid():
+    scene = _valid_scene()
+    scene["2. CHARACTERS_AND_ACTIONS"] = []
+    scene["5. AUDIO"]["sound_effects"] = []
+    assert _validator().validate(scene) == []
+
+def test_unnamed_character_is_valid():
+    scene = _valid_scene()
+    scene["2. CHARACTERS_AND_ACTIONS"][0]["character"] = ""
+    assert _validator().validate(scene) == []
+
+def test_mandatory_fields_must_not_be_empty():
+    scene = _valid_scene()
+    scene["3. SETTING"]["location"] = " "
+    scene["3. SETTING"]["key_elements"] = []
+    assert _validator().validate(scene) == ["empty 3. SETTING.location", "empty 3. SETTING.key_elements"]